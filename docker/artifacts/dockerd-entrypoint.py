@@ -12,9 +12,35 @@
 # language governing permissions and limitations under the License.
 from __future__ import absolute_import
 
+import errno
 import shlex
+import signal
 import subprocess
 import sys
 
 
-subprocess.check_call(shlex.split(' '.join(sys.argv[1:])))
+def _wait(process):
+    while True:
+        try:
+            return process.wait()
+        except OSError as e:
+            # Python 2 does not retry a wait that a signal interrupted
+            if e.errno != errno.EINTR:
+                raise
+
+
+process = subprocess.Popen(shlex.split(' '.join(sys.argv[1:])))
+
+
+def _forward(signum, _):
+    # as PID 1, this is the only process that receives the SIGTERM of a stopped or reclaimed
+    # instance; the launcher needs it to let the workers save their state before they exit
+    process.send_signal(signum)
+
+
+for signum in (signal.SIGTERM, signal.SIGINT):
+    signal.signal(signum, _forward)
+
+returncode = _wait(process)
+# exit like a shell does when its child was killed by a signal
+sys.exit(128 - returncode if returncode < 0 else returncode)
@@ -31,8 +31,9 @@ def read(fname):
     return open(os.path.join(os.path.dirname(__file__), fname)).read()
 
 
-test_dependencies = ['botocore', 'boto3', 'docker-compose', 'flake8', 'mock', 'pytest>=4.6.0',
-                     'pytest-cov', 'pytest-xdist', 'sagemaker==1.62.0', 'six', 'tox']
+test_dependencies = ['botocore', 'boto3', 'docker-compose', 'flake8', 'mock', 'numpy',
+                     'pytest>=4.6.0', 'pytest-cov', 'pytest-xdist', 'sagemaker==1.62.0', 'six',
+                     'tox']
 
 if sys.version_info.major > 2:
     test_dependencies.append('sagemaker-experiments==0.1.7')
@@ -64,7 +65,7 @@ setup(
 
     # We don't declare our dependency on mxnet here because we build with
     # different packages for different variants (e.g. mxnet-mkl and mxnet-cu90).
-    install_requires=['sagemaker-training>=3.5.2', 'retrying==1.3.3'],
+    install_requires=['sagemaker-training>=3.6.0', 'retrying==1.3.3', 'psutil'],
     extras_require={
         'test': test_dependencies
     },
@@ -0,0 +1,43 @@
+# Copyright 2018-2020 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the 'License'). You
+# may not use this file except in compliance with the License. A copy of
+# the License is located at
+#
+#     http://aws.amazon.com/apache2.0/
+#
+# or in the 'license' file accompanying this file. This file is
+# distributed on an 'AS IS' BASIS, WITHOUT WARRANTIES OR CONDITIONS OF
+# ANY KIND, either express or implied. See the License for the specific
+# language governing permissions and limitations under the License.
+"""Read the settings that Horovod's autotuner finds best for a job.
+
+With the '_horovod_autotune' hyperparameter set and no settings cached for the cluster, the
+launcher runs the training job with ``HOROVOD_AUTOTUNE`` on. Horovod then explores the tensor
+fusion threshold and cycle time while the job trains, and logs every sample on rank 0; the
+launcher reads the best one from the log once the job ends, so that later jobs start with it.
+"""
+from __future__ import absolute_import
+
+import csv
+import os
+
+
+def read_autotune_log(path):
+    """Return the best settings in a Horovod autotune log, or None if there are none."""
+    if not os.path.exists(path):
+        return None
+
+    with open(path) as f:
+        samples = [row for row in csv.DictReader(f)
+                   if row.get('score') and row.get('tensor_fusion_threshold')]
+    if not samples:
+        return None
+
+    best = max(samples, key=lambda row: float(row['score']))
+    threshold = float(best['tensor_fusion_threshold'])
+    # depending on the Horovod version, the threshold is logged in bytes or in megabytes
+    if threshold < 2 ** 20:
+        threshold *= 2 ** 20
+    return {'HOROVOD_FUSION_THRESHOLD': str(int(threshold)),
+            'HOROVOD_CYCLE_TIME': str(float(best['cycle_time_ms']))}
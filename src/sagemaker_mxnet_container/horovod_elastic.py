@@ -0,0 +1,91 @@
+# Copyright 2018-2020 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the 'License'). You
+# may not use this file except in compliance with the License. A copy of
+# the License is located at
+#
+#     http://aws.amazon.com/apache2.0/
+#
+# or in the 'license' file accompanying this file. This file is
+# distributed on an 'AS IS' BASIS, WITHOUT WARRANTIES OR CONDITIONS OF
+# ANY KIND, either express or implied. See the License for the specific
+# language governing permissions and limitations under the License.
+"""Discover the live hosts of a job for Horovod's elastic driver.
+
+Under elastic training, ``horovodrun`` runs a host discovery script every second and grows or
+shrinks the job to the hosts that it prints. The launcher generates that script with
+``write_discovery_script``; it runs this module, which prints every host of the job whose SSH
+daemon accepts connections, since Horovod reaches the hosts over SSH. The module only imports
+the standard library, so that running it every second stays cheap.
+"""
+from __future__ import absolute_import
+
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import os
+import socket
+import stat
+import sys
+
+SSH_PORT = 22
+CONNECT_TIMEOUT_SECONDS = 2
+MAX_CONNECT_THREADS = 64
+
+DISCOVERY_SCRIPT = '''#!/bin/sh
+exec {python} -m sagemaker_mxnet_container.horovod_elastic --hosts {hosts} --slots {slots} \\
+    --port {port}
+'''
+
+
+def can_connect(host, port=SSH_PORT, timeout=CONNECT_TIMEOUT_SECONDS):
+    """Return whether ``host`` accepts TCP connections on ``port``."""
+    try:
+        socket.create_connection((host, port), timeout).close()
+    except (socket.error, socket.timeout):
+        return False
+    return True
+
+
+def live_hosts(hosts, port=SSH_PORT, timeout=CONNECT_TIMEOUT_SECONDS):
+    """Return the hosts that accept connections on ``port``, in the order of ``hosts``.
+
+    The hosts are checked concurrently, so that a host that went away costs one timeout
+    rather than one per host.
+    """
+    if not hosts:
+        return []
+
+    with ThreadPoolExecutor(max_workers=min(len(hosts), MAX_CONNECT_THREADS)) as pool:
+        alive = list(pool.map(lambda host: can_connect(host, port, timeout), hosts))
+    return [host for host, is_alive in zip(hosts, alive) if is_alive]
+
+
+def write_discovery_script(path, hosts, slots, port=SSH_PORT):
+    """Write an executable host discovery script for ``horovodrun --host-discovery-script``.
+
+    Args:
+        path (str): where to write the script
+        hosts (list[str]): every host of the job
+        slots (int): the worker processes to start on each host
+        port (int): the port that a live host accepts connections on
+    """
+    with open(path, 'w') as f:
+        f.write(DISCOVERY_SCRIPT.format(python=sys.executable, hosts=','.join(hosts),
+                                        slots=slots, port=port))
+    os.chmod(path, os.stat(path).st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+    return path
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Print the live hosts of a job for Horovod.')
+    parser.add_argument('--hosts', required=True, help='every host of the job, comma-separated')
+    parser.add_argument('--slots', type=int, default=1)
+    parser.add_argument('--port', type=int, default=SSH_PORT)
+    args = parser.parse_args()
+
+    for host in live_hosts(args.hosts.split(','), args.port):
+        print('{}:{}'.format(host, args.slots))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,206 @@
+# Copyright 2018-2020 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the 'License'). You
+# may not use this file except in compliance with the License. A copy of
+# the License is located at
+#
+#     http://aws.amazon.com/apache2.0/
+#
+# or in the 'license' file accompanying this file. This file is
+# distributed on an 'AS IS' BASIS, WITHOUT WARRANTIES OR CONDITIONS OF
+# ANY KIND, either express or implied. See the License for the specific
+# language governing permissions and limitations under the License.
+"""Sample the CPU, memory and network use of the processes of a training job.
+
+The launcher starts a ``Sampler`` on every host. It reads /proc directly rather than going
+through psutil, so that sampling the handful of processes of a job every few seconds costs a
+small fraction of one core.
+"""
+from __future__ import absolute_import
+
+from collections import deque
+import logging
+import os
+import threading
+import time
+
+from sagemaker_mxnet_container.training_utils import atomic_write
+
+PROC_PATH = '/proc'
+ROLES = ('scheduler', 'server', 'worker')
+
+SAMPLE_INTERVAL_SECONDS = 5
+SUMMARY_INTERVAL_SECONDS = 60
+# the time series keeps the last hour at the default interval
+HISTORY_SAMPLES = 720
+
+COLUMNS = (['time']
+           + ['{}_{}'.format(role, name) for role in ROLES for name in ('cpu_percent', 'rss_mb')]
+           + ['net_rx_mb_per_second', 'net_tx_mb_per_second'])
+# matched by a SageMaker metric definition such as
+# {'Name': 'server:cpu', 'Regex': 'telemetry_server_cpu_percent=([0-9.]+)'}
+METRIC_FORMAT = 'telemetry_{}={:.2f};'
+
+logger = logging.getLogger(__name__)
+
+
+def read_cpu_seconds(pid, proc_path=PROC_PATH):
+    """Return the user and system CPU time of a process, in seconds."""
+    with open(os.path.join(proc_path, str(pid), 'stat')) as f:
+        stat = f.read()
+    # the command name in parentheses may contain spaces, so count fields from after it
+    fields = stat[stat.rindex(')') + 2:].split()
+    return (int(fields[11]) + int(fields[12])) / float(os.sysconf('SC_CLK_TCK'))
+
+
+def read_rss_bytes(pid, proc_path=PROC_PATH):
+    """Return the resident memory of a process, in bytes."""
+    with open(os.path.join(proc_path, str(pid), 'status')) as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1]) * 1024
+    # zombies have no memory left
+    return 0
+
+
+def read_network_bytes(proc_path=PROC_PATH):
+    """Return the bytes received and sent on every interface but loopback."""
+    received = sent = 0
+    with open(os.path.join(proc_path, 'net', 'dev')) as f:
+        for line in f.readlines()[2:]:
+            interface, counters = line.split(':', 1)
+            if interface.strip() == 'lo':
+                continue
+            counters = counters.split()
+            received += int(counters[0])
+            sent += int(counters[8])
+    return received, sent
+
+
+class Sampler(object):
+    """Sample the processes of each role in a background thread.
+
+    Every ``interval`` seconds, the sampler adds a row to a rolling time series: the CPU use,
+    in percent of one core, and the resident memory of each role, and the network throughput
+    of the host. /proc/net/dev does not tell processes apart, so the network columns cover
+    every role on the host. Every ``summary_interval`` seconds, it logs the mean CPU use and
+    throughput and the peak memory since the last summary as metric lines, and rewrites the
+    time series to ``output_path`` as CSV.
+
+    Args:
+        pids (callable): returns the role of every process to sample, keyed by pid
+        output_path (str): where to write the time series (default: not written)
+        interval (float): the seconds between samples
+        summary_interval (float): the seconds between summaries
+        proc_path (str): where procfs is mounted
+    """
+
+    def __init__(self, pids, output_path=None, interval=None, summary_interval=None,
+                 proc_path=PROC_PATH):
+        self.samples = deque(maxlen=HISTORY_SAMPLES)
+        self._pids = pids
+        self._output_path = output_path
+        self._interval = interval or SAMPLE_INTERVAL_SECONDS
+        self._summary_interval = summary_interval or SUMMARY_INTERVAL_SECONDS
+        self._proc_path = proc_path
+        self._window = []
+        self._cpu_seconds = {}
+        self._network = None
+        self._sampled_at = None
+        self._started_at = time.time()
+        self._sampling_seconds = 0.0
+        self._done = threading.Event()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        """Stop sampling and summarize the samples since the last summary."""
+        self._done.set()
+        if self._thread.is_alive():
+            self._thread.join()
+        self.summarize()
+
+    def _run(self):
+        self.sample()
+        summarized_at = time.time()
+        while not self._done.wait(self._interval):
+            self.sample()
+            if time.time() - summarized_at >= self._summary_interval:
+                self.summarize()
+                summarized_at = time.time()
+
+    def sample(self):
+        """Read the counters of every process and add a row to the time series.
+
+        The first call only reads the counters that the following rows are computed from.
+        """
+        now = time.time()
+        cpu = dict.fromkeys(ROLES, 0.0)
+        rss = dict.fromkeys(ROLES, 0)
+        cpu_seconds = {}
+        for pid, role in self._pids().items():
+            if role not in cpu:
+                continue
+            try:
+                cpu_seconds[pid] = read_cpu_seconds(pid, self._proc_path)
+                rss[role] += read_rss_bytes(pid, self._proc_path)
+            except (IOError, ValueError):
+                # the process exited after it was listed
+                continue
+            cpu[role] += cpu_seconds[pid] - self._cpu_seconds.get(pid, 0.0)
+
+        try:
+            network = read_network_bytes(self._proc_path)
+        except (IOError, ValueError):
+            network = (0, 0)
+
+        if self._sampled_at is not None:
+            elapsed = max(now - self._sampled_at, 1e-6)
+            row = [now]
+            for role in ROLES:
+                row += [round(100 * cpu[role] / elapsed, 2), round(rss[role] / 2.0 ** 20, 2)]
+            row += [round(max(new - old, 0) / elapsed / 2 ** 20, 3)
+                    for new, old in zip(network, self._network)]
+            self.samples.append(row)
+            self._window.append(row)
+
+        self._cpu_seconds = cpu_seconds
+        self._network = network
+        self._sampled_at = now
+        self._sampling_seconds += time.time() - now
+
+    def summarize(self):
+        """Log the metrics of the samples since the last summary and write the time series."""
+        window, self._window = self._window, []
+        if window:
+            for index, column in enumerate(COLUMNS[1:], 1):
+                values = [row[index] for row in window]
+                if column.endswith('_rss_mb'):
+                    value = max(values)
+                else:
+                    value = sum(values) / len(values)
+                logger.info(METRIC_FORMAT.format(column, value))
+
+        # wall time spent sampling, an upper bound on the CPU time it took
+        elapsed = max(time.time() - self._started_at, 1e-6)
+        logger.info(METRIC_FORMAT.format('overhead_percent',
+                                         100 * self._sampling_seconds / elapsed))
+
+        if self._output_path and self.samples:
+            self._write(list(self.samples))
+
+    def _write(self, samples):
+        directory = os.path.dirname(self._output_path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+
+        def write(path):
+            with open(path, 'w') as f:
+                f.write(','.join(COLUMNS) + '\n')
+                for row in samples:
+                    f.write(','.join(str(value) for value in row) + '\n')
+
+        atomic_write(self._output_path, write, per_process=True)
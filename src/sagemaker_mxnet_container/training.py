@@ -12,81 +12,1012 @@
 # language governing permissions and limitations under the License.
 from __future__ import absolute_import
 
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+import functools
+import glob
+import json
 import logging
 import os
+import signal
 import socket
 import subprocess
+import sys
+import tempfile
+import threading
+import time
 
+import psutil
 from retrying import retry
-from sagemaker_training import entry_point, environment, runner
+from sagemaker_training import entry_point, environment, mpi, params, runner
+from sagemaker_training.process import ProcessRunner
 
+from sagemaker_mxnet_container import (horovod_autotune, horovod_elastic, telemetry,
+                                       training_utils)
 from sagemaker_mxnet_container.training_utils import scheduler_host
+from sagemaker_mxnet_container.zygote import Zygote, ZygoteError
 
 LAUNCH_PS_ENV_NAME = 'sagemaker_parameter_server_enabled'
 LAUNCH_MPI_ENV_NAME = 'sagemaker_mpi_enabled'
 ROLES = ['worker', 'scheduler', 'server']
 
+DEFAULT_CHECKPOINT_DIR = '/opt/ml/checkpoints'
+
+# with '_ps_servers_per_host' set to 'auto', one server process is started per this many cores
+CPUS_PER_AUTO_SERVER = 16
+
+# with '_cpu_affinity' enabled and '_ps_reserved_cores' set to 'auto', this many physical cores
+# are reserved per server process, plus one for the scheduler
+CORES_PER_RESERVED_SERVER = 2
+CPU_TOPOLOGY_PATH = '/sys/devices/system'
+
+# the children of mpirun that keep the remote ranks running, rather than local ranks
+MPI_LAUNCH_PROCESSES = ('ssh', 'orted')
+
+THREAD_ENV_VARS = ('OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'MXNET_CPU_WORKER_NTHREADS')
+
+HOROVOD_AUTOTUNE_CACHE = 'horovod-autotune.json'
+HOROVOD_AUTOTUNE_LOG = 'horovod-autotune.csv'
+# the model size in the cache key when '_horovod_autotune_model_mb' is not set
+DEFAULT_AUTOTUNE_MODEL_MB = 100
+
+# how often the hosts other than the master check whether the master is still up
+ELASTIC_MASTER_POLL_INTERVAL_SECONDS = 10
+
+DEFAULT_PROFILE_NUM_STEPS = 10
+
+HOST_LOOKUP_TIMEOUT_SECONDS = 60 * 15
+MAX_HOST_LOOKUP_THREADS = 64
+
+ROLE_POLL_INTERVAL_SECONDS = 1
+ROLE_SHUTDOWN_TIMEOUT_SECONDS = 30
+
 logger = logging.getLogger(__name__)
 
+# Which hosts run which parameter server role. By default every host runs a worker and
+# ``servers_per_host`` servers, and the first host also runs the scheduler.
+PSLayout = namedtuple('PSLayout',
+                      ['scheduler_host', 'server_hosts', 'worker_hosts', 'servers_per_host'])
+
+# Which logical CPUs the parameter server roles and the workers on this host are pinned to.
+CPULayout = namedtuple('CPULayout', ['ps_cpus', 'worker_cpus'])
+
+# host name -> IP address, filled in once per job by _verify_hosts
+_host_ips = {}
 
-def _env_vars_for_role(role, hosts, ps_port, ps_verbose):
+
+def _env_vars_for_role(role, layout, ps_port, ps_verbose, kvstore_env_vars=None):
     if role in ROLES:
-        return {
-            'DMLC_NUM_WORKER': str(len(hosts)),
-            'DMLC_NUM_SERVER': str(len(hosts)),
+        env_vars = {
+            'DMLC_NUM_WORKER': str(len(layout.worker_hosts)),
+            'DMLC_NUM_SERVER': str(len(layout.server_hosts) * layout.servers_per_host),
             'DMLC_ROLE': role,
-            'DMLC_PS_ROOT_URI': _host_lookup(scheduler_host(hosts)),
+            'DMLC_PS_ROOT_URI': _host_lookup(layout.scheduler_host),
             'DMLC_PS_ROOT_PORT': ps_port,
             'PS_VERBOSE': ps_verbose,
         }
+        # every role of the job must agree on how the kvstore splits its arrays
+        env_vars.update(kvstore_env_vars or {})
+        return env_vars
 
     raise ValueError('Unexpected role: {}'.format(role))
 
 
-def _run_mxnet_process(role, hosts, ps_port, ps_verbose):
+def _kvstore_env_vars(env):
+    """Return the kvstore settings from the hyperparameters, for every parameter server role.
+
+    Without the '_kvstore_bigarray_bound' hyperparameter, ``training_utils.create_kvstore``
+    picks the bound in the workers from the sizes of the parameters.
+    """
+    bound = env.hyperparameters.get('_kvstore_bigarray_bound')
+    if bound is None:
+        return {}
+    return {training_utils.KVSTORE_BIGARRAY_BOUND_ENV: str(int(bound))}
+
+
+def _run_mxnet_process(role, layout, ps_port, ps_verbose, port=None, zygote=None, cpus=None,
+                       thread_env_vars=None, kvstore_env_vars=None):
     role_env = os.environ.copy()
-    role_env.update(_env_vars_for_role(role, hosts, ps_port, ps_verbose))
-    subprocess.Popen("python -c 'import mxnet'", shell=True, env=role_env).pid
+    role_env.update(thread_env_vars or {})
+    role_env.update(_env_vars_for_role(role, layout, ps_port, ps_verbose, kvstore_env_vars))
+    if port is not None:
+        # ps-lite binds each node to the port in PORT, or to a random free port if unset
+        role_env['PORT'] = str(port)
+
+    if zygote:
+        return zygote.spawn(role, role_env, cpus)
+
+    popen_kwargs = {}
+    if cpus:
+        # pinned in the child before exec, so that every thread of the role inherits the affinity
+        popen_kwargs['preexec_fn'] = functools.partial(os.sched_setaffinity, 0, cpus)
+    start = time.time()
+    process = subprocess.Popen([sys.executable, '-c', 'import mxnet'], env=role_env,
+                               **popen_kwargs)
+    logger.info('Started {} (pid {}) in {:.3f}s'.format(role, process.pid, time.time() - start))
+    return process
+
+
+def _start_zygote(env=None):
+    zygote = Zygote(env=env)
+    try:
+        zygote.start()
+    except ZygoteError as e:
+        logger.warning('{}, starting each role in its own interpreter instead'.format(e))
+        return None
+    return zygote
+
+
+class _RoleSupervisor(object):
+    """Keep track of the parameter server roles started on this host.
+
+    A background thread polls the exit code and memory use of every role. If a role dies,
+    the worker processes are terminated so that the entry point fails right away instead of
+    blocking in ``dist_sync`` until the job times out.
+    """
+
+    def __init__(self, poll_interval=None):
+        self.roles = []
+        self.failure = None
+        self.terminating = False
+        self._poll_interval = poll_interval or ROLE_POLL_INTERVAL_SECONDS
+        self._done = threading.Event()
+        self._peak_rss = {}
+        self._thread = threading.Thread(target=self._watch)
+        self._thread.daemon = True
+
+    def add(self, role, process):
+        self.roles.append((role, process))
+
+    def start(self):
+        if self.roles:
+            self._thread.start()
+
+    def wait(self):
+        """Block until every role has exited or one of them failed."""
+        if self.roles:
+            self._done.wait()
+        self.raise_for_failure()
+
+    def raise_for_failure(self):
+        if self.failure:
+            raise RuntimeError(self.failure)
+
+    def stop(self, graceful=True):
+        """Tear the roles down within ``ROLE_SHUTDOWN_TIMEOUT_SECONDS``.
+
+        After the workers finished cleanly, the roles are left to exit on their own, in the
+        reverse order they were started: servers, then scheduler. When the workers or a role
+        failed, or once the time is up, every remaining role is terminated at once.
+        """
+        self._done.set()
+        deadline = time.time() + ROLE_SHUTDOWN_TIMEOUT_SECONDS
+        if graceful and not self.failure and not self.terminating:
+            for _, process in reversed(self.roles):
+                _wait_until(process, deadline)
+
+        running = [(role, process) for role, process in self.roles if process.poll() is None]
+        for role, process in reversed(running):
+            logger.warning('Terminating {} (pid {})'.format(role, process.pid))
+            process.terminate()
+        deadline = time.time() + ROLE_SHUTDOWN_TIMEOUT_SECONDS
+        for _, process in reversed(running):
+            if not _wait_until(process, deadline):
+                process.kill()
+
+    def _watch(self):
+        while not self._done.wait(self._poll_interval):
+            self._poll()
+
+    def _poll(self):
+        running = False
+        for role, process in self.roles:
+            returncode = process.poll()
+            if returncode is None:
+                running = True
+                self._record_memory(process.pid)
+            elif returncode != 0 and not self.terminating:
+                self._fail(role, process.pid, returncode)
+                return
+
+        if not running:
+            self._done.set()
+
+    def _record_memory(self, pid):
+        try:
+            rss = psutil.Process(pid).memory_info().rss
+        except psutil.Error:
+            return
+        self._peak_rss[pid] = max(rss, self._peak_rss.get(pid, 0))
+
+    def _fail(self, role, pid, returncode):
+        if returncode < 0:
+            reason = 'was killed by signal {}'.format(-returncode)
+        else:
+            reason = 'exited with code {}'.format(returncode)
+        self.failure = 'Parameter server {} (pid {}) {}, peak resident memory {} MB'.format(
+            role, pid, reason, self._peak_rss.get(pid, 0) // 2 ** 20)
+        logger.error(self.failure)
+
+        self._terminate_workers()
+        self._done.set()
+
+    def pids(self):
+        """Return the role of every process on this host, keyed by pid.
+
+        The processes that a role started belong to that role, and every other process that
+        this launcher started is a worker. Under MPI, the workers on this host were started
+        by the orted daemon instead.
+        """
+        pids = {process.pid: role for role, process in self.roles}
+        for role, process in self.roles:
+            for child in _children(process.pid):
+                pids.setdefault(child.pid, role)
+
+        workers = _children(os.getpid())
+        for daemon in psutil.process_iter(['name']):
+            if daemon.info['name'] == 'orted':
+                workers.extend(_children(daemon.pid))
+        for worker in workers:
+            pids.setdefault(worker.pid, 'worker')
+        return pids
+
+    def terminate(self, signum, grace_seconds):
+        """Forward a signal to the workers on this host, then to the roles once the workers exit.
+
+        The workers get ``grace_seconds`` to save their state and exit. From then on, a role
+        that exits does not count as a failure.
+        """
+        self.terminating = True
+        workers = self._workers()
+        for worker in workers:
+            logger.info('Forwarding signal {} to worker process {}'.format(signum, worker.pid))
+            try:
+                worker.send_signal(signum)
+            except psutil.Error:
+                pass
+        psutil.wait_procs(workers, timeout=grace_seconds)
+
+        for role, process in reversed(self.roles):
+            if role != 'zygote' and process.poll() is None:
+                process.send_signal(signum)
+
+    def _workers(self):
+        role_pids = {process.pid for _, process in self.roles}
+        launchers = [psutil.Process()]
+        launchers.extend(daemon for daemon in psutil.process_iter(['name'])
+                         if daemon.info['name'] == 'orted')
+
+        workers = []
+        for launcher in launchers:
+            for child in _children(launcher.pid, recursive=False):
+                if child.pid in role_pids:
+                    continue
+                name = _process_name(child)
+                if name != 'mpirun':
+                    if name is not None:
+                        workers.append(child)
+                    continue
+                # mpirun kills every rank shortly after a SIGTERM, so signal its ranks instead.
+                # Its other children are the ssh clients of the remote orted daemons, and mpirun
+                # aborts the job when one of them exits.
+                workers.extend(rank for rank in _children(child.pid, recursive=False)
+                               if _process_name(rank) not in MPI_LAUNCH_PROCESSES + (None,))
+        return workers
+
+    def _terminate_workers(self):
+        role_pids = set()
+        for _, process in self.roles:
+            role_pids.add(process.pid)
+            role_pids.update(child.pid for child in _children(process.pid))
+
+        workers = [child for child in psutil.Process().children(recursive=True)
+                   if child.pid not in role_pids]
+        for worker in workers:
+            logger.error('Terminating worker process {}'.format(worker.pid))
+            try:
+                worker.terminate()
+            except psutil.Error:
+                pass
+        _, alive = psutil.wait_procs(workers, timeout=ROLE_SHUTDOWN_TIMEOUT_SECONDS)
+        for worker in alive:
+            worker.kill()
+
+
+def _wait_until(process, deadline):
+    try:
+        process.wait(timeout=max(deadline - time.time(), 0))
+    except subprocess.TimeoutExpired:
+        return False
+    return True
+
+
+def _process_name(process):
+    try:
+        return process.name()
+    except psutil.Error:
+        return None
+
+
+def _children(pid, recursive=True):
+    try:
+        return psutil.Process(pid).children(recursive=recursive)
+    except psutil.Error:
+        return []
+
+
+def _termination_grace_seconds(env):
+    return float(env.hyperparameters.get('_termination_grace_seconds',
+                                         training_utils.DEFAULT_TERMINATION_GRACE_SECONDS))
+
+
+def _forward_termination(supervisor, grace_seconds):
+    """Forward SIGTERM to the processes of this host, and return the previous handler.
+
+    SageMaker sends SIGTERM when the job is stopped or a spot instance is reclaimed. The
+    signal is forwarded on another thread, so that the launcher keeps waiting for the workers.
+    """
+
+    def handle(signum, _):
+        logger.info('Received signal {}, giving the workers {}s to save and exit'.format(
+            signum, grace_seconds))
+        forwarder = threading.Thread(target=supervisor.terminate, args=(signum, grace_seconds))
+        forwarder.daemon = True
+        forwarder.start()
+
+    return signal.signal(signal.SIGTERM, handle)
+
+
+def _start_telemetry(env, supervisor):
+    """Start sampling the resource use of every role on this host, unless '_telemetry' is off."""
+    if str(env.hyperparameters.get('_telemetry', True)) == 'False':
+        return None
+
+    output_path = os.path.join(env.output_data_dir, 'telemetry-{}.csv'.format(env.current_host))
+    sampler = telemetry.Sampler(supervisor.pids, output_path,
+                                float(env.hyperparameters.get('_telemetry_interval',
+                                                              telemetry.SAMPLE_INTERVAL_SECONDS)))
+    sampler.start()
+    return sampler
+
+
+class _LaunchTimer(object):
+    """Time the phases of the launch on this host and log each one as it finishes.
+
+    The clock starts when the launcher process was created, so the first phase ('startup')
+    covers the interpreter startup, the imports and reading the training environment.
+    """
+
+    def __init__(self):
+        self.start = psutil.Process().create_time()
+        self.timings = {}
+        self.record('startup', time.time() - self.start)
+
+    def record(self, phase, seconds):
+        self.timings[phase] = seconds
+        for line in training_utils.launch_timing_lines(phase, seconds):
+            logger.info(line)
+
+    @contextmanager
+    def phase(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.record(name, time.time() - start)
+
+    def env_vars(self):
+        """Return the variables that let the entry point report its time to the first step."""
+        now = time.time()
+        self.record('launcher', now - self.start)
+        return {training_utils.LAUNCH_START_ENV: repr(self.start),
+                training_utils.ENTRY_POINT_START_ENV: repr(now)}
+
+
+def _resolve_host(host, deadline):
+    remaining_ms = max(0, int((deadline - time.time()) * 1000))
+    lookup = retry(stop_max_delay=remaining_ms, wait_exponential_multiplier=100,
+                   wait_exponential_max=30000)(socket.gethostbyname)
+    return lookup(host)
 
 
-@retry(stop_max_delay=1000 * 60 * 15, wait_exponential_multiplier=100,
-       wait_exponential_max=30000)
 def _host_lookup(host):
-    return socket.gethostbyname(host)
+    if host not in _host_ips:
+        _host_ips[host] = _resolve_host(host, time.time() + HOST_LOOKUP_TIMEOUT_SECONDS)
+    return _host_ips[host]
 
 
 def _verify_hosts(hosts):
-    for host in hosts:
-        _host_lookup(host)
+    """Resolve every host concurrently under a single job-wide deadline.
+
+    The results are cached so that later lookups through ``_host_lookup`` are free.
+    """
+    deadline = time.time() + HOST_LOOKUP_TIMEOUT_SECONDS
+    pending = [host for host in hosts if host not in _host_ips]
+
+    def resolve(host):
+        start = time.time()
+        ip = _resolve_host(host, deadline)
+        logger.info('Resolved {} to {} in {:.3f}s'.format(host, ip, time.time() - start))
+        return ip
+
+    if pending:
+        with ThreadPoolExecutor(max_workers=min(len(pending), MAX_HOST_LOOKUP_THREADS)) as pool:
+            _host_ips.update(zip(pending, pool.map(resolve, pending)))
+
+    return {host: _host_ips[host] for host in hosts}
+
+
+def _servers_per_host(env):
+    """Return the number of parameter server processes to start on each host.
+
+    MXNet shards the kvstore keys across all server processes, so running more than one
+    server per host spreads push/pull handling over more cores.
+    """
+    servers_per_host = env.hyperparameters.get('_ps_servers_per_host', 1)
+    if str(servers_per_host) == 'auto':
+        return max(1, env.num_cpus // CPUS_PER_AUTO_SERVER)
+    return int(servers_per_host)
+
+
+def _ps_layout(env):
+    """Split the hosts into scheduler, server and worker groups.
+
+    With '_ps_num_server_hosts' set, the first hosts (after the scheduler host, if
+    '_ps_dedicated_scheduler' is set) only run servers and the remaining hosts only run
+    workers. Otherwise every host that is not a dedicated scheduler runs both.
+    """
+    hosts = env.hosts
+    scheduler = scheduler_host(hosts)
+
+    dedicated_scheduler = str(env.hyperparameters.get('_ps_dedicated_scheduler', False)) == 'True'
+    candidates = hosts[1:] if dedicated_scheduler else hosts
+
+    num_server_hosts = int(env.hyperparameters.get('_ps_num_server_hosts', 0))
+    if num_server_hosts:
+        server_hosts, worker_hosts = candidates[:num_server_hosts], candidates[num_server_hosts:]
+    else:
+        server_hosts = worker_hosts = candidates
+
+    if not server_hosts or not worker_hosts:
+        raise ValueError('Cannot split {} hosts into {} server host(s) and at least one worker '
+                         'host'.format(len(hosts), num_server_hosts))
+
+    return PSLayout(scheduler, list(server_hosts), list(worker_hosts), _servers_per_host(env))
+
+
+def _num_ps_roles(layout, host):
+    """Return how many parameter server roles run on a host."""
+    return ((host == layout.scheduler_host)
+            + (host in layout.server_hosts) * layout.servers_per_host)
+
+
+def _ps_roles(env, layout, ps_port):
+    """Return the (role, port) pairs of the parameter server roles that run on this host."""
+    roles = []
+    if env.current_host == layout.scheduler_host:
+        roles.append(('scheduler', None))
+    if env.current_host in layout.server_hosts:
+        for server_index in range(layout.servers_per_host):
+            port = int(ps_port) + 1 + server_index if layout.servers_per_host > 1 else None
+            roles.append(('server', port))
+    return roles
+
+
+def _parse_cpu_list(cpu_list):
+    cpus = set()
+    for part in cpu_list.strip().split(','):
+        if part:
+            first, _, last = part.partition('-')
+            cpus.update(range(int(first), int(last or first) + 1))
+    return cpus
+
+
+def _format_cpu_list(cpus):
+    ranges = []
+    for cpu in sorted(cpus):
+        if ranges and ranges[-1][1] == cpu - 1:
+            ranges[-1][1] = cpu
+        else:
+            ranges.append([cpu, cpu])
+    return ','.join(str(first) if first == last else '{}-{}'.format(first, last)
+                    for first, last in ranges)
+
+
+def _read_cpu_list(path):
+    try:
+        with open(path) as f:
+            return _parse_cpu_list(f.read())
+    except (IOError, ValueError):
+        return None
+
+
+def _cpu_topology():
+    """Return the physical cores this process may run on, grouped by NUMA node.
+
+    Every core is the sorted list of its logical CPUs (hyperthreads). Without topology
+    information in sysfs, every logical CPU is its own core on a single node.
+    """
+    available = os.sched_getaffinity(0)
+
+    node_paths = glob.glob(os.path.join(CPU_TOPOLOGY_PATH, 'node', 'node[0-9]*', 'cpulist'))
+    node_paths.sort(key=lambda path: int(os.path.basename(os.path.dirname(path))[4:]))
+    nodes = [_read_cpu_list(path) or set() for path in node_paths] or [available]
+
+    topology = []
+    for node in nodes:
+        cores = []
+        for cpu in sorted(node & available):
+            siblings = _read_cpu_list(os.path.join(
+                CPU_TOPOLOGY_PATH, 'cpu', 'cpu{}'.format(cpu), 'topology', 'thread_siblings_list'))
+            core = sorted((siblings or {cpu}) & available)
+            if core not in cores:
+                cores.append(core)
+        if cores:
+            topology.append(cores)
+    return topology
+
+
+def _num_reserved_cores(env, layout, host, num_ps_roles, num_cores):
+    """Return how many of the ``num_cores`` physical cores of a host its roles are pinned to."""
+    if not num_ps_roles:
+        return 0
+    if layout is not None and host not in layout.worker_hosts:
+        return num_cores
+
+    num_reserved = env.hyperparameters.get('_ps_reserved_cores', 'auto')
+    if str(num_reserved) == 'auto':
+        num_servers = num_ps_roles - (host == layout.scheduler_host)
+        num_reserved = num_servers * CORES_PER_RESERVED_SERVER + num_ps_roles - num_servers
+    # the workers always keep at least one core
+    return max(0, min(int(num_reserved), num_cores - 1))
+
+
+def _cpu_layout(env, layout, num_ps_roles):
+    """Split this host's cores between its parameter server roles and its workers.
+
+    Returns None unless the '_cpu_affinity' hyperparameter is set. The cores reserved for the
+    roles ('_ps_reserved_cores', by default two per server and one for the scheduler) are the
+    last physical cores of the last NUMA nodes, so that the workers keep whole nodes and whole
+    cores for their compute threads.
+    """
+    if str(env.hyperparameters.get('_cpu_affinity', False)) != 'True':
+        return None
+
+    cores = [core for node in _cpu_topology() for core in node]
+    split = len(cores) - _num_reserved_cores(env, layout, env.current_host, num_ps_roles,
+                                             len(cores))
+    cpu_layout = CPULayout(sorted(cpu for core in cores[split:] for cpu in core),
+                           sorted(cpu for core in cores[:split] for cpu in core))
+    logger.info('CPU layout on {}: parameter server roles on CPUs [{}], workers on CPUs [{}]'
+                .format(env.current_host, _format_cpu_list(cpu_layout.ps_cpus),
+                        _format_cpu_list(cpu_layout.worker_cpus)))
+    return cpu_layout
+
+
+def _mpi_binding_options(env, layout, cpu_layout):
+    """Return mpirun options that bind the workers the way ``_cpu_layout`` planned.
+
+    They are appended to the custom MPI options, after the ``-bind-to none -map-by slot``
+    defaults of sagemaker-training, which they override. mpirun applies them on every host, so
+    when cores are reserved for the parameter server roles, each worker is bound to a share of
+    the first cores that no host reserves, rather than to this host's set of worker CPUs. The
+    hosts of a job are of the same instance type, and so have the same topology as this one.
+    """
+    options = ['-map-by', 'numa', '-bind-to', 'numa']
+    if cpu_layout.ps_cpus:
+        num_cores = len([core for node in _cpu_topology() for core in node])
+        worker_cores = min(
+            num_cores - _num_reserved_cores(env, layout, host, _num_ps_roles(layout, host),
+                                            num_cores)
+            for host in layout.worker_hosts)
+        num_workers = _num_workers(env, layout)
+        if worker_cores < num_workers:
+            logger.warning('Not binding {} workers per host to {} cores'
+                           .format(num_workers, worker_cores))
+            options = []
+        else:
+            options = ['-map-by', 'ppr:{}:node:PE={}'.format(num_workers,
+                                                             worker_cores // num_workers),
+                       '-bind-to', 'core']
+    custom_options = env.additional_framework_parameters.get(params.MPI_CUSTOM_OPTIONS, '')
+    return {params.MPI_CUSTOM_OPTIONS: ' '.join([custom_options] + options).strip()}
+
+
+def _num_workers(env, layout):
+    """Return the number of worker processes that will run on this host."""
+    if layout is not None and env.current_host not in layout.worker_hosts:
+        return 0
+    if env.additional_framework_parameters.get(LAUNCH_MPI_ENV_NAME):
+        # the default of sagemaker-training: one process per GPU, or a single one on CPU
+        return int(env.additional_framework_parameters.get(params.MPI_PROCESSES_PER_HOST,
+                                                           int(env.num_gpus) or 1))
+    return 1
+
+
+def _thread_budget(omp_threads, engine_threads):
+    return {
+        'OMP_NUM_THREADS': str(omp_threads),
+        'MKL_NUM_THREADS': str(omp_threads),
+        'MXNET_CPU_WORKER_NTHREADS': str(engine_threads),
+    }
+
+
+def _thread_env_vars(env, layout, roles, cpu_layout):
+    """Split this host's CPUs between the threads of the processes started on it.
+
+    Left alone, OpenMP and MKL start one thread per CPU in every process, which oversubscribes
+    a host that runs several workers or a worker next to servers. The workers share the CPUs
+    not set aside for the parameter server roles, as in ``_cpu_layout``, and run their
+    operators on a single engine thread that parallelizes over OpenMP. A server aggregates
+    many small keys at once, so it gets its CPUs as engine threads instead. Variables already
+    set in the environment are kept, and the '_omp_num_threads', '_mkl_num_threads' and
+    '_mxnet_cpu_worker_nthreads' hyperparameters override the workers' budget.
+
+    Returns:
+        dict[str, dict[str, str]]: the thread environment variables of the 'worker', 'server'
+            and 'scheduler' processes
+    """
+    num_workers = _num_workers(env, layout)
+    num_servers = sum(1 for role, _ in roles if role == 'server')
+    num_schedulers = len(roles) - num_servers
+
+    if cpu_layout:
+        ps_cpus, worker_cpus = len(cpu_layout.ps_cpus), len(cpu_layout.worker_cpus)
+    else:
+        num_cpus = int(env.num_cpus)
+        ps_cpus = num_servers * CORES_PER_RESERVED_SERVER + num_schedulers
+        ps_cpus = min(ps_cpus, num_cpus - 1) if num_workers else num_cpus
+        worker_cpus = num_cpus - ps_cpus
+
+    budgets = {
+        'worker': _thread_budget(max(1, worker_cpus // max(num_workers, 1)), 1),
+        'server': _thread_budget(1, max(1, (ps_cpus - num_schedulers) // max(num_servers, 1))),
+        'scheduler': _thread_budget(1, 1),
+    }
+    for budget in budgets.values():
+        for name in list(budget):
+            if name in os.environ:
+                budget[name] = os.environ[name]
+    for name in THREAD_ENV_VARS:
+        value = env.hyperparameters.get('_{}'.format(name.lower()))
+        if value is not None:
+            budgets['worker'][name] = str(value)
+
+    logger.info('Thread budgets on {}: {} worker(s) with {}, {} server(s) with {}, {} '
+                'scheduler(s) with {}'.format(env.current_host, num_workers, budgets['worker'],
+                                              num_servers, budgets['server'], num_schedulers,
+                                              budgets['scheduler']))
+    return budgets
+
+
+def _start_ps_roles(env, layout, ps_port, ps_verbose, supervisor, cpus=None,
+                    thread_env_vars=None):
+    roles = _ps_roles(env, layout, ps_port)
+    if not roles:
+        return
+
+    # MXNet is imported once in a zygote, which then forks the roles on this host. OpenMP and
+    # MKL read their thread counts when MXNet loads them, so the roles of every thread budget
+    # are forked from a zygote started with that budget.
+    thread_env_vars = thread_env_vars or {}
+    budgets = {role: tuple(sorted(thread_env_vars.get(role, {}).items())) for role, _ in roles}
+    distinct_budgets = sorted(set(budgets.values()))
+    with ThreadPoolExecutor(max_workers=len(distinct_budgets)) as pool:
+        zygotes = dict(zip(distinct_budgets,
+                           pool.map(lambda budget: _start_zygote(dict(budget)), distinct_budgets)))
+    for zygote in zygotes.values():
+        if zygote:
+            supervisor.add('zygote', zygote.process)
+
+    kvstore_env_vars = _kvstore_env_vars(env)
+    for role, port in roles:
+        supervisor.add(role, _run_mxnet_process(role, layout, ps_port, ps_verbose, port,
+                                                zygotes[budgets[role]], cpus,
+                                                thread_env_vars.get(role), kvstore_env_vars))
+    for zygote in zygotes.values():
+        if zygote:
+            zygote.close()
+    supervisor.start()
+
+
+def _read_autotune_cache(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+
+def _write_autotune_cache(path, cache):
+    directory = os.path.dirname(path)
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory)
+
+    def write(tmp_path):
+        with open(tmp_path, 'w') as f:
+            json.dump(cache, f, indent=2, sort_keys=True)
+
+    training_utils.atomic_write(path, write)
+
+
+def _autotune_cache(env):
+    """Return the path of the Horovod settings cache and this job's key in it."""
+    model_mb = float(env.hyperparameters.get('_horovod_autotune_model_mb',
+                                             DEFAULT_AUTOTUNE_MODEL_MB))
+    key = 'hosts-{}-processes-{}-model-{:g}mb'.format(
+        len(env.hosts), _num_workers(env, None), model_mb)
+    checkpoint_dir = env.hyperparameters.get('_checkpoint_dir', DEFAULT_CHECKPOINT_DIR)
+    cache_path = env.hyperparameters.get('_horovod_autotune_cache',
+                                         os.path.join(checkpoint_dir, HOROVOD_AUTOTUNE_CACHE))
+    return cache_path, key
+
+
+def _horovod_env_vars(env):
+    """Return the tuned Horovod settings for this job, or turn on Horovod's autotuner.
+
+    With the '_horovod_autotune' hyperparameter set, the master host looks up the fusion
+    threshold and cycle time for the job's host count, processes per host and model size
+    ('_horovod_autotune_model_mb') in a cache file in the checkpoint directory, so that later
+    jobs with a checkpoint location reuse it. On a cache miss, the job itself runs with
+    Horovod's autotuner on, and ``_record_horovod_autotune`` caches the settings it found best
+    once the entry point returns. mpirun passes the settings on to the workers on every host.
+    """
+    if str(env.hyperparameters.get('_horovod_autotune', False)) != 'True' or not env.is_master:
+        return {}
+
+    cache_path, key = _autotune_cache(env)
+    cache = _read_autotune_cache(cache_path)
+    if key in cache:
+        logger.info('Horovod settings for {}: {}'.format(key, cache[key]['env']))
+        return cache[key]['env']
+
+    # Horovod's autotuner logs its samples on rank 0, which mpirun starts on the master
+    autotune_log = os.path.join(tempfile.gettempdir(), HOROVOD_AUTOTUNE_LOG)
+    if os.path.exists(autotune_log):
+        os.remove(autotune_log)
+    logger.info('No Horovod settings cached for {}, running with Horovod autotune'.format(key))
+    return {'HOROVOD_AUTOTUNE': '1', 'HOROVOD_AUTOTUNE_LOG': autotune_log}
+
+
+def _record_horovod_autotune(env, env_vars):
+    """Cache the best settings that Horovod's autotuner logged during the job, if it ran."""
+    autotune_log = env_vars.get('HOROVOD_AUTOTUNE_LOG')
+    if not autotune_log:
+        return
+
+    settings = horovod_autotune.read_autotune_log(autotune_log)
+    if not settings:
+        logger.warning('Horovod autotune logged no samples, no settings to cache')
+        return
+
+    cache_path, key = _autotune_cache(env)
+    cache = _read_autotune_cache(cache_path)
+    cache[key] = {'env': settings}
+    _write_autotune_cache(cache_path, cache)
+    logger.info('Cached Horovod settings for {}: {}'.format(key, settings))
+
+
+def _init_process_runner(process_runner, user_entry_point, args, env_vars, processes_per_host):
+    try:
+        ProcessRunner.__init__(process_runner, user_entry_point, args, env_vars,
+                               processes_per_host)
+    except TypeError:
+        # before sagemaker-training 4.0, which still supports Python 3.6
+        ProcessRunner.__init__(process_runner, user_entry_point, args, env_vars)
+
+
+class _ElasticRunner(ProcessRunner):
+    """Run the entry point under ``horovodrun`` on the master host."""
+
+    def __init__(self, horovodrun_command, user_entry_point, args, env_vars, processes_per_host):
+        _init_process_runner(self, user_entry_point, args, env_vars, processes_per_host)
+        self._horovodrun_command = horovodrun_command
+
+    def _setup(self):
+        mpi._start_sshd_daemon()
+
+    def _create_command(self):
+        return self._horovodrun_command + super(_ElasticRunner, self)._create_command()
+
+
+class _ElasticWorkerRunner(ProcessRunner):
+    """Serve SSH to the elastic driver on a host other than the master, until the master is gone.
+
+    Unlike mpirun, the elastic driver starts the workers over SSH without an orted daemon, so
+    there is no process to wait for on this host.
+    """
+
+    def __init__(self, master_hostname, user_entry_point, args, env_vars, processes_per_host,
+                 poll_interval=None):
+        _init_process_runner(self, user_entry_point, args, env_vars, processes_per_host)
+        self._master_hostname = master_hostname
+        self._poll_interval = poll_interval or ELASTIC_MASTER_POLL_INTERVAL_SECONDS
+
+    def run(self, wait=True, capture_error=False):
+        # the workers started over SSH read their environment from /etc/environment, as under
+        # mpirun
+        mpi._write_env_vars_to_file()
+        mpi._start_sshd_daemon()
+        if not wait:
+            return None
+
+        while not horovod_elastic.can_connect(self._master_hostname):
+            time.sleep(self._poll_interval)
+        logger.info('Serving the elastic driver on {}'.format(self._master_hostname))
+        while horovod_elastic.can_connect(self._master_hostname):
+            time.sleep(self._poll_interval)
+        logger.info('{} is gone, the elastic job is over'.format(self._master_hostname))
+        return None
+
+
+def _horovod_elastic_runner(env, env_vars):
+    """Return the runner that starts the entry point under Horovod's elastic driver.
+
+    With the '_horovod_elastic' hyperparameter set, the master host runs ``horovodrun`` with a
+    host discovery script that lists the hosts of the job whose SSH daemon is up. The driver
+    starts as soon as '_horovod_elastic_min_hosts' (default: 1) hosts are up, widens the job as
+    more hosts come up and narrows it when hosts go away. The entry point should commit its
+    state through ``training_utils.elastic_state`` to carry on across those changes.
+    """
+    processes_per_host = _num_workers(env, None)
+    if not env.is_master:
+        return _ElasticWorkerRunner(env.master_hostname, env.user_entry_point,
+                                    env.to_cmd_args(), env_vars, processes_per_host)
+
+    min_hosts = int(env.hyperparameters.get('_horovod_elastic_min_hosts', 1))
+    if not 1 <= min_hosts <= len(env.hosts):
+        raise ValueError('_horovod_elastic_min_hosts must be between 1 and {}, got {}'.format(
+            len(env.hosts), min_hosts))
+
+    script = horovod_elastic.write_discovery_script(
+        os.path.join(tempfile.mkdtemp(), 'discover_hosts.sh'), env.hosts, processes_per_host)
+    command = ['horovodrun',
+               '--num-proc', str(min_hosts * processes_per_host),
+               '--min-np', str(min_hosts * processes_per_host),
+               '--max-np', str(len(env.hosts) * processes_per_host),
+               '--host-discovery-script', script,
+               '--network-interface', env.network_interface_name]
+    logger.info('Starting elastic Horovod training on {} to {} hosts'.format(
+        min_hosts, len(env.hosts)))
+    return _ElasticRunner(command, env.user_entry_point, env.to_cmd_args(), env_vars,
+                          processes_per_host)
+
+
+def _profiler_env_vars(env):
+    """Return the variables that configure ``training_utils.profiler_callback`` in the workers.
+
+    The profiler stays off unless the '_profile_start_step' hyperparameter is set.
+    """
+    start_step = env.hyperparameters.get('_profile_start_step')
+    if start_step is None:
+        return {}
+
+    start_step = int(start_step)
+    if start_step < 0:
+        raise ValueError('_profile_start_step must not be negative, got {}'.format(start_step))
+
+    mode = env.hyperparameters.get('_profile_mode', 'all')
+    if mode not in training_utils.PROFILE_MODES:
+        raise ValueError('_profile_mode must be one of {}, got {}'.format(
+            sorted(training_utils.PROFILE_MODES), mode))
+
+    num_steps = int(env.hyperparameters.get('_profile_num_steps', DEFAULT_PROFILE_NUM_STEPS))
+    if num_steps <= 0:
+        # the profiler would never stop, and never write its results
+        raise ValueError('_profile_num_steps must be positive, got {}'.format(num_steps))
+
+    output_dir = os.path.join(env.output_data_dir, 'profile')
+    logger.info('Profiling {} step(s) from step {} in {} mode to {}'.format(
+        num_steps, start_step, mode, output_dir))
+    return {training_utils.PROFILE_START_STEP_ENV: str(start_step),
+            training_utils.PROFILE_NUM_STEPS_ENV: str(num_steps),
+            training_utils.PROFILE_MODE_ENV: mode,
+            training_utils.PROFILE_DIR_ENV: output_dir}
+
+
+def _resume_env_vars(env):
+    checkpoint_dir = env.hyperparameters.get('_checkpoint_dir', DEFAULT_CHECKPOINT_DIR)
+    checkpoint = training_utils.find_latest_checkpoint(checkpoint_dir)
+    if not checkpoint:
+        return {}
+
+    prefix, epoch = checkpoint
+    logger.info('Resuming from checkpoint {} at epoch {}'.format(prefix, epoch))
+    return {training_utils.CHECKPOINT_PREFIX_ENV: prefix,
+            training_utils.CHECKPOINT_EPOCH_ENV: str(epoch)}
 
 
 def train(env):
+    timer = _LaunchTimer()
     logger.info('MXNet training environment: {}'.format(env.to_env_vars()))
+    env_vars = env.to_env_vars()
+    # checked before any role starts, so that a bad setting fails the job right away
+    env_vars.update(_profiler_env_vars(env))
+    supervisor = _RoleSupervisor()
+    ps_enabled = env.additional_framework_parameters.get(LAUNCH_PS_ENV_NAME, False)
+    mpi_enabled = env.additional_framework_parameters.get(LAUNCH_MPI_ENV_NAME)
 
-    if env.additional_framework_parameters.get(LAUNCH_PS_ENV_NAME, False):
-        _verify_hosts(env.hosts)
+    layout = None
+    roles = []
+    if ps_enabled:
+        with timer.phase('verify_hosts'):
+            _verify_hosts(env.hosts)
 
         ps_port = env.hyperparameters.get('_ps_port', '8000')
         ps_verbose = env.hyperparameters.get('_ps_verbose', '0')
+        layout = _ps_layout(env)
+        roles = _ps_roles(env, layout, ps_port)
 
-        logger.info('Starting distributed training task')
-        if scheduler_host(env.hosts) == env.current_host:
-            _run_mxnet_process('scheduler', env.hosts, ps_port, ps_verbose)
-        _run_mxnet_process('server', env.hosts, ps_port, ps_verbose)
-        os.environ.update(_env_vars_for_role('worker', env.hosts, ps_port, ps_verbose))
+    cpu_layout = _cpu_layout(env, layout, len(roles))
+    thread_env_vars = _thread_env_vars(env, layout, roles, cpu_layout)
+    sampler = _start_telemetry(env, supervisor)
+    grace_seconds = _termination_grace_seconds(env)
+    env_vars[training_utils.TERMINATION_GRACE_ENV] = str(grace_seconds)
+    previous_handler = _forward_termination(supervisor, grace_seconds)
 
-    mpi_enabled = env.additional_framework_parameters.get(LAUNCH_MPI_ENV_NAME)
+    succeeded = False
+    try:
+        if ps_enabled:
+            logger.info('Starting distributed training task with {}'.format(layout))
+            with timer.phase('ps_roles'):
+                _start_ps_roles(env, layout, ps_port, ps_verbose, supervisor,
+                                cpu_layout.ps_cpus if cpu_layout else None, thread_env_vars)
 
-    if mpi_enabled:
-        runner_type = runner.MPIRunnerType
-    else:
-        runner_type = runner.ProcessRunnerType
+            if env.current_host not in layout.worker_hosts:
+                logger.info('{} runs no worker, waiting for its parameter server roles to finish'
+                            .format(env.current_host))
+                supervisor.wait()
+                succeeded = True
+                return
+
+            os.environ.update(_env_vars_for_role('worker', layout, ps_port, ps_verbose,
+                                                 _kvstore_env_vars(env)))
+            if layout.worker_hosts != env.hosts:
+                # the entry point should only shard data and save the model among the workers
+                env_vars['SM_HOSTS'] = json.dumps(layout.worker_hosts)
+
+        env_vars.update(_resume_env_vars(env))
+        env_vars.update(thread_env_vars['worker'])
+
+        run_kwargs = {}
+        elastic = (mpi_enabled
+                   and str(env.hyperparameters.get('_horovod_elastic', False)) == 'True')
+        if mpi_enabled:
+            runner_type = runner.MPIRunnerType
+            if cpu_layout and not elastic:
+                # mpirun starts the workers on every host, outside of this process
+                run_kwargs['extra_opts'] = _mpi_binding_options(env, layout, cpu_layout)
+            env_vars.update(_horovod_env_vars(env))
+        else:
+            runner_type = runner.ProcessRunnerType
+            if cpu_layout:
+                # the workers inherit the affinity of this process
+                os.sched_setaffinity(0, cpu_layout.worker_cpus)
 
-    entry_point.run(uri=env.module_dir,
-                    user_entry_point=env.user_entry_point,
-                    args=env.to_cmd_args(),
-                    env_vars=env.to_env_vars(),
-                    runner_type=runner_type)
+        env_vars.update(timer.env_vars())
+        if elastic:
+            # horovodrun starts the workers on the live hosts instead of mpirun on every host
+            runner_type = _horovod_elastic_runner(env, env_vars)
+        entry_point.run(uri=env.module_dir,
+                        user_entry_point=env.user_entry_point,
+                        args=env.to_cmd_args(),
+                        env_vars=env_vars,
+                        runner_type=runner_type,
+                        **run_kwargs)
+        _record_horovod_autotune(env, env_vars)
+        succeeded = True
+    except Exception:
+        # report the role that brought the worker down rather than the worker's own error
+        supervisor.raise_for_failure()
+        raise
+    finally:
+        # also stops the roles that started before one of them failed to start
+        supervisor.stop(graceful=succeeded)
+        if sampler:
+            sampler.stop()
+        signal.signal(signal.SIGTERM, previous_handler)
 
 
 def main():
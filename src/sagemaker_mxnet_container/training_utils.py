@@ -12,15 +12,124 @@
 # language governing permissions and limitations under the License.
 from __future__ import absolute_import
 
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import gzip
+import hashlib
 import json
+import logging
+import multiprocessing
 import os
+import queue
+import re
+import signal
+import struct
+import sys
+import tempfile
+import threading
+import time
+import zlib
 
 SYMBOL_PATH = 'model-symbol.json'
-PARAMS_PATH = 'model-0000.params'
+EPOCH_PARAMS_PATH = 'model-{:04d}.params'
+PARAMS_PATH = EPOCH_PARAMS_PATH.format(0)
 SHAPES_PATH = 'model-shapes.json'
+SHARD_PATH = 'model-shard-{:05d}-of-{:05d}.params'
+SHARDS_MANIFEST_PATH = 'model-shards.json'
+COMPACT_PARAMS_PATH = 'model-0000.compact'
+COMPACT_MANIFEST_PATH = 'model-compact.json'
+INFERENCE_SYMBOL_PATH = 'model-inference-symbol.json'
+INFERENCE_PARAMS_PATH = 'model-inference-0000.params'
+INT8_SYMBOL_PATH = 'model-int8-symbol.json'
+INT8_PARAMS_PATH = 'model-int8-0000.params'
 
+# loss heads -> the operator that computes the same prediction without a label, None for identity
+INFERENCE_HEADS = {'SoftmaxOutput': 'softmax', 'LogisticRegressionOutput': 'sigmoid',
+                   'LinearRegressionOutput': None, 'MAERegressionOutput': None}
+# operators that are the identity outside of training
+TRAINING_ONLY_OPS = ('Dropout',)
+# the subgraph backend that fuses a graph for INT8 quantization
+QUANTIZATION_BACKEND = 'MKLDNN'
 
-def save(model_dir, model, current_host=None, hosts=None):
+# set by the launcher when it finds a checkpoint to resume from, see ``restore``
+CHECKPOINT_PREFIX_ENV = 'SM_MXNET_CHECKPOINT_PREFIX'
+CHECKPOINT_EPOCH_ENV = 'SM_MXNET_CHECKPOINT_EPOCH'
+
+# the subdirectory of the checkpoint directory that ``emergency_save_handler`` saves to
+INTERRUPTED_CHECKPOINT_DIR = 'interrupted'
+
+# set by the launcher from the '_termination_grace_seconds' hyperparameter, see
+# ``emergency_save_handler``
+TERMINATION_GRACE_ENV = 'SM_MXNET_TERMINATION_GRACE_SECONDS'
+# SageMaker kills the processes of a stopped job 120 seconds after it sends SIGTERM
+DEFAULT_TERMINATION_GRACE_SECONDS = 60
+# after SIGTERM, the share of the grace period spent waiting for the current batch to end
+BATCH_END_WAIT_FRACTION = 0.5
+
+# set by the launcher to when it started and when it handed over to the entry point,
+# see ``report_first_step``
+LAUNCH_START_ENV = 'SM_MXNET_LAUNCH_START'
+ENTRY_POINT_START_ENV = 'SM_MXNET_ENTRY_POINT_START'
+# matched by a SageMaker metric definition such as
+# {'Name': 'launch:first_step', 'Regex': 'launch_first_step_seconds=([0-9.]+)'}
+LAUNCH_METRIC_FORMAT = 'launch_{}_seconds={:.3f};'
+
+# set by the launcher from the '_profile_*' hyperparameters, see ``profiler_callback``
+PROFILE_START_STEP_ENV = 'SM_MXNET_PROFILE_START_STEP'
+PROFILE_NUM_STEPS_ENV = 'SM_MXNET_PROFILE_NUM_STEPS'
+PROFILE_MODE_ENV = 'SM_MXNET_PROFILE_MODE'
+PROFILE_DIR_ENV = 'SM_MXNET_PROFILE_DIR'
+# '_profile_mode' -> the mx.profiler.set_config option it turns on
+PROFILE_MODES = {'all': 'profile_all', 'symbolic': 'profile_symbolic',
+                 'imperative': 'profile_imperative', 'memory': 'profile_memory',
+                 'api': 'profile_api'}
+
+COMPACT_DTYPES = ('float16', 'bfloat16')
+# favor speed over ratio: parameters are mostly incompressible mantissa bits anyway
+COMPRESSION_LEVEL = 1
+
+# arrays with at least this many elements are split across all parameter servers
+KVSTORE_BIGARRAY_BOUND_ENV = 'MXNET_KVSTORE_BIGARRAY_BOUND'
+# when ``create_kvstore`` picks the bound, an array larger than this fraction of a server's share
+# of the parameters is split; splitting smaller arrays costs more messages than it balances
+BIGARRAY_SHARE_FRACTION = 0.25
+MIN_BIGARRAY_BOUND = 1 << 16
+DEFAULT_COMPRESSION_THRESHOLD = 0.5
+# the framework parameter that starts the scheduler and servers, see training.LAUNCH_PS_ENV_NAME
+PARAMETER_SERVER_ENABLED = 'sagemaker_parameter_server_enabled'
+
+PIPE_MODE_INPUT_DIR = '/opt/ml/input/data'
+# RecordIO framing, see dmlc-core/include/dmlc/recordio.h and mxnet.recordio.IRHeader
+RECORDIO_MAGIC = 0xced7230a
+RECORDIO_HEADER = struct.Struct('<II')
+RECORDIO_IR_HEADER = struct.Struct('<IfQQ')
+PIPE_READ_BUFFER_BYTES = 1 << 20
+# how long to wait for SageMaker to create the next epoch's FIFO
+PIPE_TIMEOUT_SECONDS = 600
+
+DECODED_CACHE_DIR = os.path.join(tempfile.gettempdir(), 'sagemaker-mxnet-decoded')
+# IDX type codes, see http://yann.lecun.com/exdb/mnist/
+IDX_DTYPES = {0x08: 'uint8', 0x09: 'int8', 0x0b: 'int16', 0x0c: 'int32', 0x0d: 'float32',
+              0x0e: 'float64'}
+IDX_CHUNK_BYTES = 1 << 24
+SOURCE_HASH_BLOCK_BYTES = 1 << 20
+
+PERMUTATION_PATH = 'permutation-{}-seed-{}-epoch-{}.npy'
+PERMUTATION_CHUNK_SIZE = 1 << 24
+
+# asynchronous saves block the caller once this many are queued or being written
+MAX_SAVES_IN_FLIGHT = 2
+
+logger = logging.getLogger(__name__)
+
+_save_executor = None
+_save_slots = threading.BoundedSemaphore(MAX_SAVES_IN_FLIGHT)
+_save_lock = threading.Lock()
+
+
+def save(model_dir, model, current_host=None, hosts=None, asynchronous=False, sharded=False,
+         compact=False, dtype=None, compress=True, epoch=0, inference_backend=None,
+         calib_data=None):
     """Save an MXNet Module to a given location if the current host is the scheduler host.
 
     This generates three files in the model directory:
@@ -28,26 +137,1584 @@ def save(model_dir, model, current_host=None, hosts=None):
     - model-symbol.json: The serialized module symbolic graph.
         Formed by invoking ``module.symbole.save``.
     - model-0000.params: The serialized module parameters.
-        Formed by invoking ``module.save_params``.
+        Formed by invoking ``module.save_params``. With ``epoch`` set, the file is named
+        ``model-<epoch>.params`` instead, as ``mx.callback.do_checkpoint`` would name it.
     - model-shapes.json: The serialized module input data shapes in the form of a JSON list of
         JSON data-shape objects. Each data-shape object contains a string name and
         a list of integer dimensions.
 
+    With ``asynchronous=True``, the parameters are copied to host memory and the three files
+    are written by a background thread, each to a temporary name that is then renamed into
+    place, so readers never see a partially written file. At most ``MAX_SAVES_IN_FLIGHT``
+    saves are pending at a time; further calls block until one of them completes.
+
+    With ``sharded=True``, every host must call ``save``. The parameter arrays are split into
+    one shard per host, balanced by size, and each host writes its own shard to
+    ``model-shard-<index>-of-<count>.params``. The scheduler host also writes the symbol and
+    shapes files and ``model-shards.json``, which maps every parameter to its shard file. All
+    shards must end up in the same directory, for example on a shared file system; load them
+    back with ``load_sharded``.
+
+    With ``compact=True``, the parameters are written to ``model-0000.compact`` instead of
+    ``model-0000.params``, next to a ``model-compact.json`` manifest. Floating point tensors can
+    be down-cast to ``dtype`` and every tensor can be zlib-compressed; tensors are encoded in
+    parallel. The manifest records a CRC32 checksum of every tensor so that ``load_compact``
+    detects truncated or partially written files. The symbol and shapes files are unchanged.
+
+    With ``inference_backend`` set, an inference-optimized copy of the model is also written to
+    ``model-inference-symbol.json`` and ``model-inference-0000.params``, which load with
+    ``mx.model.load_checkpoint(os.path.join(model_dir, 'model-inference'), 0)``. Dropout is
+    removed, loss heads such as ``SoftmaxOutput`` are replaced with the prediction they compute,
+    so that the model no longer takes a label, and the graph is fused for the subgraph backend,
+    such as 'MKLDNN'. With ``calib_data`` as well, the fused model is quantized to INT8,
+    calibrated on the batches of ``calib_data``, and written to ``model-int8-symbol.json`` and
+    ``model-int8-0000.params``. The input shapes are those of ``model-shapes.json``.
+
     Args:
         model_dir (str): the directory for saving the model
         model (mxnet.mod.Module): the module to be saved
+        current_host (str): the name of the current host (default: ``SM_CURRENT_HOST``)
+        hosts (list[str]): the names of all hosts (default: ``SM_HOSTS``)
+        asynchronous (bool): whether to write the files on a background thread
+        sharded (bool): whether every host writes a disjoint part of the parameters
+        compact (bool): whether to write the parameters in the compact format
+        dtype (str): with ``compact``, store floating point tensors as 'float16' or
+            'bfloat16' (default: keep their original type)
+        compress (bool): with ``compact``, whether to compress every tensor
+        epoch (int): the number of completed epochs, used to name the params file of a
+            checkpoint that training can later resume from (see ``restore``)
+        inference_backend (str): the subgraph backend to fuse an inference copy of the model
+            for, such as 'MKLDNN' (default: no inference copy)
+        calib_data (mxnet.io.DataIter): with ``inference_backend='MKLDNN'``, a few batches to
+            calibrate an INT8 copy of the model on (default: no INT8 copy)
+
+    Returns:
+        concurrent.futures.Future: a future that completes once the files are written, if
+            ``asynchronous`` is set and this host saved the model; otherwise None
     """
     current_host = current_host or os.environ['SM_CURRENT_HOST']
     hosts = hosts or json.loads(os.environ['SM_HOSTS'])
 
+    if compact and sharded:
+        raise ValueError('Compact saves cannot be sharded')
+    if epoch and (compact or sharded):
+        raise ValueError('Only the default format supports saving a specific epoch')
+    if dtype not in (None,) + COMPACT_DTYPES:
+        raise ValueError('Unsupported compact dtype: {}'.format(dtype))
+    if inference_backend and sharded:
+        raise ValueError('Sharded saves cannot export an inference model')
+    if calib_data is not None and inference_backend != QUANTIZATION_BACKEND:
+        raise ValueError('INT8 quantization requires inference_backend={!r}'
+                         .format(QUANTIZATION_BACKEND))
+
+    if sharded:
+        return _save_sharded(model_dir, model, current_host, hosts, asynchronous)
+
+    if current_host != scheduler_host(hosts):
+        return None
+
+    params_path = EPOCH_PARAMS_PATH.format(epoch)
+    compact_options = {'dtype': dtype, 'compress': compress} if compact else None
+    inference_options = ({'backend': inference_backend, 'calib_data': calib_data}
+                         if inference_backend else None)
+    if asynchronous:
+        return _save_async(model_dir, model, params_path, compact_options, inference_options)
+    if compact:
+        _write_checkpoint(model_dir, model.symbol.tojson(), _params(model),
+                          _data_signature(model), params_path, compact_options,
+                          inference_options)
+        return None
+
+    model.symbol.save(os.path.join(model_dir, SYMBOL_PATH))
+    # a checkpoint cut off mid-write must not be mistaken for the latest one
+    atomic_write(os.path.join(model_dir, params_path), model.save_params)
+
+    with open(os.path.join(model_dir, SHAPES_PATH), 'w') as f:
+        json.dump(_data_signature(model), f)
+
+    if inference_options:
+        _export_inference(model_dir, model.symbol.tojson(), _params(model),
+                          _data_signature(model), **inference_options)
+    return None
+
+
+def _data_signature(model):
+    return [{'name': data_desc.name, 'shape': [dim for dim in data_desc.shape]}
+            for data_desc in model.data_shapes]
+
+
+def _params(model):
+    # the same keys that Module.save_params uses
+    arg_params, aux_params = model.get_params()
+    params = {'arg:{}'.format(name): value for name, value in arg_params.items()}
+    params.update({'aux:{}'.format(name): value for name, value in aux_params.items()})
+    return params
+
+
+def _snapshot_params(model):
+    # the copies are taken in engine order, so later updates to the module do not leak
+    # into the snapshot
+    return {key: value.copy() for key, value in _params(model).items()}
+
+
+def _submit_save(prepare):
+    """Write a save in the background once a save slot is free.
+
+    ``prepare`` snapshots the parameters and returns the write function and its arguments.
+    It only runs once the slot is acquired, so that a caller blocked on a full queue does not
+    hold one more copy of the parameters than the saves in flight.
+    """
+    global _save_executor
+
+    _save_slots.acquire()
+    try:
+        fn, args = prepare()
+        with _save_lock:
+            if _save_executor is None:
+                # a single writer keeps saves in order; its thread is joined at interpreter exit
+                _save_executor = ThreadPoolExecutor(max_workers=1)
+            future = _save_executor.submit(fn, *args)
+    except BaseException:
+        _save_slots.release()
+        raise
+    future.add_done_callback(lambda _: _save_slots.release())
+    return future
+
+
+def _save_async(model_dir, model, params_path, compact_options=None, inference_options=None):
+    def prepare():
+        return _write_checkpoint, (model_dir, model.symbol.tojson(), _snapshot_params(model),
+                                   _data_signature(model), params_path, compact_options,
+                                   inference_options)
+
+    return _submit_save(prepare)
+
+
+def _assign_shards(params, num_shards):
+    """Assign every parameter to a shard, largest first, always to the lightest shard.
+
+    Every host computes the same assignment from the same parameter shapes.
+    """
+    loads = [0] * num_shards
+    assignment = {}
+    for name in sorted(params, key=lambda name: (-params[name].size, name)):
+        shard = loads.index(min(loads))
+        assignment[name] = shard
+        loads[shard] += params[name].size
+    return assignment
+
+
+def _save_sharded(model_dir, model, current_host, hosts, asynchronous):
+    if asynchronous:
+        return _submit_save(lambda: (_write_shard, _shard_args(
+            model_dir, model, current_host, hosts, _snapshot_params(model))))
+    _write_shard(*_shard_args(model_dir, model, current_host, hosts, _params(model)))
+    return None
+
+
+def _shard_args(model_dir, model, current_host, hosts, params):
+    assignment = _assign_shards(params, len(hosts))
+    shard_paths = [SHARD_PATH.format(index, len(hosts)) for index in range(len(hosts))]
+
+    shard = hosts.index(current_host)
+    shard_params = {name: params[name] for name, index in assignment.items() if index == shard}
+
+    scheduler_files = None
     if current_host == scheduler_host(hosts):
-        model.symbol.save(os.path.join(model_dir, SYMBOL_PATH))
-        model.save_params(os.path.join(model_dir, PARAMS_PATH))
+        manifest = {'shards': shard_paths,
+                    'params': {name: shard_paths[index] for name, index in assignment.items()}}
+        scheduler_files = (model.symbol.tojson(), _data_signature(model), manifest)
+
+    return model_dir, shard_paths[shard], shard_params, scheduler_files
+
+
+def _write_shard(model_dir, shard_path, shard_params, scheduler_files):
+    import mxnet as mx
+
+    atomic_write(os.path.join(model_dir, shard_path),
+                 lambda path: mx.nd.save(path, shard_params))
+
+    if scheduler_files:
+        symbol_json, signature, manifest = scheduler_files
+        atomic_write(os.path.join(model_dir, SYMBOL_PATH),
+                     lambda path: _write_file(path, symbol_json))
+        atomic_write(os.path.join(model_dir, SHAPES_PATH),
+                     lambda path: _write_file(path, json.dumps(signature)))
+        atomic_write(os.path.join(model_dir, SHARDS_MANIFEST_PATH),
+                     lambda path: _write_file(path, json.dumps(manifest)))
+
+
+def load_sharded(model_dir):
+    """Load a model saved with ``save(..., sharded=True)``.
+
+    Args:
+        model_dir (str): the directory that holds the manifest and all of the shards
+
+    Returns:
+        tuple(mxnet.symbol.Symbol, dict[str, mxnet.nd.NDArray], dict[str, mxnet.nd.NDArray]):
+            the symbol, the arg params and the aux params, as ``mx.model.load_checkpoint``
+            returns them
+    """
+    import mxnet as mx
+
+    with open(os.path.join(model_dir, SHARDS_MANIFEST_PATH)) as f:
+        manifest = json.load(f)
+
+    params = {}
+    for shard_path in manifest['shards']:
+        params.update(mx.nd.load(os.path.join(model_dir, shard_path)))
+
+    missing = set(manifest['params']) - set(params)
+    if missing:
+        raise ValueError('Parameters missing from the shards in {}: {}'
+                         .format(model_dir, ', '.join(sorted(missing))))
+
+    arg_params, aux_params = _split_params(params)
+    symbol = mx.sym.load(os.path.join(model_dir, SYMBOL_PATH))
+    return symbol, arg_params, aux_params
+
+
+def _write_checkpoint(model_dir, symbol_json, params, signature, params_path,
+                      compact_options=None, inference_options=None):
+    if compact_options:
+        _write_compact_params(model_dir, params, **compact_options)
+    else:
+        import mxnet as mx
+        atomic_write(os.path.join(model_dir, params_path),
+                     lambda path: mx.nd.save(path, params))
+    atomic_write(os.path.join(model_dir, SHAPES_PATH),
+                 lambda path: _write_file(path, json.dumps(signature)))
+    atomic_write(os.path.join(model_dir, SYMBOL_PATH),
+                 lambda path: _write_file(path, symbol_json))
+    if inference_options:
+        _export_inference(model_dir, symbol_json, params, signature, **inference_options)
+
+
+def _is_true(value):
+    return str(value).lower() in ('true', '1')
+
+
+def _strip_training_ops(symbol_json, head_ndims):
+    """Return the JSON of a symbol without the operators that only matter to training.
+
+    Dropout is bypassed, and every loss head that takes a label is replaced with the
+    prediction it computes, so that the label is no longer an input of the graph.
+    ``SoftmaxOutput`` flattens an input of more than two dimensions unless it is told not to,
+    which ``softmax`` cannot do; such heads are kept.
+
+    Args:
+        symbol_json (str): the symbol, as ``Symbol.tojson`` returns it
+        head_ndims (list[int]): the number of dimensions of every output of the symbol
+    """
+    graph = json.loads(symbol_json)
+    nodes = graph['nodes']
+    bypassed = {(index, 0): tuple(node['inputs'][0][:2]) for index, node in enumerate(nodes)
+                if node['op'] in TRAINING_ONLY_OPS}
+
+    def follow(entry):
+        key = tuple(entry[:2])
+        while key in bypassed:
+            key = bypassed[key]
+        return list(key) + entry[2:]
+
+    for node in nodes:
+        node['inputs'] = [follow(entry) for entry in node['inputs']]
+    heads = [follow(head) for head in graph['heads']]
+
+    for head, ndim in zip(heads, head_ndims):
+        node = nodes[head[0]]
+        if node['op'] not in INFERENCE_HEADS:
+            continue
+
+        attrs = {}
+        if node['op'] == 'SoftmaxOutput':
+            node_attrs = node.get('attrs', {})
+            if _is_true(node_attrs.get('multi_output')):
+                attrs = {'axis': '1'}
+            elif _is_true(node_attrs.get('preserve_shape')) or ndim == 2:
+                attrs = {'axis': '-1'}
+            else:
+                continue
+
+        prediction = INFERENCE_HEADS[node['op']]
+        if prediction is None:
+            head[:2] = node['inputs'][0][:2]
+        else:
+            node.update(op=prediction, inputs=node['inputs'][:1], attrs=attrs)
+
+    graph['heads'] = heads
+    return json.dumps(graph)
+
+
+def _export_inference(model_dir, symbol_json, params, signature, backend, calib_data=None):
+    import mxnet as mx
+
+    data_shapes = {desc['name']: tuple(desc['shape']) for desc in signature}
+    _, output_shapes, _ = mx.sym.load_json(symbol_json).infer_shape_partial(**data_shapes)
+    symbol = mx.sym.load_json(_strip_training_ops(symbol_json,
+                                                  [len(shape) for shape in output_shapes]))
+
+    arg_params, aux_params = _split_params(params)
+    # the labels of the replaced loss heads are no longer arguments
+    arguments = set(symbol.list_arguments())
+    arg_params = {name: value for name, value in arg_params.items() if name in arguments}
+    _write_inference_model(model_dir, INFERENCE_SYMBOL_PATH, INFERENCE_PARAMS_PATH,
+                           symbol.get_backend_symbol(backend), arg_params, aux_params)
+
+    if calib_data is None:
+        return
+
+    from mxnet.contrib.quantization import quantize_model
+
+    quantization_backend = '{}_QUANTIZE'.format(backend)
+    calib_data.reset()
+    qsym, qarg_params, aux_params = quantize_model(
+        symbol.get_backend_symbol(quantization_backend), arg_params, aux_params,
+        data_names=[desc['name'] for desc in signature], label_names=[], ctx=mx.cpu(),
+        calib_mode='naive', calib_data=calib_data, quantized_dtype='auto')
+    _write_inference_model(model_dir, INT8_SYMBOL_PATH, INT8_PARAMS_PATH,
+                           qsym.get_backend_symbol(quantization_backend), qarg_params,
+                           aux_params)
+
+
+def _write_inference_model(model_dir, symbol_path, params_path, symbol, arg_params, aux_params):
+    import mxnet as mx
+
+    params = {'arg:{}'.format(name): value for name, value in arg_params.items()}
+    params.update({'aux:{}'.format(name): value for name, value in aux_params.items()})
+    atomic_write(os.path.join(model_dir, params_path), lambda path: mx.nd.save(path, params))
+    atomic_write(os.path.join(model_dir, symbol_path), symbol.save)
+
+
+def _to_bfloat16(array):
+    import numpy as np
+
+    # round to nearest even on the upper 16 bits of the float32 representation
+    values = np.ascontiguousarray(array, dtype=np.float32)
+    bits = values.view(np.uint32).astype(np.uint64)
+    rounded = (bits + ((bits >> 16) & 1) + 0x7FFF) >> 16
+    # rounding would carry the payload of a NaN into the exponent, so NaNs are truncated
+    # instead, with the quiet bit set so that they stay NaNs
+    truncated = (bits >> 16) | 0x40
+    return np.where(np.isnan(values), truncated, rounded).astype(np.uint16)
+
+
+def _from_bfloat16(array):
+    import numpy as np
+
+    return (array.astype(np.uint32) << 16).view(np.float32)
+
+
+def _encode_tensor(array, dtype, compress):
+    import numpy as np
+
+    stored_dtype = str(array.dtype)
+    if dtype and array.dtype.kind == 'f':
+        stored_dtype = dtype
+        array = _to_bfloat16(array) if dtype == 'bfloat16' else array.astype(np.float16)
+
+    data = np.ascontiguousarray(array).tobytes()
+    if compress:
+        data = zlib.compress(data, COMPRESSION_LEVEL)
+    return {'stored_dtype': stored_dtype, 'compressed': compress,
+            'crc32': zlib.crc32(data) & 0xFFFFFFFF}, data
+
+
+def _decode_tensor(name, entry, data):
+    import numpy as np
+
+    if zlib.crc32(data) & 0xFFFFFFFF != entry['crc32']:
+        raise ValueError('Checksum mismatch for {}, the checkpoint is corrupt or partially '
+                         'written'.format(name))
+    if entry['compressed']:
+        data = zlib.decompress(data)
+
+    if entry['stored_dtype'] == 'bfloat16':
+        array = _from_bfloat16(np.frombuffer(data, dtype=np.uint16))
+    else:
+        array = np.frombuffer(data, dtype=entry['stored_dtype'])
+    return array.astype(entry['dtype'], copy=False).reshape(entry['shape'])
+
+
+def _write_compact_params(model_dir, params, dtype=None, compress=True):
+    tensors = {}
+
+    def write(path):
+        workers = multiprocessing.cpu_count()
+        offset = 0
+        with open(path, 'wb') as f, ThreadPoolExecutor(max_workers=workers) as pool:
+            # tensors are copied off MXNet one at a time and encoded in parallel, with at most
+            # one pending tensor per worker so that memory use stays bounded
+            pending = deque()
+            for name in sorted(params) + [None]:
+                if name is not None:
+                    array = params[name].asnumpy()
+                    entry = {'dtype': str(array.dtype), 'shape': list(array.shape)}
+                    pending.append((name, entry, pool.submit(_encode_tensor, array, dtype,
+                                                             compress)))
+                while pending and (len(pending) > workers or name is None):
+                    pending_name, pending_entry, future = pending.popleft()
+                    encoding, data = future.result()
+                    f.write(data)
+                    pending_entry.update(encoding, offset=offset, length=len(data))
+                    tensors[pending_name] = pending_entry
+                    offset += len(data)
+
+    atomic_write(os.path.join(model_dir, COMPACT_PARAMS_PATH), write)
+    manifest = {'format_version': 1, 'params_file': COMPACT_PARAMS_PATH, 'tensors': tensors}
+    atomic_write(os.path.join(model_dir, COMPACT_MANIFEST_PATH),
+                 lambda path: _write_file(path, json.dumps(manifest)))
+
+
+def load_compact(model_dir):
+    """Load a model saved with ``save(..., compact=True)``.
+
+    Every tensor is checked against the checksum in the manifest and cast back to the type it
+    had when it was saved.
+
+    Args:
+        model_dir (str): the directory that holds the compact checkpoint
+
+    Returns:
+        tuple(mxnet.symbol.Symbol, dict[str, mxnet.nd.NDArray], dict[str, mxnet.nd.NDArray]):
+            the symbol, the arg params and the aux params, as ``mx.model.load_checkpoint``
+            returns them
+    """
+    import mxnet as mx
+
+    with open(os.path.join(model_dir, COMPACT_MANIFEST_PATH)) as f:
+        manifest = json.load(f)
+
+    tensors = manifest['tensors']
+    with open(os.path.join(model_dir, manifest['params_file']), 'rb') as f:
+        blobs = {}
+        for name in sorted(tensors, key=lambda name: tensors[name]['offset']):
+            f.seek(tensors[name]['offset'])
+            blobs[name] = f.read(tensors[name]['length'])
+
+    with ThreadPoolExecutor(max_workers=multiprocessing.cpu_count()) as pool:
+        arrays = dict(zip(blobs, pool.map(
+            lambda name: _decode_tensor(name, tensors[name], blobs[name]), blobs)))
+
+    arg_params, aux_params = _split_params(
+        {name: mx.nd.array(array, dtype=array.dtype) for name, array in arrays.items()})
+    symbol = mx.sym.load(os.path.join(model_dir, SYMBOL_PATH))
+    return symbol, arg_params, aux_params
+
+
+def _split_params(params):
+    arg_params, aux_params = {}, {}
+    for key, value in params.items():
+        kind, name = key.split(':', 1)
+        if kind == 'arg':
+            arg_params[name] = value
+        elif kind == 'aux':
+            aux_params[name] = value
+    return arg_params, aux_params
+
+
+def _write_file(path, content):
+    with open(path, 'w') as f:
+        f.write(content)
+
+
+def atomic_write(path, write, per_process=False):
+    """Write a file so that no reader ever sees it partly written.
+
+    ``write`` is called with a temporary path next to ``path``, which is then renamed into
+    place. If ``write`` raises, the temporary file is removed.
+
+    Args:
+        path (str): the path of the file
+        write (callable): writes the file to the path that it is called with
+        per_process (bool): make the temporary path unique to this process, for files that
+            several processes on a host may write at the same time (default: False)
+    """
+    directory, name = os.path.split(path)
+    if per_process:
+        name = '{}.{}'.format(name, os.getpid())
+    tmp_path = os.path.join(directory, '.{}.tmp'.format(name))
+    try:
+        write(tmp_path)
+        os.rename(tmp_path, path)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def _complete_epochs(checkpoint_dir):
+    if not os.path.isdir(checkpoint_dir):
+        return []
+
+    names = os.listdir(checkpoint_dir)
+    if SYMBOL_PATH not in names or SHAPES_PATH not in names:
+        return []
+
+    pattern = re.compile(r'^model-(\d{4,})\.params$')
+    return [int(match.group(1)) for match in map(pattern.match, names)
+            if match and os.path.getsize(os.path.join(checkpoint_dir, match.group(0)))]
+
+
+def _checkpoints(checkpoint_dir):
+    """Return the complete checkpoints in a directory as (prefix, epoch), newest first.
+
+    A checkpoint saved by ``emergency_save_handler`` holds the progress made during its epoch,
+    so it comes before the checkpoint saved at the end of the previous epoch.
+    """
+    checkpoints = []
+    for directory, interrupted in ((checkpoint_dir, False),
+                                   (os.path.join(checkpoint_dir, INTERRUPTED_CHECKPOINT_DIR),
+                                    True)):
+        checkpoints.extend((epoch, interrupted, os.path.join(directory, 'model'))
+                           for epoch in _complete_epochs(directory))
+    return [(prefix, epoch) for epoch, _, prefix in sorted(checkpoints, reverse=True)]
+
+
+def find_latest_checkpoint(checkpoint_dir):
+    """Find the newest complete checkpoint written by ``save(..., epoch=...)``.
+
+    A checkpoint is complete when its params file and the symbol and shapes files are all
+    present. Temporary files of saves that are still in progress are ignored. A checkpoint
+    saved by ``emergency_save_handler`` in the ``interrupted`` subdirectory is newer than the
+    one of the same epoch in the directory itself.
+
+    Args:
+        checkpoint_dir (str): the directory to scan
+
+    Returns:
+        tuple(str, int): the checkpoint prefix, as ``mx.model.load_checkpoint`` takes it, and
+            the epoch; or None if there is no complete checkpoint
+    """
+    checkpoints = _checkpoints(checkpoint_dir)
+    return checkpoints[0] if checkpoints else None
+
+
+def restore(module):
+    """Restore a Module from the checkpoint that the launcher found, if any.
+
+    When the ``_checkpoint_dir`` hyperparameter (default: /opt/ml/checkpoints) holds a complete
+    checkpoint, the launcher exports its prefix and epoch to the entry point. The module must
+    already be bound. If the checkpoint cannot be loaded, the older ones are tried in turn,
+    and training starts over if none of them loads.
+
+    Args:
+        module (mxnet.mod.Module): the module to restore
+
+    Returns:
+        int: the epoch of the checkpoint, to be passed to ``Module.fit`` as ``begin_epoch``;
+            0 if there is no checkpoint to resume from
+    """
+    prefix = os.environ.get(CHECKPOINT_PREFIX_ENV)
+    if not prefix:
+        return 0
+
+    import mxnet as mx
+
+    checkpoint = (prefix, int(os.environ[CHECKPOINT_EPOCH_ENV]))
+    checkpoint_dir = os.path.dirname(prefix)
+    if os.path.basename(checkpoint_dir) == INTERRUPTED_CHECKPOINT_DIR:
+        checkpoint_dir = os.path.dirname(checkpoint_dir)
+    older = _checkpoints(checkpoint_dir)
+    older = older[older.index(checkpoint) + 1:] if checkpoint in older else []
+
+    for prefix, epoch in [checkpoint] + older:
+        try:
+            _, arg_params, aux_params = mx.model.load_checkpoint(prefix, epoch)
+        except mx.base.MXNetError as e:
+            logger.warning('Cannot load checkpoint {} at epoch {}: {}'.format(prefix, epoch, e))
+            continue
+        module.set_params(arg_params, aux_params)
+        return epoch
+
+    logger.warning('No checkpoint could be loaded, training from the start')
+    return 0
+
+
+class _EmergencySave(object):
+    """Save a module once after SIGTERM, then exit; see ``emergency_save_handler``."""
+
+    def __init__(self, checkpoint_dir, module, grace_seconds, save_kwargs):
+        self._checkpoint_dir = checkpoint_dir
+        self._module = module
+        self._grace_seconds = grace_seconds
+        self._save_kwargs = save_kwargs
+        self._epoch = 0
+        self._requested = threading.Event()
+        self._saving = threading.Event()
+        self._lock = threading.Lock()
+
+    def __call__(self, param):
+        self._epoch = param.epoch
+        if self._requested.is_set():
+            self._save_and_exit()
+
+    def handle(self, signum, _):
+        logger.info('Received signal {}, saving the model within {:g}s'.format(
+            signum, self._grace_seconds))
+        self._requested.set()
+        watchdog = threading.Thread(target=self._watch)
+        watchdog.daemon = True
+        watchdog.start()
+
+    def _watch(self):
+        deadline = time.time() + self._grace_seconds
+        if not self._saving.wait(self._grace_seconds * BATCH_END_WAIT_FRACTION):
+            # the current batch did not end in time, so save the parameters as they are
+            saver = threading.Thread(target=self._save_and_exit)
+            saver.daemon = True
+            saver.start()
+
+        time.sleep(max(0, deadline - time.time()))
+        logger.error('The model was not saved within {:g}s'.format(self._grace_seconds))
+        _exit(1)
+
+    def _save_and_exit(self):
+        self._saving.set()
+        # whichever of the training loop and the watchdog comes second blocks here until exit
+        with self._lock:
+            start = time.time()
+            model_dir = os.path.join(self._checkpoint_dir, INTERRUPTED_CHECKPOINT_DIR)
+            if not os.path.isdir(model_dir):
+                os.makedirs(model_dir)
+            future = save(model_dir, self._module, asynchronous=True, epoch=self._epoch,
+                          **self._save_kwargs)
+            if future:
+                future.result()
+            logger.info('Saved the model during epoch {} in {:.1f}s'.format(
+                self._epoch, time.time() - start))
+            # skip the interpreter shutdown, which can block on a kvstore whose peers are
+            # going away as well
+            _exit(0)
+
+
+def _exit(returncode):
+    # os._exit does not flush the output of the process
+    sys.stdout.flush()
+    sys.stderr.flush()
+    os._exit(returncode)
+
+
+def emergency_save_handler(checkpoint_dir, module, grace_seconds=None, **kwargs):
+    """Save a Module and exit when the job is stopped or its spot instance is reclaimed.
+
+    Installs a SIGTERM handler and returns a ``batch_end_callback`` for ``Module.fit``, which
+    the launcher forwards SIGTERM to. After the signal, the module is saved at the end of the
+    current batch, so that all of its parameters come from the same step. If the batch does not
+    end within half the grace period, the parameters are saved as they are. The files are
+    written as ``save(..., asynchronous=True, epoch=<current epoch>)`` writes them, to the
+    ``interrupted`` subdirectory of ``checkpoint_dir``, so that the checkpoint of the last
+    completed epoch is kept. The process exits with 0 once they are in place, or with 1 if the
+    grace period runs out first.
+
+    The launcher resumes the next job from the interrupted checkpoint, unless a later epoch
+    completed since, at the start of the interrupted epoch (see ``restore``).
+
+    Args:
+        checkpoint_dir (str): the directory to save to, e.g. /opt/ml/checkpoints
+        module (mxnet.mod.Module): the module to save
+        grace_seconds (float): how long saving may take (default: the
+            '_termination_grace_seconds' hyperparameter, or 60)
+        **kwargs: passed on to ``save``, e.g. ``current_host`` and ``hosts``
+
+    Returns:
+        callable: the callback to pass to ``Module.fit`` as (one of) its ``batch_end_callback``
+    """
+    if grace_seconds is None:
+        grace_seconds = float(os.environ.get(TERMINATION_GRACE_ENV,
+                                             DEFAULT_TERMINATION_GRACE_SECONDS))
+    emergency_save = _EmergencySave(checkpoint_dir, module, grace_seconds, kwargs)
+    signal.signal(signal.SIGTERM, emergency_save.handle)
+    return emergency_save
+
+
+def launch_timing_lines(phase, seconds, host=None):
+    """Format how long a launch phase took as a JSON log line and a metric line.
+
+    Args:
+        phase (str): the name of the phase
+        seconds (float): how long it took
+        host (str): the host it ran on (default: SM_CURRENT_HOST)
+
+    Returns:
+        list[str]: the lines to log
+    """
+    record = {'event': 'launch_timing', 'phase': phase, 'seconds': round(seconds, 3),
+              'host': host or os.environ.get('SM_CURRENT_HOST')}
+    return [json.dumps(record, sort_keys=True), LAUNCH_METRIC_FORMAT.format(phase, seconds)]
+
+
+_first_step_reported = threading.Event()
+
+
+def report_first_step(*_):
+    """Log how long the job took to get from the launch to the first training step.
+
+    Call it after the first batch, or pass it to ``Module.fit`` as ``batch_end_callback``; only
+    the first call in a process reports. Besides the total ('first_step'), it reports how long
+    sagemaker-training took to start this process once the launcher handed over to it
+    ('entry_point': installing the module and running mpirun), and how long this process took
+    to reach the first step ('script': imports, data loading and the first batch).
+
+    Returns:
+        dict: the seconds per phase, or None if the first step was already reported
+    """
+    if _first_step_reported.is_set():
+        return None
+    _first_step_reported.set()
+
+    import psutil
+
+    now = time.time()
+    started = psutil.Process().create_time()
+    timings = {}
+    if os.environ.get(ENTRY_POINT_START_ENV):
+        timings['entry_point'] = started - float(os.environ[ENTRY_POINT_START_ENV])
+    timings['script'] = now - started
+    if os.environ.get(LAUNCH_START_ENV):
+        timings['first_step'] = now - float(os.environ[LAUNCH_START_ENV])
+
+    for phase, seconds in timings.items():
+        for line in launch_timing_lines(phase, seconds):
+            logger.info(line)
+    return timings
+
+
+class _ProfilerWindow(object):
+    def __init__(self, start_step, num_steps, mode, output_dir):
+        self.step = 0
+        self._start_step = start_step
+        self._stop_step = start_step + num_steps
+        self._mode = mode
+        self._output_dir = output_dir
+        self._prefix = None
+        if start_step == 0:
+            self._start()
+
+    def __call__(self, *_):
+        self.step += 1
+        if self.step == self._start_step:
+            self._start()
+        elif self.step == self._stop_step:
+            self._stop()
+
+    def _start(self):
+        import mxnet as mx
+
+        os.makedirs(self._output_dir, exist_ok=True)
+        self._prefix = os.path.join(self._output_dir, 'profile-{}-{}'.format(
+            os.environ.get('SM_CURRENT_HOST', 'local'), os.getpid()))
+        mx.profiler.set_config(filename='{}.json'.format(self._prefix), aggregate_stats=True,
+                               **{PROFILE_MODES[self._mode]: True})
+        mx.profiler.set_state('run')
+
+    def _stop(self):
+        if self._prefix is None:
+            # the window started before the first step, so the profiler never ran
+            return
+
+        import mxnet as mx
+
+        mx.profiler.set_state('stop')
+        mx.profiler.dump()
+        _write_file('{}-summary.txt'.format(self._prefix), mx.profiler.dumps(reset=True))
+
+
+def _skip_step(*_):
+    pass
+
+
+def profiler_callback():
+    """Return a callback that runs the MXNet profiler over the steps the launcher was asked to.
+
+    With the ``_profile_start_step`` hyperparameter set, the callback profiles the
+    ``_profile_num_steps`` steps (default: 10) after that many steps, with the profiler option
+    that ``_profile_mode`` selects (one of ``PROFILE_MODES``, default: 'all'). It then writes
+    a chrome trace and an aggregate summary of the operators to the 'profile' directory of
+    the output data. Otherwise, it does nothing.
+
+    Pass it to ``Module.fit`` as ``batch_end_callback``, or call it after every step of a
+    Gluon training loop.
+
+    Returns:
+        callable: the callback
+    """
+    if not os.environ.get(PROFILE_START_STEP_ENV):
+        return _skip_step
+
+    return _ProfilerWindow(int(os.environ[PROFILE_START_STEP_ENV]),
+                           int(os.environ[PROFILE_NUM_STEPS_ENV]),
+                           os.environ[PROFILE_MODE_ENV], os.environ[PROFILE_DIR_ENV])
+
+
+# subclasses of MXNet and Horovod classes, created on first use so that importing this module
+# does not import either
+_mxnet_classes = {}
+
+
+def _mxnet_class(mixin, base):
+    if (mixin, base) not in _mxnet_classes:
+        _mxnet_classes[mixin, base] = type(mixin.__name__.lstrip('_'), (mixin, base), {})
+    return _mxnet_classes[mixin, base]
+
+
+def host_shard(num_samples, hosts=None, current_host=None):
+    """Return the range of samples that belongs to the current host.
+
+    The samples are split into one contiguous shard per host, in the order of ``hosts``. Shard
+    sizes differ by at most one sample, so no sample is dropped and no host in a ``dist_sync``
+    job waits on a much larger shard than the others.
+
+    Args:
+        num_samples (int): the number of samples in the dataset
+        hosts (list[str]): the names of all hosts (default: ``SM_HOSTS``)
+        current_host (str): the name of the current host (default: ``SM_CURRENT_HOST``)
+
+    Returns:
+        (int, int): the index of the first sample of the shard and one past its last sample
+    """
+    hosts = hosts or json.loads(os.environ['SM_HOSTS'])
+    current_host = current_host or os.environ['SM_CURRENT_HOST']
+
+    index = hosts.index(current_host)
+    return num_samples * index // len(hosts), num_samples * (index + 1) // len(hosts)
+
+
+def _index_dtype(num_samples):
+    import numpy as np
+
+    return np.int32 if num_samples <= np.iinfo(np.int32).max else np.int64
+
+
+def _write_permutation(path, num_samples, random):
+    import numpy as np
+
+    def write(tmp_path):
+        indices = np.lib.format.open_memmap(tmp_path, mode='w+', shape=(num_samples,),
+                                            dtype=_index_dtype(num_samples))
+        for start in range(0, num_samples, PERMUTATION_CHUNK_SIZE):
+            end = min(start + PERMUTATION_CHUNK_SIZE, num_samples)
+            indices[start:end] = np.arange(start, end)
+        random.shuffle(indices)
+        indices.flush()
+
+    # every process on a host may build the same file at once
+    atomic_write(path, write, per_process=True)
+
+
+def _remove_old_permutations(index_dir, num_samples, seed, epoch):
+    pattern = re.compile('^{}$'.format(re.escape(
+        PERMUTATION_PATH.format(num_samples, seed, '@')).replace('@', r'(\d+)')))
+    for name in os.listdir(index_dir):
+        match = pattern.match(name)
+        # the permutations of later epochs may belong to other processes that are ahead
+        if match and int(match.group(1)) < epoch:
+            try:
+                os.remove(os.path.join(index_dir, name))
+            except OSError:
+                # removed by another process, or still mapped by one on a filesystem that
+                # does not allow it
+                pass
+
+
+def epoch_permutation(num_samples, epoch, seed=0, index_dir=None):
+    """Return a permutation of all samples that is different for every epoch.
+
+    The permutation only depends on ``num_samples``, ``epoch`` and ``seed``, so every host
+    computes the same one without communicating.
+
+    Args:
+        num_samples (int): the number of samples in the dataset
+        epoch (int): the epoch
+        seed (int): the seed shared by all hosts (default: 0)
+        index_dir (str): if given, the permutation is written to an ``.npy`` file in this
+            directory, once per host, and returned memory-mapped, for datasets whose indices
+            do not fit in memory. Writing it removes the files of the earlier epochs
+            (default: build it in memory)
+
+    Returns:
+        numpy.ndarray: the sample indices in shuffled order
+    """
+    import numpy as np
+
+    random = np.random.RandomState([seed, epoch])
+    if index_dir is None:
+        indices = np.arange(num_samples, dtype=_index_dtype(num_samples))
+        random.shuffle(indices)
+        return indices
+
+    path = os.path.join(index_dir, PERMUTATION_PATH.format(num_samples, seed, epoch))
+    if not os.path.exists(path):
+        _write_permutation(path, num_samples, random)
+        _remove_old_permutations(index_dir, num_samples, seed, epoch)
+    return np.load(path, mmap_mode='r')
+
+
+def shuffled_shard(num_samples, epoch, seed=0, hosts=None, current_host=None, index_dir=None):
+    """Return the current host's samples for an epoch of a global shuffle.
+
+    Unlike shuffling inside a fixed shard, every host draws from the whole dataset in every
+    epoch. The shards of an epoch are disjoint, cover all samples and are balanced as in
+    ``host_shard``.
+
+    Args:
+        num_samples (int): the number of samples in the dataset
+        epoch (int): the epoch
+        seed (int): the seed shared by all hosts (default: 0)
+        hosts (list[str]): the names of all hosts (default: ``SM_HOSTS``)
+        current_host (str): the name of the current host (default: ``SM_CURRENT_HOST``)
+        index_dir (str): a directory for a memory-mapped permutation, see
+            ``epoch_permutation`` (default: build it in memory)
+
+    Returns:
+        numpy.ndarray: the indices of the current host's samples, in shuffled order
+    """
+    start, end = host_shard(num_samples, hosts, current_host)
+    return epoch_permutation(num_samples, epoch, seed, index_dir)[start:end]
+
+
+def _source_key(path, **options):
+    """Identify a source file's content and the options it is decoded with."""
+    stat = os.stat(path)
+    digest = hashlib.sha256()
+    digest.update(json.dumps([os.path.abspath(path), stat.st_size, stat.st_mtime_ns,
+                              sorted(options.items())]).encode('utf-8'))
+    with open(path, 'rb') as f:
+        # the first and last blocks catch a rewritten file whose size and mtime were kept
+        digest.update(f.read(SOURCE_HASH_BLOCK_BYTES))
+        f.seek(max(stat.st_size - SOURCE_HASH_BLOCK_BYTES, 0))
+        digest.update(f.read(SOURCE_HASH_BLOCK_BYTES))
+    return digest.hexdigest()[:16]
+
+
+def _open_source(path):
+    return gzip.open(path, 'rb') if path.endswith('.gz') else open(path, 'rb')
+
+
+def _decode_idx(path, tmp_path, dtype, scale):
+    import numpy as np
+
+    with _open_source(path) as source:
+        zero, type_code, num_dims = struct.unpack('>HBB', source.read(4))
+        if zero != 0 or type_code not in IDX_DTYPES:
+            raise ValueError('{} is not an IDX file'.format(path))
+        shape = struct.unpack('>{}I'.format(num_dims), source.read(4 * num_dims))
+        source_dtype = np.dtype(IDX_DTYPES[type_code]).newbyteorder('>')
+        if dtype is None:
+            dtype = 'float32' if scale is not None else source_dtype.newbyteorder('=')
+        dtype = np.dtype(dtype)
+
+        array = np.lib.format.open_memmap(tmp_path, mode='w+', shape=shape, dtype=dtype)
+        flat = array.reshape(-1)
+        # decode in chunks, so that the decompressed data never has to fit in memory
+        chunk = max(IDX_CHUNK_BYTES // source_dtype.itemsize, 1)
+        for start in range(0, flat.size, chunk):
+            count = min(chunk, flat.size - start)
+            values = np.frombuffer(source.read(count * source_dtype.itemsize), source_dtype)
+            if len(values) < count:
+                raise ValueError('{} is truncated'.format(path))
+            if scale is not None:
+                values = values * scale
+            flat[start:start + count] = values
+        array.flush()
+
+
+def _load_idx(path, dtype, scale, cache_dir):
+    import numpy as np
+
+    key = _source_key(path, dtype=str(dtype), scale=scale)
+    name = re.sub(r'\.gz$', '', os.path.basename(path))
+    cache_path = os.path.join(cache_dir, '{}-{}.npy'.format(name, key))
+    if not os.path.exists(cache_path):
+        atomic_write(cache_path, lambda tmp_path: _decode_idx(path, tmp_path, dtype, scale),
+                     per_process=True)
+    return np.load(cache_path, mmap_mode='r')
+
+
+def load_idx(paths, dtype=None, scale=None, cache_dir=DECODED_CACHE_DIR):
+    """Load IDX files, such as the MNIST ones, decoding them only once per host.
+
+    Every file, optionally gzipped, is decoded into an ``.npy`` file in ``cache_dir`` and
+    returned memory-mapped. The cached file is keyed by the source's path, size, mtime and a
+    hash of its first and last blocks, and by ``dtype`` and ``scale``, so later runs and other
+    processes on the host reuse it instead of decompressing the source again. Several files
+    are decoded in parallel.
+
+    Args:
+        paths (str or list[str]): the path of an IDX file, or a list of paths
+        dtype (str): the dtype to convert the values to (default: float32 when scaling,
+            otherwise the dtype of the file)
+        scale (float): a factor to multiply the values by, e.g. ``1.0 / 255`` for images
+            (default: no scaling)
+        cache_dir (str): the directory of the decoded files (default: a directory in the
+            system's temporary directory)
+
+    Returns:
+        numpy.ndarray or list[numpy.ndarray]: the decoded array, or a list of arrays if
+            ``paths`` is a list
+    """
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir, exist_ok=True)
+
+    if isinstance(paths, str):
+        return _load_idx(paths, dtype, scale, cache_dir)
+    with ThreadPoolExecutor(max(min(len(paths), multiprocessing.cpu_count()), 1)) as executor:
+        # zlib releases the GIL while it decompresses
+        return list(executor.map(lambda path: _load_idx(path, dtype, scale, cache_dir), paths))
+
+
+def _load_npy(paths, default_name):
+    import numpy as np
+
+    if isinstance(paths, str):
+        paths = {default_name: paths}
+    return [(name, np.load(path, mmap_mode='r')) for name, path in sorted(paths.items())]
+
+
+class _NumpyShardIter(object):
+    def __init__(self, data, label=None, batch_size=1, hosts=None, current_host=None,
+                 shuffle=False, last_batch_handle='pad', data_name='data',
+                 label_name='softmax_label', dtype='float32', prefetch=0, seed=0,
+                 index_dir=None):
+        super(_NumpyShardIter, self).__init__(batch_size)
+        import mxnet as mx
+        import numpy as np
+
+        if last_batch_handle not in ('pad', 'discard'):
+            raise ValueError('Unsupported last_batch_handle: {}'.format(last_batch_handle))
+
+        self.hosts = hosts or json.loads(os.environ['SM_HOSTS'])
+        self.current_host = current_host or os.environ['SM_CURRENT_HOST']
+
+        data_arrays = _load_npy(data, data_name)
+        self._arrays = data_arrays + (_load_npy(label, label_name) if label else [])
+        self._num_data = len(data_arrays)
+        self._total_samples = len(self._arrays[0][1])
+        if any(len(array) != self._total_samples for _, array in self._arrays):
+            raise ValueError('All arrays must have the same number of samples')
+
+        self._start, self._end = host_shard(self._total_samples, self.hosts, self.current_host)
+        self.num_samples = self._end - self._start
+        if self.num_samples < batch_size:
+            raise ValueError('The shard of {} holds {} samples, fewer than one batch'
+                             .format(self.current_host, self.num_samples))
+
+        self.dtype = np.dtype(dtype)
+        self.shuffle = shuffle
+        self.last_batch_handle = last_batch_handle
+        self.prefetch = prefetch
+        self.seed = seed
+        self.index_dir = index_dir
+        self.epoch = -1
+
+        descs = [mx.io.DataDesc(name, (batch_size,) + array.shape[1:], self.dtype)
+                 for name, array in self._arrays]
+        self.provide_data = descs[:self._num_data]
+        self.provide_label = descs[self._num_data:]
+
+        self._order = None
+        self._batches = None
+        self._prefetcher = None
+        self._prefetcher_stopped = False
+        self.reset()
+
+    @property
+    def num_batches(self):
+        if self.last_batch_handle == 'discard':
+            return self.num_samples // self.batch_size
+        return -(-self.num_samples // self.batch_size)
+
+    def reset(self):
+        self._stop_prefetcher()
+        self.epoch += 1
+        if self.shuffle:
+            self._order = shuffled_shard(self._total_samples, self.epoch, self.seed, self.hosts,
+                                         self.current_host, self.index_dir)
+        self._cursor = 0
+        if self.prefetch:
+            self._batches = queue.Queue(self.prefetch)
+            self._prefetcher = threading.Thread(target=self._prefetch, args=(self._batches,))
+            self._prefetcher.daemon = True
+            self._prefetcher.start()
+
+    def _stop_prefetcher(self):
+        if self._prefetcher:
+            # drain the queue so that a blocked producer sees the stop flag and exits
+            self._prefetcher_stopped = True
+            while self._prefetcher.is_alive():
+                try:
+                    self._batches.get_nowait()
+                except queue.Empty:
+                    self._prefetcher.join(0.01)
+            self._prefetcher = None
+        self._prefetcher_stopped = False
+
+    def _prefetch(self, batches):
+        for index in range(self.num_batches):
+            if self._prefetcher_stopped:
+                return
+            arrays, pad = self._read_batch(index)
+            # copying here makes the page faults happen on this thread instead of the trainer's
+            batches.put(([array.copy() for array in arrays], pad))
+        batches.put(None)
+
+    def _read_batch(self, index):
+        import numpy as np
+
+        first = index * self.batch_size
+        last = min(first + self.batch_size, self.num_samples)
+        pad = self.batch_size - (last - first)
+
+        if self._order is None and not pad:
+            # contiguous rows of the memory map: a view, no copy
+            rows = slice(self._start + first, self._start + last)
+        else:
+            order = self._order if self._order is not None else np.arange(self._start, self._end)
+            # reading rows in file order keeps page access sequential
+            rows = np.sort(np.concatenate([order[first:last], order[:pad]]))
+        return [_astype(array[rows], self.dtype) for _, array in self._arrays], pad
+
+    def iter_next(self):
+        return self._cursor < self.num_batches
+
+    def next(self):
+        import mxnet as mx
+        import numpy as np
+
+        if not self.iter_next():
+            raise StopIteration
+        if self.prefetch:
+            arrays, pad = self._batches.get()
+        else:
+            arrays, pad = self._read_batch(self._cursor)
+        self._cursor += 1
+
+        arrays = [mx.nd.from_numpy(np.ascontiguousarray(array), zero_copy=True)
+                  for array in arrays]
+        return mx.io.DataBatch(data=arrays[:self._num_data], label=arrays[self._num_data:],
+                               pad=pad, provide_data=self.provide_data,
+                               provide_label=self.provide_label)
+
+
+def _astype(array, dtype):
+    return array if array.dtype == dtype else array.astype(dtype)
+
+
+def numpy_shard_iter(data, label=None, batch_size=1, hosts=None, current_host=None, **kwargs):
+    """Iterate over this host's shard of memory-mapped ``.npy`` files.
+
+    A drop-in replacement for ``mx.io.NDArrayIter`` for datasets stored as ``.npy`` files, such
+    as a File-mode channel. The files are memory-mapped rather than loaded, and the samples are
+    split between hosts as in ``host_shard``, or as in ``shuffled_shard`` with a new epoch on
+    every ``reset`` when shuffling. Batches of unshuffled, unpadded rows of the right dtype
+    are passed to MXNet without copying.
+
+    Args:
+        data (str or dict[str, str]): the path of the data ``.npy`` file, or a dict mapping
+            input names to paths
+        label (str or dict[str, str]): the path of the label ``.npy`` file, or a dict mapping
+            label names to paths (default: no label)
+        batch_size (int): the batch size
+        hosts (list[str]): the names of all hosts (default: ``SM_HOSTS``)
+        current_host (str): the name of the current host (default: ``SM_CURRENT_HOST``)
+        **kwargs: ``shuffle`` (bool, default False) to shuffle this host's samples every epoch,
+            ``last_batch_handle`` ('pad' or 'discard', default 'pad'), ``data_name``
+            (default 'data'), ``label_name`` (default 'softmax_label'), ``dtype`` (default
+            'float32'), ``prefetch`` (int, default 0) to read that many batches ahead on a
+            background thread, ``seed`` (int, default 0) for the shuffle and ``index_dir``
+            (default None) to memory-map the shuffle's permutation, see ``epoch_permutation``
+
+    Returns:
+        mxnet.io.DataIter: the iterator
+    """
+    import mxnet as mx
+
+    cls = _mxnet_class(_NumpyShardIter, mx.io.DataIter)
+    return cls(data, label, batch_size, hosts, current_host, **kwargs)
+
+
+def _read_records(stream):
+    """Yield the payloads of the RecordIO records in a binary stream."""
+    parts = []
+    while True:
+        header = stream.read(RECORDIO_HEADER.size)
+        if not header:
+            return
+        if len(header) < RECORDIO_HEADER.size:
+            raise ValueError('Truncated RecordIO header')
+        magic, length_record = RECORDIO_HEADER.unpack(header)
+        if magic != RECORDIO_MAGIC:
+            raise ValueError('Invalid RecordIO magic number: {:#x}'.format(magic))
+        flag, length = length_record >> 29, length_record & ((1 << 29) - 1)
+        data = stream.read(length + (-length % 4))[:length]
+        if len(data) < length:
+            raise ValueError('Truncated RecordIO record')
+
+        # records that contain the magic number are split around it: 1 starts such a record,
+        # 2 continues it and 3 ends it
+        if flag == 0:
+            yield data
+        elif flag == 3:
+            parts.append(data)
+            yield struct.pack('<I', RECORDIO_MAGIC).join(parts)
+            parts = []
+        else:
+            parts.append(data)
+
+
+def _unpack_record(record, label_width):
+    import numpy as np
+
+    flag, label, _, _ = RECORDIO_IR_HEADER.unpack_from(record)
+    offset = RECORDIO_IR_HEADER.size
+    if flag > 0:
+        label = np.frombuffer(record, np.float32, flag, offset)
+        offset += flag * 4
+    if label_width == 1:
+        label = float(np.ravel(label)[0])
+    return label, record[offset:]
+
+
+class _PipeModeIter(object):
+    def __init__(self, channel, batch_size, data_shape, label_width=1, data_name='data',
+                 label_name='softmax_label', dtype='float32', decode=None,
+                 last_batch_handle='pad', prefetch=4, input_dir=PIPE_MODE_INPUT_DIR,
+                 timeout=PIPE_TIMEOUT_SECONDS):
+        super(_PipeModeIter, self).__init__(batch_size)
+        import mxnet as mx
+        import numpy as np
+
+        if last_batch_handle not in ('pad', 'discard'):
+            raise ValueError('Unsupported last_batch_handle: {}'.format(last_batch_handle))
+
+        self.channel = channel
+        self.data_shape = tuple(data_shape)
+        self.label_width = label_width
+        self.dtype = np.dtype(dtype)
+        self.decode = decode or self._decode_raw
+        self.last_batch_handle = last_batch_handle
+        self.input_dir = input_dir
+        self.timeout = timeout
+
+        self.provide_data = [mx.io.DataDesc(data_name, (batch_size,) + self.data_shape,
+                                            self.dtype)]
+        label_shape = (batch_size,) if label_width == 1 else (batch_size, label_width)
+        self.provide_label = [mx.io.DataDesc(label_name, label_shape, np.float32)]
+
+        self.epoch = 0
+        self._started = False
+        self._finished = False
+        # the producer abandons the rest of every epoch up to this one
+        self._skip_through = -1
+        self._closed = False
+        self._batches = queue.Queue(max(prefetch, 1))
+        self._producer = threading.Thread(target=self._produce)
+        self._producer.daemon = True
+        self._producer.start()
+
+    def fifo_path(self, epoch):
+        return os.path.join(self.input_dir, '{}_{}'.format(self.channel, epoch))
+
+    def _decode_raw(self, payload):
+        import numpy as np
+
+        return np.frombuffer(payload, self.dtype).reshape(self.data_shape)
+
+    def _produce(self):
+        try:
+            epoch = 0
+            while not self._closed:
+                self._produce_epoch(epoch)
+                self._batches.put((epoch, None))
+                epoch += 1
+        except Exception as e:
+            self._batches.put((None, e))
+
+    def _wait_for_fifo(self, path):
+        deadline = time.time() + self.timeout
+        while not os.path.exists(path):
+            if self._closed or time.time() > deadline:
+                raise IOError('Pipe-mode FIFO {} did not appear within {}s'
+                              .format(path, self.timeout))
+            time.sleep(0.1)
+
+    def _produce_epoch(self, epoch):
+        import numpy as np
+
+        path = self.fifo_path(epoch)
+        self._wait_for_fifo(path)
+        data, labels = [], []
+        with open(path, 'rb', buffering=PIPE_READ_BUFFER_BYTES) as stream:
+            for record in _read_records(stream):
+                if self._closed or epoch <= self._skip_through:
+                    # closing the FIFO early is fine: the next epoch gets a fresh one
+                    return
+                label, payload = _unpack_record(record, self.label_width)
+                data.append(self.decode(payload))
+                labels.append(label)
+                if len(data) == self.batch_size:
+                    self._batches.put((epoch, (np.stack(data).astype(self.dtype, copy=False),
+                                               np.array(labels, np.float32), 0)))
+                    data, labels = [], []
+
+        if data and self.last_batch_handle == 'pad':
+            pad = self.batch_size - len(data)
+            # repeat the last batch's own samples, there is no going back to the start of a FIFO
+            indices = [i % len(data) for i in range(self.batch_size)]
+            self._batches.put((epoch, (np.stack(data)[indices].astype(self.dtype, copy=False),
+                                       np.array(labels, np.float32)[indices], pad)))
+
+    def _get(self):
+        epoch, batch = self._batches.get()
+        if epoch is None:
+            raise batch
+        return epoch, batch
+
+    def reset(self):
+        if self._started and not self._finished:
+            self._skip_through = self.epoch
+            # drop what was read ahead of the abandoned epoch
+            epoch, batch = self._get()
+            while epoch != self.epoch or batch is not None:
+                epoch, batch = self._get()
+        if self._started:
+            self.epoch += 1
+        self._started = False
+        self._finished = False
+
+    def close(self):
+        self._closed = True
+
+    def next(self):
+        import mxnet as mx
+
+        if self._finished:
+            raise StopIteration
+        self._started = True
+        _, batch = self._get()
+        if batch is None:
+            self._finished = True
+            raise StopIteration
+
+        data, label, pad = batch
+        return mx.io.DataBatch(data=[mx.nd.from_numpy(data, zero_copy=True)],
+                               label=[mx.nd.from_numpy(label, zero_copy=True)], pad=pad,
+                               provide_data=self.provide_data,
+                               provide_label=self.provide_label)
+
+
+def pipe_mode_iter(channel, batch_size, data_shape, **kwargs):
+    """Stream batches of RecordIO records from a Pipe-mode channel.
+
+    In Pipe mode, SageMaker streams every epoch of a channel through a new FIFO named
+    ``/opt/ml/input/data/<channel>_<epoch>`` instead of downloading the data before training.
+    The iterator reads and decodes records on a background thread, up to ``prefetch`` batches
+    ahead of the training loop, and moves on to the next epoch's FIFO on ``reset``. Each
+    record is an ``mx.recordio.pack`` record whose label is taken from its header.
+
+    Args:
+        channel (str): the name of the channel
+        batch_size (int): the batch size
+        data_shape (tuple[int]): the shape of one sample
+        **kwargs: ``label_width`` (int, default 1), ``data_name`` (default 'data'),
+            ``label_name`` (default 'softmax_label'), ``dtype`` (default 'float32'),
+            ``decode`` (a function from a record's payload to a numpy array, default: the
+            payload holds the raw bytes of the sample in ``dtype``, as written by
+            ``mx.recordio.pack(header, array.tobytes())``), ``last_batch_handle`` ('pad' or
+            'discard', default 'pad'), ``prefetch`` (int, default 4), ``input_dir``
+            (default '/opt/ml/input/data') and ``timeout`` (seconds to wait for an epoch's FIFO,
+            default 600)
+
+    Returns:
+        mxnet.io.DataIter: the iterator
+    """
+    import mxnet as mx
+
+    cls = _mxnet_class(_PipeModeIter, mx.io.DataIter)
+    return cls(channel, batch_size, data_shape, **kwargs)
+
+
+def _job_settings(env):
+    if env is not None:
+        return (env.hosts, env.hyperparameters, env.additional_framework_parameters,
+                env.num_gpus)
+    # the variables that sagemaker-training exports to the entry point
+    return (json.loads(os.environ.get('SM_HOSTS', '[]')),
+            json.loads(os.environ.get('SM_HPS', '{}')),
+            json.loads(os.environ.get('SM_FRAMEWORK_PARAMS', '{}')),
+            int(os.environ.get('SM_NUM_GPUS', 0)))
+
+
+def _bigarray_bound(param_shapes, num_servers):
+    import numpy as np
+
+    shapes = param_shapes.values() if hasattr(param_shapes, 'values') else param_shapes
+    num_elements = sum(int(np.prod(getattr(shape, 'shape', shape))) for shape in shapes)
+    return max(int(num_elements / num_servers * BIGARRAY_SHARE_FRACTION), MIN_BIGARRAY_BOUND)
+
+
+def create_kvstore(env=None, param_shapes=None):
+    """Create the kvstore that suits the job's hosts, GPUs and distribution settings.
+
+    A single host gets 'device' with several GPUs and 'local' otherwise. Several hosts, or a
+    job with the parameter server enabled, get 'dist_device_sync' with GPUs and 'dist_sync'
+    otherwise. The ``_kvstore`` hyperparameter
+    overrides the type. Under MPI, Horovod exchanges the gradients and no kvstore is created.
+
+    With the ``_gradient_compression`` hyperparameter set to '2bit', the gradients that the
+    kvstore sends are quantized to 2 bits, with ``_gradient_compression_threshold`` (default:
+    0.5). Compression applies to the 'device' and 'dist' types only.
+
+    For the 'dist' types, arrays are split across the parameter servers above a size bound.
+    Unless the ``_kvstore_bigarray_bound`` hyperparameter sets it for the whole job, the bound
+    is picked from ``param_shapes`` so that the largest arrays are spread over every server.
+
+    Args:
+        env (sagemaker_training.environment.Environment): the training environment (default:
+            read from the variables that sagemaker-training exports to the entry point)
+        param_shapes (list or dict): the shapes of the parameters, or the parameters
+            themselves (default: keep MXNet's bound)
+
+    Returns:
+        mxnet.kvstore.KVStore: the kvstore, or None under MPI
+    """
+    hosts, hyperparameters, framework_params, num_gpus = _job_settings(env)
+    if framework_params.get('sagemaker_mpi_enabled'):
+        return None
+
+    # with dedicated parameter server hosts, SM_HOSTS lists the worker hosts only, which can be
+    # a single host that still has to reach the scheduler and servers
+    distributed = (len(hosts) > 1 or framework_params.get(PARAMETER_SERVER_ENABLED, False)
+                   or os.environ.get('DMLC_ROLE') == 'worker')
+    if distributed:
+        kvstore_type = 'dist_device_sync' if num_gpus else 'dist_sync'
+    else:
+        kvstore_type = 'device' if num_gpus > 1 else 'local'
+    kvstore_type = hyperparameters.get('_kvstore', kvstore_type)
+
+    num_servers = int(os.environ.get('DMLC_NUM_SERVER', 1))
+    if ('dist' in kvstore_type and param_shapes is not None and num_servers > 1
+            and KVSTORE_BIGARRAY_BOUND_ENV not in os.environ):
+        # the kvstore reads the bound when it is created
+        os.environ[KVSTORE_BIGARRAY_BOUND_ENV] = str(_bigarray_bound(param_shapes, num_servers))
+
+    import mxnet as mx
+
+    kv = mx.kv.create(kvstore_type)
+    compression = hyperparameters.get('_gradient_compression')
+    if compression and compression != 'none' and ('device' in kv.type or 'dist' in kv.type):
+        kv.set_gradient_compression({
+            'type': compression,
+            'threshold': float(hyperparameters.get('_gradient_compression_threshold',
+                                                   DEFAULT_COMPRESSION_THRESHOLD))})
+    return kv
+
+
+class _ElasticState(object):
+    """The parameters of a model and the progress of its training loop under elastic Horovod.
+
+    Mixed into ``horovod.common.elastic.ObjectState`` by ``elastic_state``.
+    """
+
+    def __init__(self, model, **kwargs):
+        import horovod.mxnet as hvd
+
+        self._model = model
+        self._saved_params = self._snapshot()
+        super(_ElasticState, self).__init__(bcast_object=hvd.broadcast_object, get_rank=hvd.rank,
+                                            **kwargs)
+
+    def _is_gluon(self):
+        return hasattr(self._model, 'collect_params')
+
+    def _snapshot(self):
+        if self._is_gluon():
+            import mxnet as mx
+
+            return {name: param.data().copyto(mx.cpu())
+                    for name, param in self._model.collect_params().items()}
+        return _snapshot_params(self._model)
+
+    def save(self):
+        self._saved_params = self._snapshot()
+        super(_ElasticState, self).save()
+
+    def restore(self):
+        if self._is_gluon():
+            for name, param in self._model.collect_params().items():
+                param.set_data(self._saved_params[name])
+        else:
+            self._model.set_params(*_split_params(self._saved_params))
+        super(_ElasticState, self).restore()
+
+    def sync(self):
+        import horovod.mxnet as hvd
+
+        if self._is_gluon():
+            hvd.broadcast_parameters(self._model.collect_params(), root_rank=0)
+        else:
+            arg_params, aux_params = self._model.get_params()
+            hvd.broadcast_parameters(arg_params, root_rank=0)
+            hvd.broadcast_parameters(aux_params, root_rank=0)
+            self._model.set_params(arg_params, aux_params)
+        # a worker that joined restores to the parameters it was just sent
+        self._saved_params = self._snapshot()
+        super(_ElasticState, self).sync()
+
+    def epoch_end_callback(self, epoch, *_):
+        """Commit the state after every epoch, as the ``epoch_end_callback`` of ``Module.fit``."""
+        self.epoch = epoch + 1
+        self.commit()
+
+
+def elastic_state(model, **kwargs):
+    """Track the state that elastic Horovod training carries across hosts joining and leaving.
+
+    Every ``commit`` copies the model's parameters to host memory, along with the keyword
+    arguments, which are exposed as attributes. When a host goes away, the remaining workers
+    roll back to the last commit; when the set of hosts changes, every worker is sent rank 0's
+    state before the training function runs again. Committing less often than every batch
+    trades the steps lost on a failure for less copying.
+
+    Args:
+        model (mxnet.mod.Module or mxnet.gluon.Block): the model, with its parameters
+            initialized
+        **kwargs: the training loop's progress, such as ``epoch`` (default 0) and ``batch``
+
+    Returns:
+        horovod.common.elastic.ObjectState: the state, to be passed to a function decorated
+            with ``elastic_run``
+    """
+    from horovod.common.elastic import ObjectState
+
+    kwargs.setdefault('epoch', 0)
+    cls = _mxnet_class(_ElasticState, ObjectState)
+    return cls(model, **kwargs)
+
+
+def elastic_run(func):
+    """Run a training function under elastic Horovod, restarting it when the hosts change.
+
+    The function takes the state from ``elastic_state`` as its first argument and should
+    resume from the progress it holds, e.g. by passing ``begin_epoch=state.epoch`` and
+    ``epoch_end_callback=state.epoch_end_callback`` to ``Module.fit``. Horovod is shut down
+    and initialized again between runs, so the function should create anything that depends
+    on the number of workers, such as the optimizer's gradient scale, itself.
+
+    Args:
+        func (callable): the training function
+
+    Returns:
+        callable: the decorated function
+    """
+    import horovod.mxnet as hvd
+    from horovod.common.elastic import run_fn
+
+    def reset():
+        hvd.shutdown()
+        hvd.init()
 
-        signature = [{'name': data_desc.name, 'shape': [dim for dim in data_desc.shape]}
-                     for data_desc in model.data_shapes]
-        with open(os.path.join(model_dir, SHAPES_PATH), 'w') as f:
-            json.dump(signature, f)
+    return run_fn(func, reset)
 
 
 def scheduler_host(hosts):
@@ -0,0 +1,284 @@
+# Copyright 2018-2020 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the 'License'). You
+# may not use this file except in compliance with the License. A copy of
+# the License is located at
+#
+#     http://aws.amazon.com/apache2.0/
+#
+# or in the 'license' file accompanying this file. This file is
+# distributed on an 'AS IS' BASIS, WITHOUT WARRANTIES OR CONDITIONS OF
+# ANY KIND, either express or implied. See the License for the specific
+# language governing permissions and limitations under the License.
+"""A pre-warmed process that forks the parameter server roles.
+
+Importing MXNet loads several large shared libraries, which takes seconds on the CPU images.
+The zygote pays that cost once and then forks one child per scheduler/server role, applying
+the role's DMLC environment in the child before it enters the kvstore server loop.
+
+The launcher talks to the zygote over two pipes that carry one JSON message per line. It
+sends ``spawn`` requests; the zygote answers with ``started`` once the preload is done, and
+reports a ``ready`` message from every forked role and an ``exit`` message when a role
+exits. The zygote exits when the request pipe is closed and all of its roles have exited.
+"""
+from __future__ import absolute_import
+
+import errno
+import importlib
+import json
+import logging
+import os
+import select
+import signal
+import subprocess
+import sys
+import threading
+import time
+import traceback
+
+DEFAULT_PRELOAD = ('mxnet',)
+DEFAULT_TARGET = 'mxnet.kvstore.kvstore_server:_init_kvstore_server_module'
+
+START_TIMEOUT_SECONDS = 120
+SPAWN_TIMEOUT_SECONDS = 60
+REAP_INTERVAL_SECONDS = 0.1
+
+logger = logging.getLogger(__name__)
+
+
+class ZygoteError(Exception):
+    """Raised when the zygote cannot be started or fails to fork a role."""
+
+
+class ZygoteProcess(object):
+    """A ``subprocess.Popen``-like handle on a role forked by the zygote."""
+
+    def __init__(self, role, pid):
+        self.role = role
+        self.pid = pid
+        self.returncode = None
+        self._exited = threading.Event()
+
+    def poll(self):
+        return self.returncode
+
+    def wait(self, timeout=None):
+        if not self._exited.wait(timeout):
+            raise subprocess.TimeoutExpired(self.role, timeout)
+        return self.returncode
+
+    def send_signal(self, sig):
+        if self.returncode is None:
+            try:
+                os.kill(self.pid, sig)
+            except OSError:
+                pass
+
+    def terminate(self):
+        self.send_signal(signal.SIGTERM)
+
+    def kill(self):
+        self.send_signal(signal.SIGKILL)
+
+    def _set_returncode(self, returncode):
+        self.returncode = returncode
+        self._exited.set()
+
+
+class Zygote(object):
+    """Launcher-side handle on a zygote process.
+
+    Args:
+        preload (tuple[str]): modules imported by the zygote before it forks any role
+        target (str): ``module:function`` called in every forked role
+        env (dict[str, str]): variables to set before the preload modules are imported, such
+            as the thread counts that OpenMP and MKL read once, when MXNet loads them
+    """
+
+    def __init__(self, preload=DEFAULT_PRELOAD, target=DEFAULT_TARGET, env=None):
+        self.preload = preload
+        self.target = target
+        self.env = env or {}
+        self.process = None
+        self._requests = None
+        self._responses = None
+        self._next_id = 0
+        self._lock = threading.Lock()
+        self._started = threading.Event()
+        self._preloaded = False
+        self._ready = {}
+        self._roles = {}
+
+    def start(self, timeout=START_TIMEOUT_SECONDS):
+        """Start the zygote and wait until it has imported the preload modules."""
+        request_read, request_write = os.pipe()
+        response_read, response_write = os.pipe()
+
+        env = os.environ.copy()
+        env.update(self.env)
+        # MXNet starts a kvstore server on import if DMLC_ROLE says so
+        env.pop('DMLC_ROLE', None)
+
+        start = time.time()
+        self.process = subprocess.Popen(
+            [sys.executable, '-m', __name__, str(request_read), str(response_write),
+             self.target] + list(self.preload),
+            pass_fds=(request_read, response_write), env=env)
+        os.close(request_read)
+        os.close(response_write)
+        self._requests = os.fdopen(request_write, 'w')
+        self._responses = os.fdopen(response_read, 'r')
+
+        reader = threading.Thread(target=self._read_responses)
+        reader.daemon = True
+        reader.start()
+
+        if not self._started.wait(timeout) or not self._preloaded:
+            self.process.kill()
+            raise ZygoteError('Zygote failed to import {}'.format(', '.join(self.preload)))
+        logger.info('Zygote (pid {}) preloaded {} in {:.3f}s'.format(
+            self.process.pid, ', '.join(self.preload), time.time() - start))
+
+    def spawn(self, role, env, cpus=None, timeout=SPAWN_TIMEOUT_SECONDS):
+        """Fork a role with the given environment and return a handle on it.
+
+        Args:
+            role (str): the name of the role, used for logging
+            env (dict[str, str]): the complete environment of the role
+            cpus (list[int]): the CPUs to pin the role to (default: inherit the zygote's)
+
+        Returns:
+            ZygoteProcess: the forked role
+        """
+        with self._lock:
+            request_id = self._next_id
+            self._next_id += 1
+            ready = self._ready[request_id] = [threading.Event(), None]
+            self._requests.write(json.dumps({'id': request_id, 'role': role, 'env': env,
+                                             'cpus': cpus, 'requested_at': time.time()}) + '\n')
+            self._requests.flush()
+
+        if not ready[0].wait(timeout) or ready[1] is None:
+            raise ZygoteError('Zygote did not fork {} within {}s'.format(role, timeout))
+        return ready[1]
+
+    def close(self):
+        """Stop accepting requests. The zygote exits once all of its roles have exited."""
+        if self._requests:
+            self._requests.close()
+            self._requests = None
+
+    def _read_responses(self):
+        for line in self._responses:
+            message = json.loads(line)
+            event = message['event']
+            if event == 'started':
+                self._preloaded = True
+                self._started.set()
+            elif event == 'ready':
+                process = ZygoteProcess(message['role'], message['pid'])
+                self._roles[process.pid] = process
+                logger.info('Started {} (pid {}) in {:.3f}s'.format(
+                    process.role, process.pid, message['seconds']))
+                ready = self._ready.pop(message['id'])
+                ready[1] = process
+                ready[0].set()
+            elif event == 'exit':
+                self._roles[message['pid']]._set_returncode(message['returncode'])
+
+        # the zygote has exited: release anyone still waiting on it
+        self._started.set()
+        for ready in list(self._ready.values()):
+            ready[0].set()
+
+
+def _send(fd, message):
+    # messages are well below PIPE_BUF, so writes from the zygote and its roles never interleave
+    os.write(fd, (json.dumps(message) + '\n').encode('utf-8'))
+
+
+def _load_target(target):
+    module_name, function_name = target.split(':')
+    return getattr(importlib.import_module(module_name), function_name)
+
+
+def _run_role(request, request_fd, response_fd, target):
+    os.close(request_fd)
+    os.environ.clear()
+    os.environ.update(request['env'])
+    if request.get('cpus'):
+        # before the role starts any thread, so that all of them inherit the affinity
+        os.sched_setaffinity(0, request['cpus'])
+
+    _send(response_fd, {'event': 'ready', 'id': request['id'], 'role': request['role'],
+                        'pid': os.getpid(), 'seconds': time.time() - request['requested_at']})
+    os.close(response_fd)
+
+    returncode = 0
+    try:
+        _load_target(target)()
+    except SystemExit as e:
+        returncode = e.code if isinstance(e.code, int) else int(e.code is not None)
+    except BaseException:
+        traceback.print_exc()
+        returncode = 1
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os._exit(returncode)
+
+
+def _reap(response_fd, children):
+    while children:
+        try:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+        except OSError as e:
+            if e.errno != errno.ECHILD:
+                raise
+            return
+        if pid == 0:
+            return
+        if pid in children:
+            children.discard(pid)
+            returncode = -os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)
+            _send(response_fd, {'event': 'exit', 'pid': pid, 'returncode': returncode})
+
+
+def _serve(request_fd, response_fd, target):
+    children = set()
+    buffered = b''
+    accepting = True
+
+    while accepting or children:
+        if accepting:
+            readable, _, _ = select.select([request_fd], [], [], REAP_INTERVAL_SECONDS)
+        else:
+            readable = []
+            time.sleep(REAP_INTERVAL_SECONDS)
+
+        if readable:
+            data = os.read(request_fd, 65536)
+            if not data:
+                accepting = False
+            buffered += data
+            while b'\n' in buffered:
+                line, buffered = buffered.split(b'\n', 1)
+                request = json.loads(line.decode('utf-8'))
+                pid = os.fork()
+                if pid == 0:
+                    _run_role(request, request_fd, response_fd, target)
+                children.add(pid)
+
+        _reap(response_fd, children)
+
+
+def main(argv):
+    request_fd, response_fd, target = int(argv[0]), int(argv[1]), argv[2]
+    for module in argv[3:]:
+        importlib.import_module(module)
+    _send(response_fd, {'event': 'started'})
+    _serve(request_fd, response_fd, target)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
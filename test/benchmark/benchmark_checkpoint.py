@@ -0,0 +1,97 @@
+# Copyright 2018-2020 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the 'License'). You
+# may not use this file except in compliance with the License. A copy of
+# the License is located at
+#
+#     http://aws.amazon.com/apache2.0/
+#
+# or in the 'license' file accompanying this file. This file is
+# distributed on an 'AS IS' BASIS, WITHOUT WARRANTIES OR CONDITIONS OF
+# ANY KIND, either express or implied. See the License for the specific
+# language governing permissions and limitations under the License.
+"""Compare artifact size and save/load time of the checkpoint formats of training_utils.save.
+
+Requires MXNet. Example:
+
+    python test/benchmark/benchmark_checkpoint.py --num-params 50000000
+"""
+from __future__ import absolute_import
+
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+import mxnet as mx
+
+from sagemaker_mxnet_container import training_utils
+
+FORMATS = [
+    ('params', {}),
+    ('compact', {'compact': True, 'compress': False}),
+    ('compact+zlib', {'compact': True}),
+    ('compact+float16', {'compact': True, 'dtype': 'float16', 'compress': False}),
+    ('compact+float16+zlib', {'compact': True, 'dtype': 'float16'}),
+    ('compact+bfloat16+zlib', {'compact': True, 'dtype': 'bfloat16'}),
+]
+
+
+def build_module(num_params, num_layers):
+    hidden = int((num_params / num_layers) ** 0.5)
+    net = mx.sym.var('data')
+    for layer in range(num_layers):
+        net = mx.sym.FullyConnected(net, num_hidden=hidden, name='fc{}'.format(layer))
+    net = mx.sym.SoftmaxOutput(net, name='softmax')
+
+    module = mx.mod.Module(net)
+    module.bind(data_shapes=[('data', (1, hidden))], label_shapes=[('softmax_label', (1,))])
+    module.init_params(mx.init.Uniform())
+    return module
+
+
+def directory_size(path):
+    return sum(os.path.getsize(os.path.join(path, name)) for name in os.listdir(path))
+
+
+def benchmark(module, name, options, repeat):
+    model_dir = tempfile.mkdtemp()
+    try:
+        start = time.time()
+        for _ in range(repeat):
+            training_utils.save(model_dir, module, current_host='algo-1', hosts=['algo-1'],
+                                **options)
+        save_seconds = (time.time() - start) / repeat
+
+        start = time.time()
+        for _ in range(repeat):
+            if options.get('compact'):
+                training_utils.load_compact(model_dir)
+            else:
+                mx.model.load_checkpoint(os.path.join(model_dir, 'model'), 0)
+        load_seconds = (time.time() - start) / repeat
+
+        return name, directory_size(model_dir), save_seconds, load_seconds
+    finally:
+        shutil.rmtree(model_dir)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--num-params', type=int, default=10 ** 7)
+    parser.add_argument('--num-layers', type=int, default=8)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    module = build_module(args.num_params, args.num_layers)
+
+    print('{:<24}{:>14}{:>12}{:>12}'.format('format', 'size (MB)', 'save (s)', 'load (s)'))
+    for name, options in FORMATS:
+        name, size, save_seconds, load_seconds = benchmark(module, name, options, args.repeat)
+        print('{:<24}{:>14.1f}{:>12.3f}{:>12.3f}'.format(name, size / 2.0 ** 20, save_seconds,
+                                                         load_seconds))
+
+
+if __name__ == '__main__':
+    main()
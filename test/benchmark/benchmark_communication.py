@@ -0,0 +1,223 @@
+# Copyright 2018-2020 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the 'License'). You
+# may not use this file except in compliance with the License. A copy of
+# the License is located at
+#
+#     http://aws.amazon.com/apache2.0/
+#
+# or in the 'license' file accompanying this file. This file is
+# distributed on an 'AS IS' BASIS, WITHOUT WARRANTIES OR CONDITIONS OF
+# ANY KIND, either express or implied. See the License for the specific
+# language governing permissions and limitations under the License.
+"""Compare gradient exchange throughput of the kvstore modes and Horovod on one machine.
+
+Simulates a cluster over loopback: for the kvstore modes, the scheduler and servers are
+started with the launcher's own role logic, and every simulated host runs one worker. The
+workers exchange synthetic gradients as large as the model, split into tensors like the
+layers of a network. Requires MXNet with the distributed kvstore, and Horovod for the
+'horovod' mode. Example:
+
+    python test/benchmark/benchmark_communication.py --hosts 4 --model-mb 1,16,64
+"""
+from __future__ import absolute_import
+
+import argparse
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+from sagemaker_mxnet_container import training
+
+MODES = ('dist_sync', 'dist_async', 'dist_device_sync', 'horovod')
+WARMUP_STEPS = 3
+ROLE_SHUTDOWN_TIMEOUT_SECONDS = 30
+WORKER_TIMEOUT_SECONDS = 600
+NUM_TENSORS = 32
+
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def loopback_hosts(num_hosts):
+    return ['127.0.0.{}'.format(index + 1) for index in range(num_hosts)]
+
+
+def tensor_sizes(model_bytes, num_tensors=NUM_TENSORS):
+    """Split a model into float32 tensors of increasing size, like the layers of a network."""
+    num_floats = max(model_bytes // 4, num_tensors)
+    weights = range(1, num_tensors + 1)
+    sizes = [num_floats * weight // sum(weights) for weight in weights]
+    sizes[-1] += num_floats - sum(sizes)
+    return sizes
+
+
+def _exchange(push_pull, steps):
+    import mxnet as mx
+
+    for _ in range(WARMUP_STEPS):
+        push_pull()
+    mx.nd.waitall()
+
+    start = time.time()
+    for _ in range(steps):
+        push_pull()
+    mx.nd.waitall()
+    return time.time() - start
+
+
+def run_kvstore_worker(mode, model_bytes, steps):
+    import mxnet as mx
+
+    kv = mx.kv.create(mode)
+    sizes = tensor_sizes(model_bytes)
+    keys = list(range(len(sizes)))
+    grads = [mx.nd.ones((size,)) for size in sizes]
+    weights = [mx.nd.zeros((size,)) for size in sizes]
+    kv.init(keys, weights)
+    # like Module.fit, update on the servers; async servers cannot do without an optimizer
+    kv.set_optimizer(mx.optimizer.SGD(learning_rate=0))
+
+    def push_pull():
+        kv.push(keys, grads)
+        kv.pull(keys, out=weights)
+
+    seconds = _exchange(push_pull, steps)
+    return kv.rank, seconds
+
+
+def run_horovod_worker(model_bytes, steps):
+    import horovod.mxnet as hvd
+    import mxnet as mx
+
+    hvd.init()
+    grads = [mx.nd.ones((size,)) for size in tensor_sizes(model_bytes)]
+
+    def push_pull():
+        for index, grad in enumerate(grads):
+            hvd.allreduce_(grad, name='grad.{}'.format(index))
+
+    seconds = _exchange(push_pull, steps)
+    return hvd.rank(), seconds
+
+
+def _worker_command(mode, model_bytes, args, result_path):
+    return [sys.executable, os.path.abspath(__file__), '--worker', mode,
+            '--model-bytes', str(model_bytes), '--steps', str(args.steps),
+            '--result-file', result_path]
+
+
+def _stop(processes):
+    for process in processes:
+        try:
+            process.wait(timeout=ROLE_SHUTDOWN_TIMEOUT_SECONDS)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+
+def benchmark_kvstore(mode, model_bytes, args):
+    """Start a parameter server cluster over loopback and return rank 0's exchange time."""
+    hosts = loopback_hosts(args.hosts)
+    layout = training.PSLayout(hosts[0], hosts, hosts, args.servers_per_host)
+    ps_port = str(free_port())
+
+    roles = [training._run_mxnet_process('scheduler', layout, ps_port, '0')]
+    roles += [training._run_mxnet_process('server', layout, ps_port, '0')
+              for _ in range(len(hosts) * args.servers_per_host)]
+    worker_env = dict(os.environ, **training._env_vars_for_role('worker', layout, ps_port, '0'))
+    result_dir = tempfile.mkdtemp()
+    result_path = os.path.join(result_dir, 'result.json')
+    workers = [subprocess.Popen(_worker_command(mode, model_bytes, args, result_path),
+                                env=worker_env) for _ in hosts]
+    try:
+        return _rank_zero_seconds(workers, result_path)
+    finally:
+        _stop(workers + roles)
+        shutil.rmtree(result_dir)
+
+
+def benchmark_horovod(model_bytes, args):
+    result_dir = tempfile.mkdtemp()
+    result_path = os.path.join(result_dir, 'result.json')
+    command = (['horovodrun', '-np', str(args.hosts), '-H', 'localhost:{}'.format(args.hosts)]
+               + _worker_command('horovod', model_bytes, args, result_path))
+    try:
+        try:
+            process = subprocess.Popen(command)
+        except OSError:
+            return None
+        return _rank_zero_seconds([process], result_path)
+    finally:
+        shutil.rmtree(result_dir)
+
+
+def _rank_zero_seconds(processes, result_path):
+    """Wait for the workers and return the exchange time that rank 0 wrote to a file.
+
+    The result does not go through stdout, because horovodrun and mpirun tag every line of
+    the ranks' output.
+    """
+    for process in processes:
+        process.wait(timeout=WORKER_TIMEOUT_SECONDS)
+        if process.returncode:
+            raise RuntimeError('Worker exited with code {}'.format(process.returncode))
+    with open(result_path) as f:
+        return json.load(f)['seconds']
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--hosts', type=int, default=2, help='the simulated hosts')
+    parser.add_argument('--servers-per-host', type=int, default=1)
+    parser.add_argument('--modes', default=','.join(MODES))
+    parser.add_argument('--model-mb', default='1,16,64', help='the model sizes to sweep')
+    parser.add_argument('--steps', type=int, default=20)
+    parser.add_argument('--batch-size', type=int, default=32,
+                        help='the samples per worker and step, to derive samples/sec from the '
+                             'exchange time alone, without any compute')
+    parser.add_argument('--worker', choices=MODES, help=argparse.SUPPRESS)
+    parser.add_argument('--model-bytes', type=int, help=argparse.SUPPRESS)
+    parser.add_argument('--result-file', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        if args.worker == 'horovod':
+            rank, seconds = run_horovod_worker(args.model_bytes, args.steps)
+        else:
+            rank, seconds = run_kvstore_worker(args.worker, args.model_bytes, args.steps)
+        if rank == 0:
+            with open(args.result_file, 'w') as f:
+                json.dump({'seconds': seconds}, f)
+        return
+
+    print('{:<18}{:>10}{:>16}{:>18}'.format('mode', 'model MB', 'samples/sec*', 'MB/sec/worker'))
+    for mode in args.modes.split(','):
+        for model_mb in args.model_mb.split(','):
+            model_bytes = int(float(model_mb) * 2 ** 20)
+            if mode == 'horovod':
+                seconds = benchmark_horovod(model_bytes, args)
+            else:
+                seconds = benchmark_kvstore(mode, model_bytes, args)
+
+            if seconds is None:
+                print('{:<18}{:>10}{:>16}{:>18}'.format(mode, model_mb, 'unavailable', '-'))
+                continue
+            samples_per_second = args.steps * args.batch_size * args.hosts / seconds
+            mb_per_second = args.steps * model_bytes / seconds / 2 ** 20
+            print('{:<18}{:>10}{:>16.1f}{:>18.1f}'.format(mode, model_mb, samples_per_second,
+                                                          mb_per_second))
+    print('* derived: steps x --batch-size x hosts / exchange seconds, without any compute')
+
+
+if __name__ == '__main__':
+    main()
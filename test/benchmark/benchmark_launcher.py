@@ -0,0 +1,238 @@
+# Copyright 2018-2020 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the 'License'). You
+# may not use this file except in compliance with the License. A copy of
+# the License is located at
+#
+#     http://aws.amazon.com/apache2.0/
+#
+# or in the 'license' file accompanying this file. This file is
+# distributed on an 'AS IS' BASIS, WITHOUT WARRANTIES OR CONDITIONS OF
+# ANY KIND, either express or implied. See the License for the specific
+# language governing permissions and limitations under the License.
+"""Measure the startup latency of the launcher and compare it with stored baselines.
+
+Runs on a plain Linux machine without network or MXNet: the hosts are loopback addresses, the
+parameter server roles import an empty stub of MXNet, and the entry point is not run. Exits
+with 1 if a measurement is slower than its baseline by more than the threshold. Baselines
+depend on the machine, so record them on the machine that runs the comparison. Example:
+
+    python test/benchmark/benchmark_launcher.py --update-baselines
+    python test/benchmark/benchmark_launcher.py --threshold 1.5
+"""
+from __future__ import absolute_import
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from mock import MagicMock, patch
+
+from sagemaker_mxnet_container import training
+from sagemaker_mxnet_container.zygote import Zygote
+
+BASELINES_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                              'launcher_baselines.json')
+HOST_COUNTS = (1, 4, 16, 64, 256)
+DEFAULT_THRESHOLD = 1.5
+# faster measurements are compared against this, so that timer noise on them does not fail a run
+MIN_BASELINE_SECONDS = 0.01
+
+IMPORT_CODE = ('import time; start = time.time(); import sagemaker_mxnet_container.training; '
+               'print(time.time() - start)')
+
+# the roles started by measure_spawn write a byte to the FIFO at this path once they run
+READY_FIFO_ENV = 'BENCHMARK_READY_FIFO'
+
+# like MXNet, the stub starts a scheduler or server role when it is imported with DMLC_ROLE set
+STUB_MXNET = {
+    'mxnet/__init__.py': 'from mxnet.kvstore import kvstore_server\n',
+    'mxnet/kvstore/__init__.py': '',
+    'mxnet/kvstore/kvstore_server.py': (
+        'import os\n'
+        '\n'
+        '\n'
+        'def _init_kvstore_server_module():\n'
+        "    if os.environ.get('DMLC_ROLE') in ('scheduler', 'server') \\\n"
+        "            and os.environ.get('{0}'):\n"
+        "        with open(os.environ['{0}'], 'wb') as f:\n"
+        "            f.write(b'.')\n"
+        '\n'
+        '\n'
+        '_init_kvstore_server_module()\n'.format(READY_FIFO_ENV)),
+}
+
+
+def install_stub_mxnet():
+    """Make the roles that the launcher starts import an empty MXNet package."""
+    stub_dir = tempfile.mkdtemp()
+    for path, content in STUB_MXNET.items():
+        path = os.path.join(stub_dir, path)
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'w') as f:
+            f.write(content)
+    os.environ['PYTHONPATH'] = os.pathsep.join(
+        [stub_dir] + [path for path in [os.environ.get('PYTHONPATH')] if path])
+    return stub_dir
+
+
+def loopback_hosts(num_hosts):
+    return ['127.0.{}.{}'.format(index // 250, index % 250 + 1) for index in range(num_hosts)]
+
+
+def training_env(hosts, output_dir):
+    env = MagicMock()
+    env.hosts = hosts
+    env.current_host = hosts[0]
+    env.is_master = True
+    env.hyperparameters = {}
+    env.additional_framework_parameters = {training.LAUNCH_PS_ENV_NAME: True}
+    env.num_cpus = os.cpu_count()
+    env.num_gpus = 0
+    env.output_data_dir = output_dir
+    env.to_env_vars.return_value = {}
+    env.to_cmd_args.return_value = []
+    return env
+
+
+def median_seconds(fn, repeat):
+    seconds = []
+    for _ in range(repeat):
+        start = time.time()
+        fn()
+        seconds.append(time.time() - start)
+    return sorted(seconds)[len(seconds) // 2]
+
+
+def measure_import(repeat):
+    seconds = [float(subprocess.check_output([sys.executable, '-c', IMPORT_CODE]))
+               for _ in range(repeat)]
+    return sorted(seconds)[len(seconds) // 2]
+
+
+def measure_verify_hosts(hosts, repeat):
+    def verify():
+        training._host_ips.clear()
+        training._verify_hosts(hosts)
+
+    return median_seconds(verify, repeat)
+
+
+def measure_spawn(repeat, zygote=None):
+    """Time a server role from the request to start it until it runs and writes to a FIFO."""
+    layout = training.PSLayout('127.0.0.1', ['127.0.0.1'], ['127.0.0.1'], 1)
+    fifo_dir = tempfile.mkdtemp()
+    fifo_path = os.path.join(fifo_dir, 'ready')
+    os.mkfifo(fifo_path)
+    # opened for reading and writing, so that neither this open nor the roles' opens block
+    fifo = os.open(fifo_path, os.O_RDWR)
+    os.environ[READY_FIFO_ENV] = fifo_path
+    processes = []
+
+    def spawn():
+        processes.append(training._run_mxnet_process('server', layout, '8000', '0',
+                                                     zygote=zygote))
+        os.read(fifo, 1)
+
+    try:
+        seconds = median_seconds(spawn, repeat)
+    finally:
+        del os.environ[READY_FIFO_ENV]
+        os.close(fifo)
+        shutil.rmtree(fifo_dir)
+    for process in processes:
+        process.wait()
+    return seconds
+
+
+def measure_train(hosts, repeat, output_dir):
+    def train():
+        training._host_ips.clear()
+        training.train(training_env(hosts, output_dir))
+
+    with patch('sagemaker_training.entry_point.run'):
+        return median_seconds(train, repeat)
+
+
+def run_benchmarks(repeat):
+    results = {'import': measure_import(repeat)}
+
+    for num_hosts in HOST_COUNTS:
+        results['verify_hosts[{}]'.format(num_hosts)] = measure_verify_hosts(
+            loopback_hosts(num_hosts), repeat)
+
+    results['spawn[popen]'] = measure_spawn(repeat)
+    zygote = Zygote()
+    zygote.start()
+    try:
+        results['spawn[zygote]'] = measure_spawn(repeat, zygote)
+    finally:
+        zygote.close()
+        zygote.process.wait()
+
+    output_dir = tempfile.mkdtemp()
+    try:
+        for num_hosts in HOST_COUNTS:
+            results['train[{}]'.format(num_hosts)] = measure_train(
+                loopback_hosts(num_hosts), repeat, output_dir)
+    finally:
+        shutil.rmtree(output_dir)
+    return results
+
+
+def compare(results, baselines, threshold):
+    """Print every measurement next to its baseline and return the names of the regressions."""
+    regressions = []
+    print('{:<20}{:>12}{:>12}{:>8}'.format('benchmark', 'seconds', 'baseline', 'ratio'))
+    for name, seconds in results.items():
+        baseline = baselines.get(name)
+        if baseline is None:
+            print('{:<20}{:>12.4f}{:>12}{:>8}'.format(name, seconds, '-', '-'))
+            continue
+
+        ratio = seconds / max(baseline, MIN_BASELINE_SECONDS)
+        regressed = ratio > threshold
+        if regressed:
+            regressions.append(name)
+        print('{:<20}{:>12.4f}{:>12.4f}{:>8.2f}{}'.format(name, seconds, baseline, ratio,
+                                                          '  REGRESSION' if regressed else ''))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD,
+                        help='the slowdown over a baseline that counts as a regression')
+    parser.add_argument('--baselines', default=BASELINES_PATH)
+    parser.add_argument('--update-baselines', action='store_true')
+    args = parser.parse_args()
+
+    stub_dir = install_stub_mxnet()
+    try:
+        results = run_benchmarks(args.repeat)
+    finally:
+        shutil.rmtree(stub_dir)
+
+    if args.update_baselines:
+        with open(args.baselines, 'w') as f:
+            json.dump({name: round(seconds, 4) for name, seconds in results.items()}, f,
+                      indent=2)
+            f.write('\n')
+
+    with open(args.baselines) as f:
+        baselines = json.load(f)
+    regressions = compare(results, baselines, args.threshold)
+    if regressions:
+        print('Slower than {}x the baseline: {}'.format(args.threshold, ', '.join(regressions)))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -14,13 +14,19 @@ from __future__ import absolute_import
 
 import json
 import os
+import subprocess
 import tarfile
+import threading
+import time
 
 import pytest
 from sagemaker.mxnet import MXNet
 
 from integration import RESOURCE_PATH
 
+# how long a simulated host stays out of an elastic job
+HOST_DOWN_SECONDS = 20
+
 
 @pytest.mark.skip_cpu
 @pytest.mark.skip_generic
@@ -44,8 +50,75 @@ def test_distributed_training_horovod_cpu(
     )
 
 
+@pytest.mark.skip_gpu
+@pytest.mark.skip_generic
+def test_distributed_training_horovod_autotune_cpu(
+    sagemaker_local_session, image_uri, tmpdir, framework_version
+):
+    hyperparameters = {'_horovod_autotune': True,
+                       '_horovod_autotune_model_mb': 4,
+                       '_horovod_autotune_cache': '/opt/ml/model/horovod-autotune.json'}
+    _test_distributed_training_horovod(
+        2, 2, sagemaker_local_session, image_uri, tmpdir, framework_version, 'local',
+        hyperparameters
+    )
+
+    cache = read_json('horovod-autotune.json', str(tmpdir))
+    assert set(cache['hosts-2-processes-2-model-4mb']['env']) == {
+        'HOROVOD_FUSION_THRESHOLD', 'HOROVOD_CYCLE_TIME'}
+
+
+@pytest.mark.skip_gpu
+@pytest.mark.skip_generic
+def test_distributed_training_horovod_elastic_cpu(
+    sagemaker_local_session, image_uri, tmpdir, framework_version
+):
+    # stopping a container would stop the whole local job, so the host drops out of the job
+    # by closing its SSH daemon to new connections, and comes back by starting it again
+    simulated_failure = threading.Thread(target=_take_host_out, args=('algo-3',))
+    simulated_failure.daemon = True
+    simulated_failure.start()
+
+    output_path = 'file://%s' % tmpdir
+    estimator = MXNet(
+        entry_point=os.path.join(RESOURCE_PATH, 'hvdelastic', 'train_hvd_elastic.py'),
+        role='SageMakerRole',
+        train_instance_type='local',
+        sagemaker_session=sagemaker_local_session,
+        train_instance_count=3,
+        image_name=image_uri,
+        output_path=output_path,
+        framework_version=framework_version,
+        hyperparameters={'sagemaker_mpi_enabled': True,
+                         'sagemaker_network_interface_name': 'eth0',
+                         '_horovod_elastic': True})
+
+    estimator.fit()
+
+    tmp = str(tmpdir)
+    extract_files(output_path.replace('file://', ''), tmp)
+    sizes = read_json('sizes.json', tmp)
+    assert 2 in sizes
+    assert 3 in sizes[sizes.index(2):]
+
+
+def _take_host_out(host):
+    def docker_exec(*command):
+        container = subprocess.check_output(['docker', 'ps', '-q', '--filter',
+                                             'name={}'.format(host)]).decode('utf-8').strip()
+        return subprocess.call(['docker', 'exec', container] + list(command)) if container else 1
+
+    while docker_exec('pgrep', '-f', 'train_hvd_elastic') != 0:
+        time.sleep(5)
+    time.sleep(HOST_DOWN_SECONDS)
+    docker_exec('pkill', '-f', '/usr/sbin/sshd -D')
+    time.sleep(HOST_DOWN_SECONDS)
+    docker_exec('/usr/sbin/sshd')
+
+
 def _test_distributed_training_horovod(
-    instances, processes, session, image_uri, tmpdir, framework_version, instance_type
+    instances, processes, session, image_uri, tmpdir, framework_version, instance_type,
+    hyperparameters=None
 ):
     output_path = 'file://%s' % tmpdir
     estimator = MXNet(
@@ -57,9 +130,10 @@ def _test_distributed_training_horovod(
         image_name=image_uri,
         output_path=output_path,
         framework_version=framework_version,
-        hyperparameters={'sagemaker_mpi_enabled': True,
-                         'sagemaker_network_interface_name': 'eth0',
-                         'sagemaker_mpi_num_of_processes_per_host': processes})
+        hyperparameters=dict(hyperparameters or {},
+                             sagemaker_mpi_enabled=True,
+                             sagemaker_network_interface_name='eth0',
+                             sagemaker_mpi_num_of_processes_per_host=processes))
 
     estimator.fit('file://{}'.format(os.path.join(RESOURCE_PATH, 'mnist', 'data-distributed')))
 
@@ -0,0 +1,55 @@
+# Copyright 2018-2020 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the 'License'). You
+# may not use this file except in compliance with the License. A copy of
+# the License is located at
+#
+#     http://aws.amazon.com/apache2.0/
+#
+# or in the 'license' file accompanying this file. This file is
+# distributed on an 'AS IS' BASIS, WITHOUT WARRANTIES OR CONDITIONS OF
+# ANY KIND, either express or implied. See the License for the specific
+# language governing permissions and limitations under the License.
+import json
+import time
+
+import horovod.mxnet as hvd
+import mxnet as mx
+from mxnet import autograd, gluon
+
+from sagemaker_mxnet_container.training_utils import elastic_run, elastic_state
+
+EPOCHS = 40
+SECONDS_PER_EPOCH = 3
+
+hvd.init()
+
+net = gluon.nn.Dense(1)
+net.initialize()
+net(mx.nd.ones((1, 4)))
+loss_fn = gluon.loss.L2Loss()
+
+
+@elastic_run
+def train(state):
+    # created on every run, so that the gradients are averaged over the current workers
+    trainer = hvd.DistributedTrainer(net.collect_params(), 'sgd', {'learning_rate': 0.01})
+    while state.epoch < EPOCHS:
+        data = mx.nd.random.uniform(shape=(32, 4))
+        with autograd.record():
+            loss = loss_fn(net(data), data.sum(axis=1))
+        loss.backward()
+        trainer.step(32)
+
+        time.sleep(SECONDS_PER_EPOCH)
+        state.sizes = state.sizes + [hvd.size()]
+        state.epoch += 1
+        state.commit()
+
+
+state = elastic_state(net, sizes=[])
+train(state)
+
+if hvd.rank() == 0:
+    with open('/opt/ml/model/sizes.json', 'w') as f:
+        json.dump(state.sizes, f)
@@ -11,28 +11,23 @@
 # express or implied. See the License for the specific language governing
 # permissions and limitations under the License.
 import argparse
-import gzip
 import json
 import logging
 import os
-import struct
 import sys
 
 import mxnet as mx
 import numpy as np
 
-from sagemaker_mxnet_container.training_utils import scheduler_host
+from sagemaker_mxnet_container.training_utils import (create_kvstore, host_shard, load_idx,
+                                                      profiler_callback, report_first_step,
+                                                      scheduler_host)
 
 
 def load_data(path):
-    with gzip.open(find_file(path, 'labels.gz')) as flbl:
-        struct.unpack('>II', flbl.read(8))
-        labels = np.fromstring(flbl.read(), dtype=np.int8)
-    with gzip.open(find_file(path, 'images.gz')) as fimg:
-        _, _, rows, cols = struct.unpack('>IIII', fimg.read(16))
-        images = np.fromstring(fimg.read(), dtype=np.uint8).reshape(len(labels), rows, cols)
-        images = images.reshape(images.shape[0], 1, 28, 28).astype(np.float32) / 255
-    return labels, images
+    labels = load_idx(find_file(path, 'labels.gz'), dtype=np.int8)
+    images = load_idx(find_file(path, 'images.gz'), scale=1.0 / 255)
+    return labels, images.reshape(images.shape[0], 1, 28, 28)
 
 
 def find_file(root_path, file_name):
@@ -66,12 +61,7 @@ def train(batch_size, epochs, learning_rate, num_gpus, training_channel, testing
 
     # Data parallel training - shard the data so each host
     # only trains on a subset of the total data.
-    shard_size = len(train_images) // len(hosts)
-    for i, host in enumerate(hosts):
-        if host == current_host:
-            start = shard_size * i
-            end = start + shard_size
-            break
+    start, end = host_shard(len(train_images), hosts, current_host)
 
     train_iter = mx.io.NDArrayIter(train_images[start:end], train_labels[start:end], batch_size,
                                    shuffle=True)
@@ -79,7 +69,7 @@ def train(batch_size, epochs, learning_rate, num_gpus, training_channel, testing
 
     logging.getLogger().setLevel(logging.DEBUG)
 
-    kvstore = 'local' if len(hosts) == 1 else 'dist_sync'
+    kvstore = create_kvstore()
 
     mlp_model = mx.mod.Module(symbol=build_graph(),
                               context=get_training_context(num_gpus))
@@ -89,7 +79,8 @@ def train(batch_size, epochs, learning_rate, num_gpus, training_channel, testing
                   optimizer='sgd',
                   optimizer_params={'learning_rate': learning_rate},
                   eval_metric='acc',
-                  batch_end_callback=mx.callback.Speedometer(batch_size, 100),
+                  batch_end_callback=[report_first_step, profiler_callback(),
+                                      mx.callback.Speedometer(batch_size, 100)],
                   num_epoch=epochs)
     if current_host == scheduler_host(hosts):
         save(model_dir, mlp_model)
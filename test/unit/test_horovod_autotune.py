@@ -0,0 +1,41 @@
+# Copyright 2018-2020 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the 'License'). You
+# may not use this file except in compliance with the License. A copy of
+# the License is located at
+#
+#     http://aws.amazon.com/apache2.0/
+#
+# or in the 'license' file accompanying this file. This file is
+# distributed on an 'AS IS' BASIS, WITHOUT WARRANTIES OR CONDITIONS OF
+# ANY KIND, either express or implied. See the License for the specific
+# language governing permissions and limitations under the License.
+from __future__ import absolute_import
+
+import pytest
+
+from sagemaker_mxnet_container import horovod_autotune
+
+AUTOTUNE_LOG = '''hierarchical_allreduce,hierarchical_allgather,cache_enabled,cycle_time_ms,\
+tensor_fusion_threshold,score
+0,0,1,5,64,1000
+0,0,1,2.5,16,3000
+0,0,1,1,128,2000
+'''
+
+
+@pytest.mark.parametrize('threshold', ['16', str(16 * 2 ** 20)])
+def test_read_autotune_log(threshold, tmpdir):
+    log = tmpdir.join('autotune.csv')
+    log.write(AUTOTUNE_LOG.replace(',16,', ',{},'.format(threshold)))
+
+    assert horovod_autotune.read_autotune_log(str(log)) == {
+        'HOROVOD_FUSION_THRESHOLD': str(16 * 2 ** 20), 'HOROVOD_CYCLE_TIME': '2.5'}
+
+
+def test_read_autotune_log_without_samples(tmpdir):
+    log = tmpdir.join('autotune.csv')
+    log.write(AUTOTUNE_LOG.splitlines()[0] + '\n')
+
+    assert horovod_autotune.read_autotune_log(str(log)) is None
+    assert horovod_autotune.read_autotune_log(str(tmpdir.join('missing.csv'))) is None
@@ -0,0 +1,91 @@
+# Copyright 2018-2020 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the 'License'). You
+# may not use this file except in compliance with the License. A copy of
+# the License is located at
+#
+#     http://aws.amazon.com/apache2.0/
+#
+# or in the 'license' file accompanying this file. This file is
+# distributed on an 'AS IS' BASIS, WITHOUT WARRANTIES OR CONDITIONS OF
+# ANY KIND, either express or implied. See the License for the specific
+# language governing permissions and limitations under the License.
+from __future__ import absolute_import
+
+import os
+import socket
+import subprocess
+
+import pytest
+
+from sagemaker_mxnet_container import horovod_elastic
+
+HOSTS = ['127.0.0.2', '127.0.0.3', '127.0.0.4']
+
+
+def _free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+class _SimulatedHost(object):
+    """A host whose SSH daemon is a listening socket on a loopback address."""
+
+    def __init__(self, address, port):
+        self.address = address
+        self.port = port
+        self.sock = None
+
+    def start(self):
+        self.sock = socket.socket()
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind((self.address, self.port))
+        self.sock.listen(8)
+
+    def kill(self):
+        self.sock.close()
+
+
+@pytest.fixture
+def port():
+    return _free_port()
+
+
+@pytest.fixture
+def cluster(port):
+    hosts = [_SimulatedHost(address, port) for address in HOSTS]
+    for host in hosts:
+        host.start()
+    yield hosts
+    for host in hosts:
+        host.kill()
+
+
+def test_live_hosts(cluster, port):
+    assert horovod_elastic.live_hosts(HOSTS, port) == HOSTS
+
+    cluster[1].kill()
+    assert horovod_elastic.live_hosts(HOSTS, port) == [HOSTS[0], HOSTS[2]]
+
+    cluster[1].start()
+    assert horovod_elastic.live_hosts(HOSTS, port) == HOSTS
+
+
+def test_live_hosts_without_hosts():
+    assert horovod_elastic.live_hosts([]) == []
+
+
+def test_discovery_script(cluster, port, tmpdir):
+    script = horovod_elastic.write_discovery_script(str(tmpdir.join('discover_hosts.sh')),
+                                                    HOSTS, 2, port)
+    cluster[0].kill()
+
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(
+        [os.path.dirname(os.path.dirname(horovod_elastic.__file__))]
+        + [path for path in [os.environ.get('PYTHONPATH')] if path]))
+    output = subprocess.check_output([script], env=env)
+
+    assert output.decode('utf-8').splitlines() == ['127.0.0.3:2', '127.0.0.4:2']
@@ -0,0 +1,118 @@
+# Copyright 2018-2020 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the 'License'). You
+# may not use this file except in compliance with the License. A copy of
+# the License is located at
+#
+#     http://aws.amazon.com/apache2.0/
+#
+# or in the 'license' file accompanying this file. This file is
+# distributed on an 'AS IS' BASIS, WITHOUT WARRANTIES OR CONDITIONS OF
+# ANY KIND, either express or implied. See the License for the specific
+# language governing permissions and limitations under the License.
+from __future__ import absolute_import
+
+import logging
+import os
+import time
+
+from mock import patch
+import pytest
+
+from sagemaker_mxnet_container import telemetry
+
+NET_DEV = '''Inter-|   Receive                                                |  Transmit
+ face |bytes    packets errs drop fifo frame compressed multicast|bytes    packets errs drop fifo colls carrier compressed
+    lo: {lo} 10 0 0 0 0 0 0 {lo} 10 0 0 0 0 0 0
+  eth0: {rx} 10 0 0 0 0 0 0 {tx} 10 0 0 0 0 0 0
+'''  # noqa: E501
+
+
+def _write_process(proc, pid, ticks, rss_kb=1024, name='python'):
+    process_dir = proc.join(str(pid))
+    process_dir.ensure(dir=True)
+    fields = ['S'] + ['0'] * 10 + [str(ticks), str(ticks)] + ['0'] * 10
+    process_dir.join('stat').write('{} ({}) {}\n'.format(pid, name, ' '.join(fields)))
+    process_dir.join('status').write('Name:\t{}\nVmRSS:\t{} kB\nThreads:\t4\n'.format(
+        name, rss_kb))
+
+
+def _write_network(proc, rx, tx, lo=0):
+    proc.join('net').ensure(dir=True)
+    proc.join('net', 'dev').write(NET_DEV.format(rx=rx, tx=tx, lo=lo))
+
+
+@pytest.fixture
+def proc(tmpdir):
+    proc = tmpdir.join('proc')
+    _write_network(proc, 0, 0)
+    return proc
+
+
+def _ticks(seconds):
+    return int(seconds * os.sysconf('SC_CLK_TCK') / 2)
+
+
+def test_read_cpu_seconds(proc):
+    _write_process(proc, 7, _ticks(3), name='a (b) c')
+
+    assert telemetry.read_cpu_seconds(7, str(proc)) == 3
+
+
+def test_read_rss_bytes(proc):
+    _write_process(proc, 7, 0, rss_kb=2048)
+    proc.join('8').ensure(dir=True)
+    proc.join('8', 'status').write('Name:\tzombie\nState:\tZ\n')
+
+    assert telemetry.read_rss_bytes(7, str(proc)) == 2 * 2 ** 20
+    assert telemetry.read_rss_bytes(8, str(proc)) == 0
+
+
+def test_read_network_bytes(proc):
+    _write_network(proc, 100, 200, lo=5000)
+
+    assert telemetry.read_network_bytes(str(proc)) == (100, 200)
+
+
+@patch('time.time')
+def test_sample_and_summarize(time_mock, proc, tmpdir, caplog):
+    output = tmpdir.join('telemetry.csv')
+    pids = {1: 'scheduler', 2: 'server', 3: 'server', 4: 'worker', 5: 'zygote'}
+    for pid in pids:
+        _write_process(proc, pid, 0)
+
+    time_mock.return_value = 100.0
+    sampler = telemetry.Sampler(lambda: pids, str(output), proc_path=str(proc))
+    sampler.sample()
+    assert not sampler.samples
+
+    _write_process(proc, 2, _ticks(5), rss_kb=4096)
+    _write_process(proc, 4, _ticks(10))
+    proc.join('3').remove()
+    _write_network(proc, 20 * 2 ** 20, 10 * 2 ** 20)
+    time_mock.return_value = 110.0
+    sampler.sample()
+
+    assert list(sampler.samples) == [[110.0, 0.0, 1.0, 50.0, 4.0, 100.0, 1.0, 2.0, 1.0]]
+
+    with caplog.at_level(logging.INFO):
+        sampler.summarize()
+
+    assert 'telemetry_server_cpu_percent=50.00;' in caplog.messages
+    assert 'telemetry_net_rx_mb_per_second=2.00;' in caplog.messages
+    assert output.read().splitlines() == [','.join(telemetry.COLUMNS),
+                                          '110.0,0.0,1.0,50.0,4.0,100.0,1.0,2.0,1.0']
+
+
+def test_sampler_thread(tmpdir):
+    output = tmpdir.join('telemetry.csv')
+    sampler = telemetry.Sampler(lambda: {os.getpid(): 'worker'}, str(output), interval=0.01,
+                                summary_interval=0.05)
+    sampler.start()
+    time.sleep(0.2)
+    sampler.stop()
+
+    assert len(sampler.samples) > 1
+    assert all(row[6] > 0 for row in sampler.samples)
+    assert len(output.read().splitlines()) == len(sampler.samples) + 1
+    assert [path.basename for path in tmpdir.listdir()] == ['telemetry.csv']
@@ -12,11 +12,21 @@
 # language governing permissions and limitations under the License.
 from __future__ import absolute_import
 
+import json
+import os
+import signal
+import socket
+import subprocess
+import sys
+import time
+
 from mock import call, MagicMock, patch
+import psutil
 import pytest
 from sagemaker_training import runner
 
-from sagemaker_mxnet_container import training
+from sagemaker_mxnet_container import telemetry, training
+from sagemaker_mxnet_container.zygote import ZygoteError
 
 MODULE_DIR = 's3://my/bucket'
 MODULE_NAME = 'script_name'
@@ -36,23 +46,33 @@ BASE_ENV_VARS = {
     'PS_VERBOSE': DEFAULT_VERBOSITY,
 }
 
-MXNET_COMMAND = "python -c 'import mxnet'"
+MXNET_COMMAND = [sys.executable, '-c', 'import mxnet']
+
+NUM_CPUS = 8
+
+
+def _threads(omp_threads, engine_threads):
+    return {'OMP_NUM_THREADS': str(omp_threads), 'MKL_NUM_THREADS': str(omp_threads),
+            'MXNET_CPU_WORKER_NTHREADS': str(engine_threads)}
 
 
 @pytest.fixture
-def single_machine_training_env():
+def single_machine_training_env(tmpdir):
     env = MagicMock()
 
     env.module_dir = MODULE_DIR
     env.user_entry_point = MODULE_NAME
     env.hyperparameters = {}
     env.additional_framework_parameters = {}
+    env.num_cpus = NUM_CPUS
+    env.num_gpus = 0
+    env.output_data_dir = str(tmpdir)
 
     return env
 
 
 @pytest.fixture
-def distributed_training_env():
+def distributed_training_env(tmpdir):
     env = MagicMock()
 
     env.module_dir = MODULE_DIR
@@ -63,6 +83,9 @@ def distributed_training_env():
     env.additional_framework_parameters = {
         training.LAUNCH_PS_ENV_NAME: True,
     }
+    env.num_cpus = NUM_CPUS
+    env.num_gpus = 0
+    env.output_data_dir = str(tmpdir)
 
     return env
 
@@ -82,6 +105,7 @@ def test_train_horovod(run_module, single_machine_training_env):
 
 
 @patch('os.environ', {})
+@patch('sagemaker_mxnet_container.training._start_zygote', lambda env=None: None)
 @patch('subprocess.Popen')
 @patch('sagemaker_mxnet_container.training._host_lookup')
 @patch('sagemaker_mxnet_container.training._verify_hosts')
@@ -89,6 +113,7 @@ def test_train_horovod(run_module, single_machine_training_env):
 def test_train_for_distributed_scheduler(run_entry_point, verify_hosts,
                                          host_lookup, popen, distributed_training_env):
     host_lookup.return_value = IP_ADDRESS
+    popen.return_value.poll.return_value = None
 
     distributed_training_env.current_host = SCHEDULER
     training.train(distributed_training_env)
@@ -96,15 +121,16 @@ def test_train_for_distributed_scheduler(run_entry_point, verify_hosts,
     verify_hosts.assert_called_with(MULTIPLE_HOST_LIST)
 
     scheduler_env = BASE_ENV_VARS.copy()
-    scheduler_env.update({'DMLC_ROLE': 'scheduler'})
+    scheduler_env.update({'DMLC_ROLE': 'scheduler'}, **_threads(1, 1))
 
     server_env = BASE_ENV_VARS.copy()
-    server_env.update({'DMLC_ROLE': 'server'})
+    # the scheduler and the server take three of the eight CPUs
+    server_env.update({'DMLC_ROLE': 'server'}, **_threads(1, 2))
 
-    calls = [call(MXNET_COMMAND, shell=True, env=scheduler_env),
-             call(MXNET_COMMAND, shell=True, env=server_env)]
+    calls = [call(MXNET_COMMAND, env=scheduler_env),
+             call(MXNET_COMMAND, env=server_env)]
 
-    popen.assert_has_calls(calls)
+    assert popen.call_args_list == calls
 
     run_entry_point.assert_called_with(uri=MODULE_DIR,
                                        user_entry_point=MODULE_NAME,
@@ -114,6 +140,7 @@ def test_train_for_distributed_scheduler(run_entry_point, verify_hosts,
 
 
 @patch('os.environ', {})
+@patch('sagemaker_mxnet_container.training._start_zygote', lambda env=None: None)
 @patch('subprocess.Popen')
 @patch('sagemaker_mxnet_container.training._host_lookup')
 @patch('sagemaker_mxnet_container.training._verify_hosts')
@@ -121,6 +148,7 @@ def test_train_for_distributed_scheduler(run_entry_point, verify_hosts,
 def test_train_for_distributed_worker(run_entry_point, verify_hosts,
                                       host_lookup, popen, distributed_training_env):
     host_lookup.return_value = IP_ADDRESS
+    popen.return_value.poll.return_value = None
 
     distributed_training_env.current_host = 'host-2'
     training.train(distributed_training_env)
@@ -128,9 +156,9 @@ def test_train_for_distributed_worker(run_entry_point, verify_hosts,
     verify_hosts.assert_called_with(MULTIPLE_HOST_LIST)
 
     server_env = BASE_ENV_VARS.copy()
-    server_env.update({'DMLC_ROLE': 'server'})
+    server_env.update({'DMLC_ROLE': 'server'}, **_threads(1, 2))
 
-    popen.assert_called_once_with(MXNET_COMMAND, shell=True, env=server_env)
+    popen.assert_called_once_with(MXNET_COMMAND, env=server_env)
 
     run_entry_point.assert_called_with(uri=MODULE_DIR,
                                        user_entry_point=MODULE_NAME,
@@ -139,6 +167,32 @@ def test_train_for_distributed_worker(run_entry_point, verify_hosts,
                                        runner_type=runner.ProcessRunnerType)
 
 
+@patch('os.environ', {})
+@patch('sagemaker_mxnet_container.training._start_telemetry')
+@patch('sagemaker_mxnet_container.training._start_zygote', lambda env=None: None)
+@patch('subprocess.Popen')
+@patch('sagemaker_mxnet_container.training._host_lookup')
+@patch('sagemaker_mxnet_container.training._verify_hosts')
+@patch('sagemaker_training.entry_point.run')
+def test_train_stops_started_roles_when_a_role_fails_to_start(
+        run_entry_point, verify_hosts, host_lookup, popen, start_telemetry,
+        distributed_training_env):
+    host_lookup.return_value = IP_ADDRESS
+    scheduler = MagicMock(pid=10)
+    scheduler.poll.return_value = None
+    popen.side_effect = [scheduler, OSError('cannot start the server')]
+    previous_handler = signal.getsignal(signal.SIGTERM)
+
+    distributed_training_env.current_host = SCHEDULER
+    with pytest.raises(OSError):
+        training.train(distributed_training_env)
+
+    scheduler.terminate.assert_called_once_with()
+    start_telemetry.return_value.stop.assert_called_once_with()
+    assert signal.getsignal(signal.SIGTERM) == previous_handler
+    run_entry_point.assert_not_called()
+
+
 @patch('sagemaker_training.entry_point.run')
 def test_train_for_single_machine(run_entry_point,
                                   single_machine_training_env):
@@ -150,6 +204,866 @@ def test_train_for_single_machine(run_entry_point,
                                        runner_type=runner.ProcessRunnerType)
 
 
+@patch('os.environ', {})
+@patch('sagemaker_mxnet_container.training._start_zygote', lambda env=None: None)
+@patch('subprocess.Popen')
+@patch('sagemaker_mxnet_container.training._host_lookup')
+@patch('sagemaker_mxnet_container.training._verify_hosts')
+@patch('sagemaker_training.entry_point.run')
+def test_train_with_multiple_servers_per_host(run_entry_point, verify_hosts, host_lookup, popen,
+                                              distributed_training_env):
+    host_lookup.return_value = IP_ADDRESS
+    popen.return_value.poll.return_value = None
+
+    distributed_training_env.current_host = 'host-2'
+    distributed_training_env.hyperparameters = {'_ps_servers_per_host': '2'}
+    training.train(distributed_training_env)
+
+    server_env = BASE_ENV_VARS.copy()
+    server_env.update({'DMLC_ROLE': 'server', 'DMLC_NUM_SERVER': str(len(MULTIPLE_HOST_LIST) * 2)})
+
+    calls = [call(MXNET_COMMAND, env=dict(server_env, PORT='8001', **_threads(1, 2))),
+             call(MXNET_COMMAND, env=dict(server_env, PORT='8002', **_threads(1, 2)))]
+    assert popen.call_args_list == calls
+
+    worker_env = dict(server_env, DMLC_ROLE='worker')
+    assert training.os.environ == worker_env
+
+
+@patch('os.environ', {})
+@patch('sagemaker_mxnet_container.training._RoleSupervisor')
+@patch('sagemaker_mxnet_container.training.Zygote')
+@patch('sagemaker_mxnet_container.training._host_lookup')
+@patch('sagemaker_mxnet_container.training._verify_hosts')
+@patch('sagemaker_training.entry_point.run')
+def test_train_forks_roles_from_zygote(run_entry_point, verify_hosts, host_lookup, zygote_class,
+                                       role_supervisor, distributed_training_env):
+    host_lookup.return_value = IP_ADDRESS
+    zygotes = {}
+
+    def start_zygote(env):
+        zygotes[env['MXNET_CPU_WORKER_NTHREADS']] = zygote = MagicMock()
+        return zygote
+
+    zygote_class.side_effect = start_zygote
+    supervisor = role_supervisor.return_value
+
+    distributed_training_env.current_host = SCHEDULER
+    training.train(distributed_training_env)
+
+    # OpenMP and MKL read the thread counts when the zygote imports MXNet, so every budget
+    # has its own zygote
+    assert sorted((kwargs['env'] for _, kwargs in zygote_class.call_args_list),
+                  key=lambda env: env['MXNET_CPU_WORKER_NTHREADS']) == [_threads(1, 1),
+                                                                        _threads(1, 2)]
+    scheduler_zygote, server_zygote = zygotes['1'], zygotes['2']
+    scheduler_env = dict(BASE_ENV_VARS, DMLC_ROLE='scheduler', **_threads(1, 1))
+    server_env = dict(BASE_ENV_VARS, DMLC_ROLE='server', **_threads(1, 2))
+    scheduler_zygote.spawn.assert_called_once_with('scheduler', scheduler_env, None)
+    server_zygote.spawn.assert_called_once_with('server', server_env, None)
+    scheduler_zygote.close.assert_called_once_with()
+    server_zygote.close.assert_called_once_with()
+
+    assert supervisor.add.call_args_list[2:] == [
+        call('scheduler', scheduler_zygote.spawn.return_value),
+        call('server', server_zygote.spawn.return_value)]
+    assert call('zygote', scheduler_zygote.process) in supervisor.add.call_args_list[:2]
+    assert call('zygote', server_zygote.process) in supervisor.add.call_args_list[:2]
+
+
+@patch('sagemaker_mxnet_container.training.Zygote')
+def test_start_zygote_failure(zygote_class):
+    zygote_class.return_value.start.side_effect = ZygoteError('no mxnet')
+
+    assert training._start_zygote() is None
+
+
+@patch('time.time')
+@patch('psutil.Process')
+def test_launch_timer(process, time):
+    process.return_value.create_time.return_value = 100.0
+    time.side_effect = [101.5, 102.0, 104.5, 105.0]
+
+    timer = training._LaunchTimer()
+    with timer.phase('verify_hosts'):
+        pass
+
+    assert timer.env_vars() == {'SM_MXNET_LAUNCH_START': '100.0',
+                                'SM_MXNET_ENTRY_POINT_START': '105.0'}
+    assert timer.timings == {'startup': 1.5, 'verify_hosts': 2.5, 'launcher': 5.0}
+
+
+@patch('sagemaker_mxnet_container.training._LaunchTimer.record')
+@patch('os.environ', {})
+@patch('sagemaker_mxnet_container.training._start_zygote', lambda env=None: None)
+@patch('subprocess.Popen')
+@patch('sagemaker_mxnet_container.training._host_lookup', lambda host: IP_ADDRESS)
+@patch('sagemaker_mxnet_container.training._verify_hosts')
+@patch('sagemaker_training.entry_point.run')
+def test_train_records_launch_timings(run_entry_point, verify_hosts, popen, record,
+                                      distributed_training_env):
+    popen.return_value.poll.return_value = None
+    distributed_training_env.current_host = SCHEDULER
+    env_vars = {}
+    distributed_training_env.to_env_vars.return_value = env_vars
+
+    training.train(distributed_training_env)
+
+    assert [args[0] for args, _ in record.call_args_list] == [
+        'startup', 'verify_hosts', 'ps_roles', 'launcher']
+    assert float(env_vars['SM_MXNET_ENTRY_POINT_START']) >= float(
+        env_vars['SM_MXNET_LAUNCH_START'])
+
+
+@patch('sagemaker_mxnet_container.training_utils.find_latest_checkpoint')
+@patch('sagemaker_training.entry_point.run')
+def test_train_resumes_from_checkpoint(run_entry_point, find_latest_checkpoint,
+                                       single_machine_training_env):
+    find_latest_checkpoint.return_value = ('/opt/ml/checkpoints/model', 3)
+    env_vars = {}
+    single_machine_training_env.to_env_vars.return_value = env_vars
+
+    training.train(single_machine_training_env)
+
+    find_latest_checkpoint.assert_called_once_with('/opt/ml/checkpoints')
+    env_vars.pop('SM_MXNET_LAUNCH_START')
+    env_vars.pop('SM_MXNET_ENTRY_POINT_START')
+    assert env_vars == dict({'SM_MXNET_CHECKPOINT_PREFIX': '/opt/ml/checkpoints/model',
+                             'SM_MXNET_CHECKPOINT_EPOCH': '3',
+                             'SM_MXNET_TERMINATION_GRACE_SECONDS': '60.0'},
+                            **_threads(NUM_CPUS, 1))
+
+
+@pytest.mark.parametrize('hyperparameters, expected', [
+    ({}, (SCHEDULER, MULTIPLE_HOST_LIST, MULTIPLE_HOST_LIST)),
+    ({'_ps_num_server_hosts': 1}, (SCHEDULER, [SCHEDULER], ['host-2', 'host-3'])),
+    ({'_ps_dedicated_scheduler': True}, (SCHEDULER, ['host-2', 'host-3'], ['host-2', 'host-3'])),
+    ({'_ps_dedicated_scheduler': True, '_ps_num_server_hosts': 1},
+     (SCHEDULER, ['host-2'], ['host-3'])),
+])
+def test_ps_layout(hyperparameters, expected, distributed_training_env):
+    distributed_training_env.hyperparameters = hyperparameters
+
+    layout = training._ps_layout(distributed_training_env)
+    assert (layout.scheduler_host, layout.server_hosts, layout.worker_hosts) == expected
+    assert layout.servers_per_host == 1
+
+
+def test_ps_layout_without_worker_hosts(distributed_training_env):
+    distributed_training_env.hyperparameters = {'_ps_num_server_hosts': 3}
+
+    with pytest.raises(ValueError):
+        training._ps_layout(distributed_training_env)
+
+
+@patch('os.environ', {})
+@patch('sagemaker_mxnet_container.training.ROLE_POLL_INTERVAL_SECONDS', 0.01)
+@patch('sagemaker_mxnet_container.training._start_zygote', lambda env=None: None)
+@patch('subprocess.Popen')
+@patch('sagemaker_mxnet_container.training._host_lookup')
+@patch('sagemaker_mxnet_container.training._verify_hosts')
+@patch('sagemaker_training.entry_point.run')
+def test_train_on_dedicated_server_host(run_entry_point, verify_hosts, host_lookup, popen,
+                                        distributed_training_env):
+    host_lookup.return_value = IP_ADDRESS
+    popen.return_value.poll.return_value = 0
+
+    distributed_training_env.current_host = 'host-2'
+    distributed_training_env.hyperparameters = {'_ps_dedicated_scheduler': True,
+                                                '_ps_num_server_hosts': 1}
+    training.train(distributed_training_env)
+
+    server_env = BASE_ENV_VARS.copy()
+    server_env.update({'DMLC_ROLE': 'server', 'DMLC_NUM_WORKER': '1', 'DMLC_NUM_SERVER': '1'},
+                      **_threads(1, NUM_CPUS))
+    popen.assert_called_once_with(MXNET_COMMAND, env=server_env)
+    popen.return_value.poll.assert_called_with()
+
+    run_entry_point.assert_not_called()
+
+
+@patch('os.environ', {})
+@patch('sagemaker_mxnet_container.training._start_zygote', lambda env=None: None)
+@patch('subprocess.Popen')
+@patch('sagemaker_mxnet_container.training._host_lookup')
+@patch('sagemaker_mxnet_container.training._verify_hosts')
+@patch('sagemaker_training.entry_point.run')
+def test_train_on_dedicated_worker_host(run_entry_point, verify_hosts, host_lookup, popen,
+                                        distributed_training_env):
+    host_lookup.return_value = IP_ADDRESS
+    popen.return_value.poll.return_value = None
+
+    distributed_training_env.current_host = 'host-3'
+    distributed_training_env.hyperparameters = {'_ps_num_server_hosts': 1}
+    env_vars = {'SM_HOSTS': json.dumps(MULTIPLE_HOST_LIST)}
+    distributed_training_env.to_env_vars.return_value = env_vars
+    training.train(distributed_training_env)
+
+    popen.assert_not_called()
+    assert training.os.environ['DMLC_NUM_WORKER'] == '2'
+    assert training.os.environ['DMLC_NUM_SERVER'] == '1'
+
+    assert json.loads(env_vars['SM_HOSTS']) == ['host-2', 'host-3']
+    run_entry_point.assert_called_with(uri=MODULE_DIR,
+                                       user_entry_point=MODULE_NAME,
+                                       args=distributed_training_env.to_cmd_args(),
+                                       env_vars=env_vars,
+                                       runner_type=runner.ProcessRunnerType)
+
+
+@pytest.mark.parametrize('value, num_cpus, expected', [
+    (None, 96, 1), ('3', 96, 3), ('auto', 96, 6), ('auto', 4, 1)])
+def test_servers_per_host(value, num_cpus, expected, distributed_training_env):
+    if value is not None:
+        distributed_training_env.hyperparameters = {'_ps_servers_per_host': value}
+    distributed_training_env.num_cpus = num_cpus
+
+    assert training._servers_per_host(distributed_training_env) == expected
+
+
+@patch('os.environ', {})
+@patch('sagemaker_mxnet_container.training._RoleSupervisor')
+@patch('sagemaker_mxnet_container.training._start_zygote', lambda env=None: None)
+@patch('subprocess.Popen')
+@patch('sagemaker_mxnet_container.training._host_lookup')
+@patch('sagemaker_mxnet_container.training._verify_hosts')
+@patch('sagemaker_training.entry_point.run')
+def test_train_reports_failed_role(run_entry_point, verify_hosts, host_lookup, popen,
+                                   role_supervisor, distributed_training_env):
+    supervisor = role_supervisor.return_value
+    supervisor.raise_for_failure.side_effect = RuntimeError('server failed')
+    run_entry_point.side_effect = ValueError('worker failed')
+
+    distributed_training_env.current_host = SCHEDULER
+    with pytest.raises(RuntimeError, match='server failed'):
+        training.train(distributed_training_env)
+
+    supervisor.stop.assert_called_once_with(graceful=False)
+
+
+def _python_process(code):
+    return subprocess.Popen([sys.executable, '-c', code])
+
+
+def test_role_supervisor_waits_for_roles():
+    supervisor = training._RoleSupervisor(poll_interval=0.01)
+    supervisor.add('scheduler', _python_process('pass'))
+    supervisor.add('server', _python_process('import time; time.sleep(0.2)'))
+    supervisor.start()
+
+    supervisor.wait()
+    supervisor.stop()
+
+    assert supervisor.failure is None
+
+
+def test_role_supervisor_terminates_workers_on_role_failure():
+    worker = _python_process('import time; time.sleep(60)')
+
+    supervisor = training._RoleSupervisor(poll_interval=0.01)
+    supervisor.add('server', _python_process('import sys; sys.exit(3)'))
+    supervisor.start()
+
+    with pytest.raises(RuntimeError, match='server .* exited with code 3'):
+        supervisor.wait()
+
+    # the supervisor reaps the worker, so only check that it is gone well before it would exit
+    worker.wait(timeout=10)
+    assert not psutil.pid_exists(worker.pid)
+    supervisor.stop()
+
+
+def test_role_supervisor_reports_killed_role():
+    supervisor = training._RoleSupervisor(poll_interval=0.01)
+    role = _python_process('import time; time.sleep(60)')
+    supervisor.add('scheduler', role)
+    supervisor.start()
+
+    role.kill()
+    with pytest.raises(RuntimeError, match='killed by signal 9'):
+        supervisor.wait()
+
+
+@patch('sagemaker_mxnet_container.training.ROLE_SHUTDOWN_TIMEOUT_SECONDS', 0.01)
+def test_role_supervisor_stop_terminates_hanging_roles():
+    scheduler = _python_process('import time; time.sleep(60)')
+    server = _python_process('import time; time.sleep(60)')
+
+    supervisor = training._RoleSupervisor()
+    supervisor.add('scheduler', scheduler)
+    supervisor.add('server', server)
+    supervisor.stop()
+
+    assert server.wait(timeout=10) == -signal.SIGTERM
+    assert scheduler.wait(timeout=10) == -signal.SIGTERM
+
+
+def test_role_supervisor_stop_after_failure_terminates_roles_at_once():
+    roles = [_python_process('import time; time.sleep(60)') for _ in range(3)]
+    supervisor = training._RoleSupervisor()
+    supervisor.add('scheduler', roles[0])
+    supervisor.add('server', roles[1])
+    supervisor.add('server', roles[2])
+
+    start = time.time()
+    supervisor.stop(graceful=False)
+
+    assert time.time() - start < 10
+    assert [role.wait(timeout=10) for role in roles] == [-signal.SIGTERM] * 3
+
+
+@patch('os.getpid', return_value=1)
+@patch('psutil.process_iter')
+@patch('sagemaker_mxnet_container.training._children')
+def test_role_supervisor_pids(children, process_iter, getpid):
+    descendants = {1: [10, 11, 20, 21, 30], 10: [11], 20: [21], 40: [41]}
+    children.side_effect = lambda pid: [MagicMock(pid=child) for child in descendants.get(pid, [])]
+    process_iter.return_value = [MagicMock(pid=40, info={'name': 'orted'}),
+                                 MagicMock(pid=50, info={'name': 'sshd'})]
+
+    supervisor = training._RoleSupervisor()
+    supervisor.add('zygote', MagicMock(pid=10))
+    supervisor.add('server', MagicMock(pid=20))
+
+    assert supervisor.pids() == {10: 'zygote', 11: 'zygote', 20: 'server', 21: 'server',
+                                 30: 'worker', 41: 'worker'}
+
+
+def test_role_supervisor_terminate(tmpdir):
+    marker = tmpdir.join('saved')
+    worker = _python_process(
+        'import signal, sys, time\n'
+        'def save(*_):\n'
+        '    open({!r}, "w").close()\n'
+        '    sys.exit(0)\n'
+        'signal.signal(signal.SIGTERM, save)\n'
+        'time.sleep(60)\n'.format(str(marker)))
+    server = _python_process('import time; time.sleep(60)')
+    time.sleep(0.5)
+
+    supervisor = training._RoleSupervisor(poll_interval=0.01)
+    supervisor.add('server', server)
+    supervisor.start()
+    supervisor.terminate(signal.SIGTERM, 10)
+
+    assert worker.wait(timeout=10) == 0
+    assert marker.check()
+    assert server.wait(timeout=10) == -signal.SIGTERM
+    # a role that the launcher signalled did not fail
+    supervisor.wait()
+
+
+@patch('psutil.process_iter')
+@patch('sagemaker_mxnet_container.training._children')
+def test_role_supervisor_workers(children, process_iter):
+    launcher = os.getpid()
+    mpirun = MagicMock(pid=10)
+    mpirun.name.return_value = 'mpirun'
+    descendants = {launcher: [mpirun, MagicMock(pid=20)], 10: [MagicMock(pid=11)],
+                   40: [MagicMock(pid=41)]}
+    children.side_effect = lambda pid, recursive: descendants.get(pid, [])
+    process_iter.return_value = [MagicMock(pid=40, info={'name': 'orted'})]
+
+    supervisor = training._RoleSupervisor()
+    supervisor.add('server', MagicMock(pid=20))
+
+    assert [worker.pid for worker in supervisor._workers()] == [11, 41]
+
+
+@patch('psutil.process_iter', return_value=[])
+@patch('sagemaker_mxnet_container.training._children')
+def test_role_supervisor_workers_skips_ssh_clients_of_mpirun(children, process_iter):
+    mpirun = MagicMock(pid=10)
+    mpirun.name.return_value = 'mpirun'
+    rank = MagicMock(pid=11)
+    rank.name.return_value = 'python'
+    ssh = MagicMock(pid=12)
+    ssh.name.return_value = 'ssh'
+    descendants = {os.getpid(): [mpirun], 10: [rank, ssh]}
+    children.side_effect = lambda pid, recursive: descendants.get(pid, [])
+
+    assert training._RoleSupervisor()._workers() == [rank]
+
+
+@patch('sagemaker_mxnet_container.training._RoleSupervisor.terminate')
+@patch('sagemaker_training.entry_point.run')
+def test_train_forwards_sigterm(run_entry_point, terminate, single_machine_training_env):
+    single_machine_training_env.hyperparameters = {'_termination_grace_seconds': 30}
+    single_machine_training_env.to_env_vars.return_value = {}
+    handler = signal.getsignal(signal.SIGTERM)
+
+    def preempt(**kwargs):
+        os.kill(os.getpid(), signal.SIGTERM)
+        for _ in range(100):
+            if terminate.called:
+                break
+            time.sleep(0.01)
+
+    run_entry_point.side_effect = preempt
+
+    training.train(single_machine_training_env)
+
+    terminate.assert_called_once_with(signal.SIGTERM, 30.0)
+    assert run_entry_point.call_args[1]['env_vars']['SM_MXNET_TERMINATION_GRACE_SECONDS'] == (
+        '30.0')
+    assert signal.getsignal(signal.SIGTERM) == handler
+
+
+@pytest.mark.parametrize('hyperparameters, interval', [
+    ({}, telemetry.SAMPLE_INTERVAL_SECONDS), ({'_telemetry_interval': '0.5'}, 0.5)])
+@patch('sagemaker_mxnet_container.telemetry.Sampler')
+def test_start_telemetry(sampler, hyperparameters, interval, single_machine_training_env,
+                         tmpdir):
+    single_machine_training_env.hyperparameters = hyperparameters
+    single_machine_training_env.current_host = 'algo-1'
+    supervisor = training._RoleSupervisor()
+
+    assert training._start_telemetry(single_machine_training_env, supervisor) == (
+        sampler.return_value)
+
+    sampler.assert_called_once_with(supervisor.pids, str(tmpdir.join('telemetry-algo-1.csv')),
+                                    interval)
+    sampler.return_value.start.assert_called_once_with()
+
+
+@patch('sagemaker_mxnet_container.telemetry.Sampler')
+def test_start_telemetry_disabled(sampler, single_machine_training_env):
+    single_machine_training_env.hyperparameters = {'_telemetry': 'False'}
+
+    assert training._start_telemetry(single_machine_training_env, None) is None
+    sampler.assert_not_called()
+
+
+@patch('sagemaker_mxnet_container.telemetry.Sampler')
+@patch('sagemaker_training.entry_point.run')
+def test_train_stops_telemetry(run_entry_point, sampler, single_machine_training_env):
+    run_entry_point.side_effect = ValueError('worker failed')
+
+    with pytest.raises(ValueError):
+        training.train(single_machine_training_env)
+
+    sampler.return_value.start.assert_called_once_with()
+    sampler.return_value.stop.assert_called_once_with()
+
+
+@pytest.fixture(autouse=True)
+def clear_host_ips():
+    training._host_ips.clear()
+    yield
+    training._host_ips.clear()
+
+
+@patch('socket.gethostbyname')
+def test_verify_hosts(gethostbyname):
+    gethostbyname.side_effect = lambda host: 'ip-{}'.format(host)
+
+    ips = training._verify_hosts(MULTIPLE_HOST_LIST)
+
+    assert ips == {host: 'ip-{}'.format(host) for host in MULTIPLE_HOST_LIST}
+    assert gethostbyname.call_count == len(MULTIPLE_HOST_LIST)
+
+
+@patch('socket.gethostbyname')
+def test_host_lookup_reads_verified_hosts(gethostbyname):
+    gethostbyname.return_value = IP_ADDRESS
+
+    training._verify_hosts(MULTIPLE_HOST_LIST)
+    gethostbyname.reset_mock()
+
+    assert training._host_lookup(SCHEDULER) == IP_ADDRESS
+    training._verify_hosts(MULTIPLE_HOST_LIST)
+    gethostbyname.assert_not_called()
+
+
+@patch('socket.gethostbyname')
+def test_host_lookup_retries_until_resolved(gethostbyname):
+    gethostbyname.side_effect = [socket.gaierror(), IP_ADDRESS]
+
+    assert training._host_lookup(SCHEDULER) == IP_ADDRESS
+    assert gethostbyname.call_count == 2
+
+
+@patch('socket.gethostbyname')
+def test_resolve_host_gives_up_after_deadline(gethostbyname):
+    gethostbyname.side_effect = socket.gaierror()
+
+    with pytest.raises(socket.gaierror):
+        training._resolve_host(SCHEDULER, time.time())
+
+
+@pytest.mark.parametrize('cpu_list, cpus', [
+    ('0-3,8-9,12\n', {0, 1, 2, 3, 8, 9, 12}), ('5', {5}), ('', set())])
+def test_parse_and_format_cpu_list(cpu_list, cpus):
+    assert training._parse_cpu_list(cpu_list) == cpus
+    assert training._format_cpu_list(cpus) == cpu_list.strip()
+
+
+@pytest.fixture
+def cpu_topology(tmpdir):
+    """Two NUMA nodes with four cores of two hyperthreads each, like a small EC2 instance."""
+    nodes = {0: '0-3,8-11', 1: '4-7,12-15'}
+    for node, cpu_list in nodes.items():
+        tmpdir.join('node', 'node{}'.format(node), 'cpulist').write(cpu_list, ensure=True)
+    for cpu in range(16):
+        tmpdir.join('cpu', 'cpu{}'.format(cpu), 'topology', 'thread_siblings_list').write(
+            '{},{}'.format(cpu % 8, cpu % 8 + 8), ensure=True)
+
+    with patch('sagemaker_mxnet_container.training.CPU_TOPOLOGY_PATH', str(tmpdir)), \
+            patch('os.sched_getaffinity', return_value=set(range(16)), create=True):
+        yield
+
+
+def test_cpu_topology(cpu_topology):
+    assert training._cpu_topology() == [[[0, 8], [1, 9], [2, 10], [3, 11]],
+                                        [[4, 12], [5, 13], [6, 14], [7, 15]]]
+
+
+@patch('os.sched_getaffinity', return_value={0, 1, 2}, create=True)
+@patch('sagemaker_mxnet_container.training.CPU_TOPOLOGY_PATH', '/nonexistent')
+def test_cpu_topology_without_sysfs(sched_getaffinity):
+    assert training._cpu_topology() == [[[0], [1], [2]]]
+
+
+@pytest.mark.parametrize('current_host, hyperparameters, expected', [
+    (SCHEDULER, {}, None),
+    (SCHEDULER, {'_cpu_affinity': 'True'},
+     ([5, 6, 7, 13, 14, 15], [0, 1, 2, 3, 4, 8, 9, 10, 11, 12])),
+    ('host-2', {'_cpu_affinity': 'True'},
+     ([6, 7, 14, 15], [0, 1, 2, 3, 4, 5, 8, 9, 10, 11, 12, 13])),
+    (SCHEDULER, {'_cpu_affinity': 'True', '_ps_reserved_cores': '1'},
+     ([7, 15], [0, 1, 2, 3, 4, 5, 6, 8, 9, 10, 11, 12, 13, 14])),
+    (SCHEDULER, {'_cpu_affinity': 'True', '_ps_reserved_cores': '20'},
+     ([1, 2, 3, 4, 5, 6, 7, 9, 10, 11, 12, 13, 14, 15], [0, 8])),
+    (SCHEDULER, {'_cpu_affinity': 'True', '_ps_num_server_hosts': 1}, (list(range(16)), [])),
+])
+def test_cpu_layout(current_host, hyperparameters, expected, cpu_topology,
+                    distributed_training_env):
+    distributed_training_env.current_host = current_host
+    distributed_training_env.hyperparameters = hyperparameters
+    layout = training._ps_layout(distributed_training_env)
+    num_ps_roles = len(training._ps_roles(distributed_training_env, layout, DEFAULT_PORT))
+
+    cpu_layout = training._cpu_layout(distributed_training_env, layout, num_ps_roles)
+
+    assert cpu_layout == (training.CPULayout(*expected) if expected else None)
+
+
+@patch('os.environ', {})
+@patch('os.sched_setaffinity', create=True)
+@patch('sagemaker_mxnet_container.training._start_zygote', lambda env=None: None)
+@patch('subprocess.Popen')
+@patch('sagemaker_mxnet_container.training._host_lookup')
+@patch('sagemaker_mxnet_container.training._verify_hosts')
+@patch('sagemaker_training.entry_point.run')
+def test_train_pins_roles_and_workers(run_entry_point, verify_hosts, host_lookup, popen,
+                                      sched_setaffinity, cpu_topology, distributed_training_env):
+    host_lookup.return_value = IP_ADDRESS
+    popen.return_value.poll.return_value = None
+    popen.return_value.pid = 42
+
+    distributed_training_env.current_host = 'host-2'
+    distributed_training_env.hyperparameters = {'_cpu_affinity': 'True'}
+    training.train(distributed_training_env)
+
+    # the server is pinned in the child, before exec
+    assert sched_setaffinity.call_args_list == [call(0, [0, 1, 2, 3, 4, 5, 8, 9, 10, 11, 12, 13])]
+    popen.call_args[1]['preexec_fn']()
+    assert sched_setaffinity.call_args == call(0, [6, 7, 14, 15])
+    assert 'extra_opts' not in run_entry_point.call_args[1]
+
+
+@patch('sagemaker_training.entry_point.run')
+def test_train_horovod_with_cpu_affinity(run_module, cpu_topology, single_machine_training_env):
+    single_machine_training_env.additional_framework_parameters = {
+        training.LAUNCH_MPI_ENV_NAME: True,
+        'sagemaker_mpi_custom_mpi_options': '-x FOO',
+    }
+    single_machine_training_env.hyperparameters = {'_cpu_affinity': 'True'}
+
+    training.train(single_machine_training_env)
+
+    assert run_module.call_args[1]['extra_opts'] == {
+        'sagemaker_mpi_custom_mpi_options': '-x FOO -map-by numa -bind-to numa'}
+
+
+@pytest.mark.parametrize('processes_per_host, expected', [
+    (2, '-x FOO -map-by ppr:2:node:PE=2 -bind-to core'),
+    (5, '-x FOO -map-by ppr:5:node:PE=1 -bind-to core'),
+    (6, '-x FOO'),
+])
+def test_mpi_binding_options_with_reserved_cores(processes_per_host, expected, cpu_topology,
+                                                 distributed_training_env):
+    distributed_training_env.current_host = 'host-2'
+    distributed_training_env.additional_framework_parameters.update({
+        training.LAUNCH_MPI_ENV_NAME: True,
+        'sagemaker_mpi_num_of_processes_per_host': processes_per_host,
+        'sagemaker_mpi_custom_mpi_options': '-x FOO',
+    })
+    layout = training._ps_layout(distributed_training_env)
+    # host-2 keeps six cores for its workers, but the scheduler host only five
+    cpu_layout = training.CPULayout([6, 7, 14, 15], [0, 1, 2, 3, 4, 5, 8, 9, 10, 11, 12, 13])
+
+    assert training._mpi_binding_options(distributed_training_env, layout, cpu_layout) == {
+        'sagemaker_mpi_custom_mpi_options': expected}
+
+
+@patch('os.environ', {'MKL_NUM_THREADS': '3'})
+@pytest.mark.parametrize('framework_parameters, hyperparameters, cpu_layout, worker', [
+    ({}, {}, None, dict(_threads(8, 1), MKL_NUM_THREADS='3')),
+    ({training.LAUNCH_MPI_ENV_NAME: True, 'sagemaker_mpi_num_of_processes_per_host': 3}, {},
+     None, dict(_threads(2, 1), MKL_NUM_THREADS='3')),
+    ({}, {'_omp_num_threads': 6, '_mkl_num_threads': 6}, None, _threads(6, 1)),
+    ({}, {}, training.CPULayout([6, 7], [0, 1, 2, 3, 4, 5]),
+     dict(_threads(6, 1), MKL_NUM_THREADS='3')),
+])
+def test_thread_env_vars_without_ps(framework_parameters, hyperparameters, cpu_layout, worker,
+                                    single_machine_training_env):
+    single_machine_training_env.additional_framework_parameters = framework_parameters
+    single_machine_training_env.hyperparameters = hyperparameters
+
+    budgets = training._thread_env_vars(single_machine_training_env, None, [], cpu_layout)
+
+    assert budgets['worker'] == worker
+
+
+@patch('os.environ', {})
+def test_thread_env_vars_with_ps_roles(distributed_training_env):
+    distributed_training_env.current_host = SCHEDULER
+    distributed_training_env.hyperparameters = {'_ps_servers_per_host': 2}
+    layout = training._ps_layout(distributed_training_env)
+    roles = training._ps_roles(distributed_training_env, layout, DEFAULT_PORT)
+
+    budgets = training._thread_env_vars(distributed_training_env, layout, roles,
+                                        training.CPULayout([5, 6, 7], [0, 1, 2, 3, 4]))
+
+    assert budgets == {'worker': _threads(5, 1), 'server': _threads(1, 1),
+                       'scheduler': _threads(1, 1)}
+
+
+@pytest.fixture
+def autotune_env(single_machine_training_env, tmpdir):
+    single_machine_training_env.additional_framework_parameters = {
+        training.LAUNCH_MPI_ENV_NAME: True,
+    }
+    single_machine_training_env.hyperparameters = {
+        '_horovod_autotune': True, '_checkpoint_dir': str(tmpdir.join('checkpoints'))}
+    single_machine_training_env.hosts = SINGLE_HOST_LIST
+    single_machine_training_env.is_master = True
+    return single_machine_training_env
+
+
+AUTOTUNE_KEY = 'hosts-1-processes-1-model-100mb'
+HOROVOD_SETTINGS = {'HOROVOD_FUSION_THRESHOLD': '33554432', 'HOROVOD_CYCLE_TIME': '5.0'}
+
+
+AUTOTUNE_LOG = '''cycle_time_ms,tensor_fusion_threshold,score
+5,32,3000
+1,8,1000
+'''
+
+
+def test_horovod_env_vars_autotunes_and_caches(autotune_env, tmpdir):
+    env_vars = training._horovod_env_vars(autotune_env)
+
+    assert env_vars['HOROVOD_AUTOTUNE'] == '1'
+    with open(env_vars['HOROVOD_AUTOTUNE_LOG'], 'w') as f:
+        f.write(AUTOTUNE_LOG)
+    training._record_horovod_autotune(autotune_env, env_vars)
+
+    cache = tmpdir.join('checkpoints', training.HOROVOD_AUTOTUNE_CACHE)
+    assert json.loads(cache.read()) == {AUTOTUNE_KEY: {'env': HOROVOD_SETTINGS}}
+    assert training._horovod_env_vars(autotune_env) == HOROVOD_SETTINGS
+
+
+def test_horovod_env_vars_with_cache_path(autotune_env, tmpdir):
+    cache = tmpdir.join('autotune.json')
+    cache.write(json.dumps({'hosts-1-processes-1-model-12.5mb': {'env': HOROVOD_SETTINGS}}))
+    autotune_env.hyperparameters.update({'_horovod_autotune_cache': str(cache),
+                                         '_horovod_autotune_model_mb': '12.5'})
+
+    assert training._horovod_env_vars(autotune_env) == HOROVOD_SETTINGS
+
+
+def test_record_horovod_autotune_without_samples(autotune_env, tmpdir):
+    env_vars = training._horovod_env_vars(autotune_env)
+
+    training._record_horovod_autotune(autotune_env, env_vars)
+
+    assert not tmpdir.join('checkpoints', training.HOROVOD_AUTOTUNE_CACHE).exists()
+
+
+@pytest.mark.parametrize('autotune, is_master', [(False, True), ('True', False)])
+def test_horovod_env_vars_disabled(autotune, is_master, autotune_env, tmpdir):
+    autotune_env.hyperparameters['_horovod_autotune'] = autotune
+    autotune_env.is_master = is_master
+
+    assert training._horovod_env_vars(autotune_env) == {}
+    training._record_horovod_autotune(autotune_env, {})
+    assert not tmpdir.join('checkpoints', training.HOROVOD_AUTOTUNE_CACHE).exists()
+
+
+@patch('sagemaker_training.entry_point.run')
+def test_train_horovod_with_autotune(run_module, autotune_env, tmpdir):
+    autotune_env.to_env_vars.side_effect = dict
+
+    def run(**kwargs):
+        if 'HOROVOD_AUTOTUNE_LOG' in kwargs['env_vars']:
+            with open(kwargs['env_vars']['HOROVOD_AUTOTUNE_LOG'], 'w') as f:
+                f.write(AUTOTUNE_LOG)
+
+    run_module.side_effect = run
+    training.train(autotune_env)
+    assert run_module.call_args[1]['env_vars']['HOROVOD_AUTOTUNE'] == '1'
+
+    training.train(autotune_env)
+    env_vars = run_module.call_args[1]['env_vars']
+    assert env_vars['HOROVOD_FUSION_THRESHOLD'] == '33554432'
+    assert env_vars['HOROVOD_CYCLE_TIME'] == '5.0'
+    assert 'HOROVOD_AUTOTUNE' not in env_vars
+
+
+@pytest.fixture
+def elastic_env(distributed_training_env):
+    distributed_training_env.additional_framework_parameters = {
+        training.LAUNCH_MPI_ENV_NAME: True,
+        'sagemaker_mpi_num_of_processes_per_host': 2,
+    }
+    distributed_training_env.hyperparameters = {'_horovod_elastic': True,
+                                                '_horovod_elastic_min_hosts': 2}
+    distributed_training_env.is_master = True
+    distributed_training_env.master_hostname = SCHEDULER
+    distributed_training_env.network_interface_name = 'eth0'
+    distributed_training_env.to_cmd_args.return_value = ['--epochs', '3']
+    return distributed_training_env
+
+
+@patch('sagemaker_mxnet_container.training.mpi._start_sshd_daemon')
+def test_horovod_elastic_runner(start_sshd, elastic_env, tmpdir):
+    elastic_env.user_entry_point = 'train.py'
+
+    elastic_runner = training._horovod_elastic_runner(elastic_env, {'FOO': '1'})
+    elastic_runner._setup()
+    with patch('sagemaker_training.environment.code_dir', str(tmpdir)):
+        command = elastic_runner._create_command()
+
+    script = command[command.index('--host-discovery-script') + 1]
+    assert command == ['horovodrun', '--num-proc', '4', '--min-np', '4', '--max-np', '6',
+                       '--host-discovery-script', script, '--network-interface', 'eth0',
+                       sys.executable, 'train.py', '--epochs', '3']
+    with open(script) as f:
+        assert '--hosts host-1,host-2,host-3 --slots 2' in f.read()
+    start_sshd.assert_called_once_with()
+
+
+@pytest.mark.parametrize('min_hosts', [0, 4])
+def test_horovod_elastic_runner_with_invalid_min_hosts(min_hosts, elastic_env):
+    elastic_env.hyperparameters['_horovod_elastic_min_hosts'] = min_hosts
+
+    with pytest.raises(ValueError):
+        training._horovod_elastic_runner(elastic_env, {})
+
+
+def test_elastic_runner_with_sagemaker_training_3():
+    def init(self, user_entry_point, args, env_vars):
+        self._user_entry_point = user_entry_point
+
+    with patch.object(training.ProcessRunner, '__init__', init):
+        elastic_runner = training._ElasticRunner(['horovodrun'], 'train.py', [], {}, 2)
+
+    assert elastic_runner._user_entry_point == 'train.py'
+    assert elastic_runner._horovodrun_command == ['horovodrun']
+
+
+@patch('time.sleep')
+@patch('sagemaker_mxnet_container.horovod_elastic.can_connect')
+@patch('sagemaker_mxnet_container.training.mpi._start_sshd_daemon')
+@patch('sagemaker_mxnet_container.training.mpi._write_env_vars_to_file')
+def test_elastic_worker_runner(write_env_vars, start_sshd, can_connect, sleep, elastic_env):
+    elastic_env.is_master = False
+    # the master is not up yet, then up for two checks, then gone
+    can_connect.side_effect = [False, True, True, True, False]
+    start_sshd.side_effect = lambda: write_env_vars.assert_called_once_with()
+
+    worker_runner = training._horovod_elastic_runner(elastic_env, {})
+    worker_runner.run()
+
+    start_sshd.assert_called_once_with()
+    can_connect.assert_called_with(SCHEDULER)
+    assert can_connect.call_count == 5
+
+
+@patch('sagemaker_training.entry_point.run')
+def test_train_horovod_elastic(run_module, elastic_env):
+    elastic_env.to_env_vars.return_value = {}
+
+    training.train(elastic_env)
+
+    runner_type = run_module.call_args[1]['runner_type']
+    assert isinstance(runner_type, training._ElasticRunner)
+    assert 'extra_opts' not in run_module.call_args[1]
+
+
+def test_profiler_env_vars(single_machine_training_env, tmpdir):
+    single_machine_training_env.hyperparameters = {'_profile_start_step': 100,
+                                                   '_profile_mode': 'imperative'}
+
+    assert training._profiler_env_vars(single_machine_training_env) == {
+        'SM_MXNET_PROFILE_START_STEP': '100', 'SM_MXNET_PROFILE_NUM_STEPS': '10',
+        'SM_MXNET_PROFILE_MODE': 'imperative', 'SM_MXNET_PROFILE_DIR': str(tmpdir.join('profile'))}
+
+
+def test_profiler_env_vars_without_profiling(single_machine_training_env):
+    assert training._profiler_env_vars(single_machine_training_env) == {}
+
+
+@patch('sagemaker_training.entry_point.run')
+def test_train_with_invalid_profile_mode(run_entry_point, single_machine_training_env):
+    single_machine_training_env.hyperparameters = {'_profile_start_step': 0,
+                                                   '_profile_mode': 'everything'}
+
+    with pytest.raises(ValueError, match='_profile_mode'):
+        training.train(single_machine_training_env)
+    run_entry_point.assert_not_called()
+
+
+@pytest.mark.parametrize('hyperparameters, match', [
+    ({'_profile_start_step': 0, '_profile_num_steps': 0}, '_profile_num_steps'),
+    ({'_profile_start_step': 0, '_profile_num_steps': -1}, '_profile_num_steps'),
+    ({'_profile_start_step': -5}, '_profile_start_step'),
+])
+@patch('sagemaker_training.entry_point.run')
+def test_train_with_invalid_profile_window(run_entry_point, hyperparameters, match,
+                                           single_machine_training_env):
+    single_machine_training_env.hyperparameters = hyperparameters
+
+    with pytest.raises(ValueError, match=match):
+        training.train(single_machine_training_env)
+    run_entry_point.assert_not_called()
+
+
+@patch('os.environ', {})
+@patch('sagemaker_mxnet_container.training._start_zygote', lambda env=None: None)
+@patch('subprocess.Popen')
+@patch('sagemaker_mxnet_container.training._host_lookup', lambda host: IP_ADDRESS)
+@patch('sagemaker_mxnet_container.training._verify_hosts')
+@patch('sagemaker_training.entry_point.run')
+def test_train_exports_kvstore_bigarray_bound(run_entry_point, verify_hosts, popen,
+                                              distributed_training_env):
+    popen.return_value.poll.return_value = None
+    distributed_training_env.current_host = SCHEDULER
+    distributed_training_env.hyperparameters = {'_kvstore_bigarray_bound': 250000}
+
+    training.train(distributed_training_env)
+
+    for role_call in popen.call_args_list:
+        assert role_call[1]['env']['MXNET_KVSTORE_BIGARRAY_BOUND'] == '250000'
+    assert training.os.environ['MXNET_KVSTORE_BIGARRAY_BOUND'] == '250000'
+
+
+def test_kvstore_env_vars_without_bound(distributed_training_env):
+    assert training._kvstore_env_vars(distributed_training_env) == {}
+
+
 @patch('sagemaker_mxnet_container.training.train')
 @patch('sagemaker_training.environment.Environment')
 def test_main(env, train, single_machine_training_env):
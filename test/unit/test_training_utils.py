@@ -12,10 +12,20 @@
 # language governing permissions and limitations under the License.
 from __future__ import absolute_import
 
+import gzip
+import io
 import json
+import logging
 import os
+import signal
+import struct
+import sys
+import threading
+import time
 
-from mock import Mock, mock_open, patch
+from mock import call, MagicMock, Mock, mock_open, patch
+import numpy as np
+import pytest
 
 from sagemaker_mxnet_container import training_utils
 
@@ -24,9 +34,10 @@ WORKER_HOST = 'host-2'
 MODEL_DIR = 'foo/model'
 
 
+@patch('os.rename')
 @patch('json.dump')
 @patch('os.environ', {'SM_CURRENT_HOST': SCHEDULER_HOST, 'SM_HOSTS': json.dumps([SCHEDULER_HOST])})
-def test_save_single_machine(json_dump):
+def test_save_single_machine(json_dump, rename):
     model = Mock()
     model.data_shapes = []
 
@@ -34,12 +45,15 @@ def test_save_single_machine(json_dump):
         training_utils.save(MODEL_DIR, model)
 
     model.symbol.save.assert_called_with(os.path.join(MODEL_DIR, 'model-symbol.json'))
-    model.save_params.assert_called_with(os.path.join(MODEL_DIR, 'model-0000.params'))
+    model.save_params.assert_called_with(os.path.join(MODEL_DIR, '.model-0000.params.tmp'))
+    rename.assert_called_once_with(os.path.join(MODEL_DIR, '.model-0000.params.tmp'),
+                                   os.path.join(MODEL_DIR, 'model-0000.params'))
     json_dump.assert_called_once
 
 
+@patch('os.rename')
 @patch('json.dump')
-def test_save_distributed(json_dump):
+def test_save_distributed(json_dump, rename):
     model = Mock()
     model.data_shapes = []
 
@@ -48,7 +62,9 @@ def test_save_distributed(json_dump):
                             hosts=[SCHEDULER_HOST, WORKER_HOST])
 
     model.symbol.save.assert_called_with(os.path.join(MODEL_DIR, 'model-symbol.json'))
-    model.save_params.assert_called_with(os.path.join(MODEL_DIR, 'model-0000.params'))
+    model.save_params.assert_called_with(os.path.join(MODEL_DIR, '.model-0000.params.tmp'))
+    rename.assert_called_once_with(os.path.join(MODEL_DIR, '.model-0000.params.tmp'),
+                                   os.path.join(MODEL_DIR, 'model-0000.params'))
     json_dump.assert_called_once
 
 
@@ -67,3 +83,1262 @@ def test_single_machine_scheduler_host():
 
 def test_distributed_scheduler_host():
     assert training_utils.scheduler_host([SCHEDULER_HOST, WORKER_HOST]) == SCHEDULER_HOST
+
+
+def _module_with_params():
+    model = Mock()
+    model.data_shapes = [Mock(shape=(2, 3))]
+    model.data_shapes[0].name = 'data'
+    model.symbol.tojson.return_value = '{"nodes": []}'
+    model.get_params.return_value = ({'fc_weight': Mock()}, {'bn_moving_mean': Mock()})
+    return model
+
+
+def _fake_nd_save(path, params):
+    with open(path, 'w') as f:
+        json.dump(sorted(params), f)
+
+
+@patch.dict('sys.modules', {'mxnet': MagicMock()})
+def test_save_asynchronous(tmpdir):
+    sys.modules['mxnet'].nd.save.side_effect = _fake_nd_save
+    model = _module_with_params()
+
+    future = training_utils.save(str(tmpdir), model, current_host=SCHEDULER_HOST,
+                                 hosts=[SCHEDULER_HOST], asynchronous=True)
+    future.result(timeout=10)
+
+    model.save_params.assert_not_called()
+    assert sorted(os.listdir(str(tmpdir))) == ['model-0000.params', 'model-shapes.json',
+                                               'model-symbol.json']
+    params = json.loads(tmpdir.join('model-0000.params').read())
+    assert params == ['arg:fc_weight', 'aux:bn_moving_mean']
+    shapes = json.loads(tmpdir.join('model-shapes.json').read())
+    assert shapes == [{'name': 'data', 'shape': [2, 3]}]
+    assert tmpdir.join('model-symbol.json').read() == '{"nodes": []}'
+
+    arg_params = model.get_params.return_value[0]
+    arg_params['fc_weight'].copy.assert_called_once_with()
+
+
+@patch.dict('sys.modules', {'mxnet': MagicMock()})
+def test_save_asynchronous_failure_leaves_no_partial_file(tmpdir):
+    def failing_save(path, params):
+        open(path, 'w').close()
+        raise IOError('disk full')
+
+    sys.modules['mxnet'].nd.save.side_effect = failing_save
+
+    future = training_utils.save(str(tmpdir), _module_with_params(),
+                                 current_host=SCHEDULER_HOST, hosts=[SCHEDULER_HOST],
+                                 asynchronous=True)
+    with pytest.raises(IOError):
+        future.result(timeout=10)
+
+    assert os.listdir(str(tmpdir)) == []
+
+
+@pytest.mark.parametrize('sharded', [False, True])
+def test_save_asynchronous_snapshots_once_a_slot_is_free(sharded):
+    events = []
+    slots = Mock()
+    slots.acquire.side_effect = lambda: events.append('acquire')
+    slots.release.side_effect = lambda: events.append('release')
+
+    def snapshot(model):
+        events.append('snapshot')
+        raise MemoryError()
+
+    with patch('sagemaker_mxnet_container.training_utils._save_slots', slots), \
+            patch('sagemaker_mxnet_container.training_utils._snapshot_params', snapshot):
+        with pytest.raises(MemoryError):
+            training_utils.save(MODEL_DIR, _module_with_params(), current_host=SCHEDULER_HOST,
+                                hosts=[SCHEDULER_HOST], asynchronous=True, sharded=sharded)
+
+    assert events == ['acquire', 'snapshot', 'release']
+
+
+def test_save_asynchronous_for_non_scheduler_host():
+    model = Mock()
+    assert training_utils.save(MODEL_DIR, model, current_host=WORKER_HOST,
+                               hosts=[SCHEDULER_HOST, WORKER_HOST], asynchronous=True) is None
+    model.get_params.assert_not_called()
+
+
+def _param(size):
+    param = Mock(size=size)
+    param.copy.return_value = param
+    return param
+
+
+def test_assign_shards_balances_by_size():
+    params = {'arg:a': _param(100), 'arg:b': _param(60), 'arg:c': _param(50), 'aux:d': _param(10)}
+
+    assignment = training_utils._assign_shards(params, 2)
+
+    assert assignment == {'arg:a': 0, 'arg:b': 1, 'arg:c': 1, 'aux:d': 0}
+
+
+@pytest.mark.parametrize('asynchronous', [False, True])
+@patch.dict('sys.modules', {'mxnet': MagicMock()})
+def test_save_sharded(asynchronous, tmpdir):
+    saved = {}
+
+    def nd_save(path, params):
+        saved[os.path.basename(path)] = sorted(params)
+        open(path, 'w').close()
+
+    sys.modules['mxnet'].nd.save.side_effect = nd_save
+    model = _module_with_params()
+    model.get_params.return_value = ({'fc_weight': _param(100), 'fc_bias': _param(10)},
+                                     {'bn_moving_mean': _param(20)})
+    hosts = [SCHEDULER_HOST, WORKER_HOST]
+
+    for host in hosts:
+        future = training_utils.save(str(tmpdir), model, current_host=host, hosts=hosts,
+                                     asynchronous=asynchronous, sharded=True)
+        if future:
+            future.result(timeout=10)
+
+    assert saved == {'.model-shard-00000-of-00002.params.tmp': ['arg:fc_weight'],
+                     '.model-shard-00001-of-00002.params.tmp': ['arg:fc_bias',
+                                                                'aux:bn_moving_mean']}
+    assert sorted(os.listdir(str(tmpdir))) == ['model-shapes.json',
+                                               'model-shard-00000-of-00002.params',
+                                               'model-shard-00001-of-00002.params',
+                                               'model-shards.json',
+                                               'model-symbol.json']
+
+    manifest = json.loads(tmpdir.join('model-shards.json').read())
+    assert manifest['params'] == {'arg:fc_weight': 'model-shard-00000-of-00002.params',
+                                  'arg:fc_bias': 'model-shard-00001-of-00002.params',
+                                  'aux:bn_moving_mean': 'model-shard-00001-of-00002.params'}
+
+
+@patch.dict('sys.modules', {'mxnet': MagicMock()})
+def test_load_sharded(tmpdir):
+    mx = sys.modules['mxnet']
+    shards = {'model-shard-00000-of-00002.params': {'arg:fc_weight': 1},
+              'model-shard-00001-of-00002.params': {'arg:fc_bias': 2, 'aux:bn_moving_mean': 3}}
+    mx.nd.load.side_effect = lambda path: shards[os.path.basename(path)]
+    manifest = {'shards': sorted(shards),
+                'params': {name: path for path, params in shards.items() for name in params}}
+    tmpdir.join('model-shards.json').write(json.dumps(manifest))
+
+    symbol, arg_params, aux_params = training_utils.load_sharded(str(tmpdir))
+
+    assert symbol == mx.sym.load.return_value
+    mx.sym.load.assert_called_once_with(str(tmpdir.join('model-symbol.json')))
+    assert arg_params == {'fc_weight': 1, 'fc_bias': 2}
+    assert aux_params == {'bn_moving_mean': 3}
+
+
+@patch.dict('sys.modules', {'mxnet': MagicMock()})
+def test_load_sharded_with_missing_shard(tmpdir):
+    sys.modules['mxnet'].nd.load.return_value = {'arg:fc_weight': 1}
+    manifest = {'shards': ['model-shard-00000-of-00001.params'],
+                'params': {'arg:fc_weight': 'model-shard-00000-of-00001.params',
+                           'arg:fc_bias': 'model-shard-00000-of-00001.params'}}
+    tmpdir.join('model-shards.json').write(json.dumps(manifest))
+
+    with pytest.raises(ValueError, match='arg:fc_bias'):
+        training_utils.load_sharded(str(tmpdir))
+
+
+class _NDArray(object):
+    def __init__(self, array):
+        self.array = array
+        self.size = array.size
+
+    def asnumpy(self):
+        return self.array
+
+    def copy(self):
+        return _NDArray(self.array.copy())
+
+
+def _compact_model():
+    model = _module_with_params()
+    model.get_params.return_value = (
+        {'fc_weight': _NDArray(np.linspace(-2, 2, 1000, dtype=np.float32).reshape(10, 100)),
+         'embedding_index': _NDArray(np.arange(10, dtype=np.int32))},
+        {'bn_moving_var': _NDArray(np.ones(100, dtype=np.float32))})
+    return model
+
+
+@pytest.mark.parametrize('dtype, compress, tolerance', [
+    (None, True, 0), (None, False, 0), ('float16', True, 1e-3), ('bfloat16', False, 1e-2)])
+@patch.dict('sys.modules', {'mxnet': MagicMock()})
+def test_save_and_load_compact(dtype, compress, tolerance, tmpdir):
+    mx = sys.modules['mxnet']
+    mx.nd.array.side_effect = lambda array, dtype: array
+    model = _compact_model()
+
+    training_utils.save(str(tmpdir), model, current_host=SCHEDULER_HOST, hosts=[SCHEDULER_HOST],
+                        compact=True, dtype=dtype, compress=compress)
+
+    model.save_params.assert_not_called()
+    assert sorted(os.listdir(str(tmpdir))) == ['model-0000.compact', 'model-compact.json',
+                                               'model-shapes.json', 'model-symbol.json']
+
+    symbol, arg_params, aux_params = training_utils.load_compact(str(tmpdir))
+    expected_args, expected_aux = model.get_params.return_value
+
+    assert symbol == mx.sym.load.return_value
+    assert sorted(arg_params) == sorted(expected_args)
+    for name, value in arg_params.items():
+        assert value.dtype == expected_args[name].array.dtype
+        np.testing.assert_allclose(value, expected_args[name].array, atol=tolerance)
+    np.testing.assert_array_equal(aux_params['bn_moving_var'], np.ones(100))
+
+
+@patch.dict('sys.modules', {'mxnet': MagicMock()})
+def test_save_compact_asynchronous(tmpdir):
+    future = training_utils.save(str(tmpdir), _compact_model(), current_host=SCHEDULER_HOST,
+                                 hosts=[SCHEDULER_HOST], asynchronous=True, compact=True,
+                                 dtype='float16')
+    future.result(timeout=10)
+
+    manifest = json.loads(tmpdir.join('model-compact.json').read())
+    assert manifest['tensors']['arg:fc_weight']['stored_dtype'] == 'float16'
+    assert manifest['tensors']['arg:embedding_index']['stored_dtype'] == 'int32'
+
+
+@patch.dict('sys.modules', {'mxnet': MagicMock()})
+def test_load_compact_detects_partial_write(tmpdir):
+    training_utils.save(str(tmpdir), _compact_model(), current_host=SCHEDULER_HOST,
+                        hosts=[SCHEDULER_HOST], compact=True)
+    with open(str(tmpdir.join('model-0000.compact')), 'r+b') as f:
+        f.truncate(100)
+
+    with pytest.raises(ValueError, match='Checksum mismatch'):
+        training_utils.load_compact(str(tmpdir))
+
+
+def test_bfloat16_rounds_to_nearest_even():
+    values = np.array([1.0, 1.00390625, 1.01171875, -2.5, np.inf], dtype=np.float32)
+
+    rounded = training_utils._from_bfloat16(training_utils._to_bfloat16(values))
+
+    np.testing.assert_array_equal(rounded, [1.0, 1.0, 1.015625, -2.5, np.inf])
+
+
+def test_bfloat16_keeps_nans():
+    # NaNs whose payload would round up into the exponent, or into the sign
+    values = np.array([0x7FFFFFFF, 0xFFFFFFFF, 0x7F80FFFF, 0x7FC00000],
+                      dtype=np.uint32).view(np.float32)
+
+    converted = training_utils._to_bfloat16(values)
+
+    assert converted.tolist() == [0x7FFF, 0xFFFF, 0x7FC0, 0x7FC0]
+    assert np.isnan(training_utils._from_bfloat16(converted)).all()
+
+
+@pytest.mark.parametrize('kwargs', [{'compact': True, 'sharded': True},
+                                    {'compact': True, 'dtype': 'int8'}])
+def test_save_compact_with_invalid_options(kwargs):
+    with pytest.raises(ValueError):
+        training_utils.save(MODEL_DIR, Mock(), current_host=SCHEDULER_HOST,
+                            hosts=[SCHEDULER_HOST], **kwargs)
+
+
+def _training_graph(head_op, head_attrs=None):
+    nodes = [{'op': 'null', 'name': 'data', 'inputs': []},
+             {'op': 'Dropout', 'name': 'dropout', 'attrs': {'p': '0.5'}, 'inputs': [[0, 0, 0]]},
+             {'op': 'null', 'name': 'fc_weight', 'inputs': []},
+             {'op': 'FullyConnected', 'name': 'fc', 'attrs': {'num_hidden': '10'},
+              'inputs': [[1, 0, 0], [2, 0, 0]]},
+             {'op': 'Dropout', 'name': 'dropout2', 'attrs': {'p': '0.5'}, 'inputs': [[3, 0, 0]]},
+             {'op': 'null', 'name': 'label', 'inputs': []},
+             {'op': head_op, 'name': 'output', 'attrs': head_attrs or {},
+              'inputs': [[4, 0, 0], [5, 0, 0]]}]
+    return json.dumps({'nodes': nodes, 'arg_nodes': [0, 2, 5], 'heads': [[6, 0, 0]]})
+
+
+@pytest.mark.parametrize('head_op, head_attrs, ndim, expected_op, expected_attrs', [
+    ('SoftmaxOutput', None, 2, 'softmax', {'axis': '-1'}),
+    ('SoftmaxOutput', {'multi_output': 'True'}, 4, 'softmax', {'axis': '1'}),
+    ('SoftmaxOutput', {'preserve_shape': 'true'}, 3, 'softmax', {'axis': '-1'}),
+    ('LogisticRegressionOutput', None, 2, 'sigmoid', {})])
+def test_strip_training_ops(head_op, head_attrs, ndim, expected_op, expected_attrs):
+    graph = json.loads(training_utils._strip_training_ops(_training_graph(head_op, head_attrs),
+                                                          [ndim]))
+
+    nodes = graph['nodes']
+    assert nodes[3]['inputs'] == [[0, 0, 0], [2, 0, 0]]
+    assert graph['heads'] == [[6, 0, 0]]
+    assert nodes[6]['op'] == expected_op
+    assert nodes[6]['attrs'] == expected_attrs
+    assert nodes[6]['inputs'] == [[3, 0, 0]]
+
+
+def test_strip_training_ops_regression_head():
+    graph = json.loads(training_utils._strip_training_ops(
+        _training_graph('LinearRegressionOutput'), [2]))
+
+    assert graph['heads'] == [[3, 0, 0]]
+
+
+def test_strip_training_ops_keeps_flattening_softmax():
+    symbol_json = _training_graph('SoftmaxOutput')
+    graph = json.loads(training_utils._strip_training_ops(symbol_json, [4]))
+
+    assert graph['nodes'][6]['op'] == 'SoftmaxOutput'
+    assert graph['nodes'][6]['inputs'] == [[3, 0, 0], [5, 0, 0]]
+
+
+def _mock_mxnet_for_inference():
+    mxnet = MagicMock()
+    mxnet.nd.save.side_effect = _fake_nd_save
+    symbol = mxnet.sym.load_json.return_value
+    symbol.infer_shape_partial.return_value = ([], [(2, 10)], [])
+    symbol.list_arguments.return_value = ['data', 'fc_weight']
+    symbol.get_backend_symbol.return_value.save.side_effect = \
+        lambda path: _write_file(path, 'fused')
+    return mxnet
+
+
+def _write_file(path, content):
+    with open(path, 'w') as f:
+        f.write(content)
+
+
+@pytest.mark.parametrize('asynchronous', [False, True])
+def test_save_exports_inference_model(asynchronous, tmpdir):
+    mxnet = _mock_mxnet_for_inference()
+    model = _module_with_params()
+    model.symbol.tojson.return_value = _training_graph('SoftmaxOutput')
+    model.save_params.side_effect = lambda path: _write_file(path, 'params')
+    model.symbol.save.side_effect = lambda path: _write_file(path, 'symbol')
+
+    with patch.dict('sys.modules', {'mxnet': mxnet}):
+        future = training_utils.save(str(tmpdir), model, current_host=SCHEDULER_HOST,
+                                     hosts=[SCHEDULER_HOST], asynchronous=asynchronous,
+                                     inference_backend='MKLDNN')
+        if future:
+            future.result(timeout=10)
+
+    assert sorted(os.listdir(str(tmpdir))) == [
+        'model-0000.params', 'model-inference-0000.params', 'model-inference-symbol.json',
+        'model-shapes.json', 'model-symbol.json']
+    assert tmpdir.join('model-inference-symbol.json').read() == 'fused'
+    params = json.loads(tmpdir.join('model-inference-0000.params').read())
+    assert params == ['arg:fc_weight', 'aux:bn_moving_mean']
+
+    graph = json.loads(mxnet.sym.load_json.call_args[0][0])
+    assert graph['nodes'][6]['op'] == 'softmax'
+    mxnet.sym.load_json.return_value.infer_shape_partial.assert_called_once_with(data=(2, 3))
+    mxnet.sym.load_json.return_value.get_backend_symbol.assert_called_once_with('MKLDNN')
+
+
+def test_save_exports_int8_model(tmpdir):
+    mxnet = _mock_mxnet_for_inference()
+    quantization = MagicMock()
+    qsym = MagicMock()
+    qsym.get_backend_symbol.return_value.save.side_effect = \
+        lambda path: _write_file(path, 'int8')
+    quantization.quantize_model.return_value = (qsym, {'fc_weight_quantize': Mock()},
+                                                {'bn_moving_mean': Mock()})
+    calib_data = Mock()
+    model = _module_with_params()
+    model.symbol.tojson.return_value = _training_graph('SoftmaxOutput')
+    model.save_params.side_effect = lambda path: _write_file(path, 'params')
+
+    with patch.dict('sys.modules', {'mxnet': mxnet, 'mxnet.contrib.quantization': quantization}):
+        training_utils.save(str(tmpdir), model, current_host=SCHEDULER_HOST,
+                            hosts=[SCHEDULER_HOST], inference_backend='MKLDNN',
+                            calib_data=calib_data)
+
+    assert tmpdir.join('model-int8-symbol.json').read() == 'int8'
+    params = json.loads(tmpdir.join('model-int8-0000.params').read())
+    assert params == ['arg:fc_weight_quantize', 'aux:bn_moving_mean']
+
+    calib_data.reset.assert_called_once_with()
+    mxnet.sym.load_json.return_value.get_backend_symbol.assert_any_call('MKLDNN_QUANTIZE')
+    qsym.get_backend_symbol.assert_called_once_with('MKLDNN_QUANTIZE')
+    _, kwargs = quantization.quantize_model.call_args
+    assert kwargs['data_names'] == ['data']
+    assert kwargs['label_names'] == []
+    assert kwargs['calib_data'] is calib_data
+
+
+@pytest.mark.parametrize('kwargs', [{'inference_backend': 'MKLDNN', 'sharded': True},
+                                    {'calib_data': Mock()},
+                                    {'inference_backend': 'TensorRT', 'calib_data': Mock()}])
+def test_save_inference_with_invalid_options(kwargs):
+    with pytest.raises(ValueError):
+        training_utils.save(MODEL_DIR, Mock(), current_host=SCHEDULER_HOST,
+                            hosts=[SCHEDULER_HOST], **kwargs)
+
+
+def _write_checkpoint_files(directory, *names):
+    for name in names:
+        directory.join(name).write('x')
+
+
+def test_find_latest_checkpoint(tmpdir):
+    _write_checkpoint_files(tmpdir, 'model-symbol.json', 'model-shapes.json', 'model-0001.params',
+                            'model-0012.params', '.model-0013.params.tmp')
+
+    prefix, epoch = training_utils.find_latest_checkpoint(str(tmpdir))
+
+    assert prefix == os.path.join(str(tmpdir), 'model')
+    assert epoch == 12
+
+
+@pytest.mark.parametrize('interrupted_epoch, expected', [
+    (2, ('interrupted', 2)), (1, ('', 2)), (3, ('interrupted', 3))])
+def test_find_latest_checkpoint_after_interruption(interrupted_epoch, expected, tmpdir):
+    _write_checkpoint_files(tmpdir, 'model-symbol.json', 'model-shapes.json', 'model-0002.params')
+    interrupted = tmpdir.mkdir('interrupted')
+    _write_checkpoint_files(interrupted, 'model-symbol.json', 'model-shapes.json',
+                            'model-{:04d}.params'.format(interrupted_epoch))
+
+    prefix, epoch = training_utils.find_latest_checkpoint(str(tmpdir))
+
+    assert (prefix, epoch) == (os.path.join(str(tmpdir), expected[0], 'model'), expected[1])
+
+
+@pytest.mark.parametrize('names', [
+    [], ['model-0001.params', 'model-shapes.json'], ['model-symbol.json', 'model-shapes.json']])
+def test_find_latest_checkpoint_without_complete_checkpoint(names, tmpdir):
+    _write_checkpoint_files(tmpdir, *names)
+    tmpdir.join('model-0002.params').ensure()
+
+    assert training_utils.find_latest_checkpoint(str(tmpdir)) is None
+
+
+def test_find_latest_checkpoint_without_directory(tmpdir):
+    assert training_utils.find_latest_checkpoint(str(tmpdir.join('missing'))) is None
+
+
+def test_save_epoch(tmpdir):
+    model = Mock()
+    model.data_shapes = []
+    model.save_params.side_effect = lambda path: _write_file(path, 'params')
+
+    training_utils.save(str(tmpdir), model, current_host=SCHEDULER_HOST,
+                        hosts=[SCHEDULER_HOST], epoch=7)
+
+    model.save_params.assert_called_once_with(str(tmpdir.join('.model-0007.params.tmp')))
+    assert tmpdir.join('model-0007.params').read() == 'params'
+
+
+def test_save_epoch_interrupted_leaves_no_checkpoint(tmpdir):
+    def failing_save(path):
+        _write_file(path, 'par')
+        raise IOError('disk full')
+
+    _write_checkpoint_files(tmpdir, 'model-symbol.json', 'model-shapes.json', 'model-0001.params')
+    model = Mock()
+    model.data_shapes = []
+    model.save_params.side_effect = failing_save
+
+    with pytest.raises(IOError):
+        training_utils.save(str(tmpdir), model, current_host=SCHEDULER_HOST,
+                            hosts=[SCHEDULER_HOST], epoch=2)
+
+    assert training_utils.find_latest_checkpoint(str(tmpdir))[1] == 1
+
+
+class _MXNetError(Exception):
+    pass
+
+
+@patch.dict('sys.modules', {'mxnet': MagicMock()})
+@patch.dict('os.environ', {'SM_MXNET_CHECKPOINT_PREFIX': '/opt/ml/checkpoints/model',
+                           'SM_MXNET_CHECKPOINT_EPOCH': '4'})
+def test_restore():
+    mx = sys.modules['mxnet']
+    mx.model.load_checkpoint.return_value = (Mock(), {'fc_weight': 1}, {'bn_moving_mean': 2})
+    module = Mock()
+
+    assert training_utils.restore(module) == 4
+
+    mx.model.load_checkpoint.assert_called_once_with('/opt/ml/checkpoints/model', 4)
+    module.set_params.assert_called_once_with({'fc_weight': 1}, {'bn_moving_mean': 2})
+
+
+@pytest.mark.parametrize('loadable, epoch', [({1, 3}, 3), ({1}, 1), (set(), 0)])
+def test_restore_falls_back_to_earlier_checkpoint(loadable, epoch, tmpdir):
+    _write_checkpoint_files(tmpdir, 'model-symbol.json', 'model-shapes.json', 'model-0001.params',
+                            'model-0003.params', 'model-0004.params')
+    mx = MagicMock()
+    mx.base.MXNetError = _MXNetError
+
+    def load_checkpoint(prefix, checkpoint_epoch):
+        if checkpoint_epoch not in loadable:
+            raise _MXNetError('truncated')
+        return Mock(), {'fc_weight': checkpoint_epoch}, {}
+
+    mx.model.load_checkpoint.side_effect = load_checkpoint
+    module = Mock()
+    environ = {'SM_MXNET_CHECKPOINT_PREFIX': str(tmpdir.join('model')),
+               'SM_MXNET_CHECKPOINT_EPOCH': '4'}
+
+    with patch.dict('sys.modules', {'mxnet': mx}), patch.dict('os.environ', environ):
+        assert training_utils.restore(module) == epoch
+
+    if epoch:
+        module.set_params.assert_called_once_with({'fc_weight': epoch}, {})
+    else:
+        module.set_params.assert_not_called()
+
+
+def test_restore_falls_back_from_interrupted_checkpoint(tmpdir):
+    _write_checkpoint_files(tmpdir, 'model-symbol.json', 'model-shapes.json', 'model-0003.params')
+    interrupted = tmpdir.mkdir('interrupted')
+    _write_checkpoint_files(interrupted, 'model-symbol.json', 'model-shapes.json',
+                            'model-0003.params')
+    mx = MagicMock()
+    mx.base.MXNetError = _MXNetError
+    mx.model.load_checkpoint.side_effect = [_MXNetError('truncated'), (Mock(), {}, {})]
+    environ = {'SM_MXNET_CHECKPOINT_PREFIX': str(interrupted.join('model')),
+               'SM_MXNET_CHECKPOINT_EPOCH': '3'}
+
+    with patch.dict('sys.modules', {'mxnet': mx}), patch.dict('os.environ', environ):
+        assert training_utils.restore(Mock()) == 3
+
+    assert mx.model.load_checkpoint.call_args_list == [
+        call(str(interrupted.join('model')), 3), call(str(tmpdir.join('model')), 3)]
+
+
+@patch.dict('os.environ', {}, clear=True)
+def test_restore_without_checkpoint():
+    module = Mock()
+
+    assert training_utils.restore(module) == 0
+    module.set_params.assert_not_called()
+
+
+@pytest.fixture
+def sigterm_handler():
+    handler = signal.getsignal(signal.SIGTERM)
+    yield
+    signal.signal(signal.SIGTERM, handler)
+
+
+def _wait_for_exits(exit_mock, count):
+    for _ in range(500):
+        if exit_mock.call_count >= count:
+            return
+        time.sleep(0.01)
+
+
+@patch('os._exit')
+@patch('sagemaker_mxnet_container.training_utils.save')
+def test_emergency_save_handler_at_batch_end(save, exit_mock, sigterm_handler, tmpdir):
+    module = Mock()
+    callback = training_utils.emergency_save_handler(str(tmpdir), module, grace_seconds=0.2,
+                                                     hosts=['algo-1'])
+    assert signal.getsignal(signal.SIGTERM) == callback.handle
+
+    callback(Mock(epoch=2))
+    save.assert_not_called()
+
+    callback.handle(signal.SIGTERM, None)
+    callback(Mock(epoch=3))
+
+    # the checkpoint of the last completed epoch is kept
+    save.assert_called_once_with(str(tmpdir.join('interrupted')), module, asynchronous=True,
+                                 epoch=3, hosts=['algo-1'])
+    save.return_value.result.assert_called_once_with()
+    # the watchdog gives up once the grace period is over, had the process not exited yet
+    _wait_for_exits(exit_mock, 2)
+    assert exit_mock.call_args_list == [call(0), call(1)]
+
+
+@patch('os._exit')
+@patch('sagemaker_mxnet_container.training_utils.save', return_value=None)
+def test_emergency_save_handler_mid_batch(save, exit_mock, sigterm_handler, tmpdir):
+    module = Mock()
+    callback = training_utils.emergency_save_handler(str(tmpdir), module, grace_seconds=0.2)
+    callback(Mock(epoch=1))
+
+    callback.handle(signal.SIGTERM, None)
+
+    _wait_for_exits(exit_mock, 2)
+    save.assert_called_once_with(str(tmpdir.join('interrupted')), module, asynchronous=True,
+                                 epoch=1)
+    assert exit_mock.call_args_list == [call(0), call(1)]
+
+
+@patch.dict('os.environ', {'SM_MXNET_TERMINATION_GRACE_SECONDS': '90.0'})
+def test_emergency_save_handler_grace_from_launcher(sigterm_handler):
+    callback = training_utils.emergency_save_handler('/opt/ml/checkpoints', Mock())
+
+    assert callback._grace_seconds == 90.0
+
+
+def test_launch_timing_lines():
+    lines = training_utils.launch_timing_lines('verify_hosts', 1.23456, host='algo-1')
+
+    assert json.loads(lines[0]) == {'event': 'launch_timing', 'phase': 'verify_hosts',
+                                    'seconds': 1.235, 'host': 'algo-1'}
+    assert lines[1] == 'launch_verify_hosts_seconds=1.235;'
+
+
+@pytest.fixture
+def first_step():
+    training_utils._first_step_reported.clear()
+    yield
+    training_utils._first_step_reported.clear()
+
+
+@patch('time.time', return_value=110.0)
+@patch('psutil.Process')
+@patch.dict('os.environ', {'SM_MXNET_LAUNCH_START': '90.0', 'SM_MXNET_ENTRY_POINT_START': '98.0',
+                           'SM_CURRENT_HOST': 'algo-1'})
+def test_report_first_step(process, time, first_step, caplog):
+    process.return_value.create_time.return_value = 100.0
+
+    with caplog.at_level(logging.INFO):
+        assert training_utils.report_first_step(Mock()) == {
+            'entry_point': 2.0, 'script': 10.0, 'first_step': 20.0}
+        assert training_utils.report_first_step(Mock()) is None
+
+    assert len(caplog.messages) == 6
+    assert caplog.messages[-1] == 'launch_first_step_seconds=20.000;'
+
+
+@patch('time.time', return_value=110.0)
+@patch('psutil.Process')
+@patch.dict('os.environ', {}, clear=True)
+def test_report_first_step_outside_the_launcher(process, time, first_step):
+    process.return_value.create_time.return_value = 100.0
+
+    assert training_utils.report_first_step() == {'script': 10.0}
+
+
+@patch.dict('os.environ', {}, clear=True)
+def test_profiler_callback_without_profiling():
+    with patch.dict('sys.modules', {'mxnet': MagicMock()}):
+        callback = training_utils.profiler_callback()
+        callback(Mock())
+
+        sys.modules['mxnet'].profiler.set_state.assert_not_called()
+
+
+def test_profiler_window_that_never_started(tmpdir):
+    mx = MagicMock()
+    window = training_utils._ProfilerWindow(-2, 3, 'all', str(tmpdir))
+
+    with patch.dict('sys.modules', {'mxnet': mx}):
+        for _ in range(3):
+            window(Mock())
+
+    mx.profiler.set_state.assert_not_called()
+    mx.profiler.dump.assert_not_called()
+    assert tmpdir.listdir() == []
+
+
+@pytest.mark.parametrize('start_step', [0, 2])
+def test_profiler_callback(start_step, tmpdir):
+    mx = MagicMock()
+    mx.profiler.dumps.return_value = 'summary'
+    profile_dir = tmpdir.join('profile')
+    environ = {'SM_MXNET_PROFILE_START_STEP': str(start_step), 'SM_MXNET_PROFILE_NUM_STEPS': '3',
+               'SM_MXNET_PROFILE_MODE': 'symbolic', 'SM_MXNET_PROFILE_DIR': str(profile_dir),
+               'SM_CURRENT_HOST': 'algo-1'}
+
+    with patch.dict('os.environ', environ), patch.dict('sys.modules', {'mxnet': mx}):
+        callback = training_utils.profiler_callback()
+        for step in range(start_step):
+            callback(Mock())
+        mx.profiler.set_state.assert_called_once_with('run')
+
+        for step in range(3):
+            callback(Mock())
+        callback(Mock())
+
+    prefix = str(profile_dir.join('profile-algo-1-{}'.format(os.getpid())))
+    mx.profiler.set_config.assert_called_once_with(filename=prefix + '.json',
+                                                   aggregate_stats=True, profile_symbolic=True)
+    assert mx.profiler.set_state.call_args_list == [call('run'), call('stop')]
+    mx.profiler.dump.assert_called_once_with()
+    assert profile_dir.join('profile-algo-1-{}-summary.txt'.format(os.getpid())).read() == (
+        'summary')
+
+
+def _job_env(hosts, num_gpus=0, hyperparameters=None, framework_params=None):
+    return Mock(hosts=hosts, num_gpus=num_gpus, hyperparameters=hyperparameters or {},
+                additional_framework_parameters=framework_params or {})
+
+
+@pytest.mark.parametrize('env, kvstore_type', [
+    (_job_env(['algo-1']), 'local'),
+    (_job_env(['algo-1'], num_gpus=4), 'device'),
+    (_job_env(['algo-1', 'algo-2']), 'dist_sync'),
+    (_job_env(['algo-1', 'algo-2'], num_gpus=1), 'dist_device_sync'),
+    (_job_env(['algo-1', 'algo-2'], hyperparameters={'_kvstore': 'dist_async'}), 'dist_async'),
+])
+@patch.dict('os.environ', {}, clear=True)
+def test_create_kvstore(env, kvstore_type):
+    mx = MagicMock()
+
+    with patch.dict('sys.modules', {'mxnet': mx}):
+        assert training_utils.create_kvstore(env) == mx.kv.create.return_value
+    mx.kv.create.assert_called_once_with(kvstore_type)
+
+
+@pytest.mark.parametrize('env, environ, kvstore_type', [
+    (_job_env(['algo-2'], framework_params={'sagemaker_parameter_server_enabled': True}), {},
+     'dist_sync'),
+    (_job_env(['algo-2'], num_gpus=1), {'DMLC_ROLE': 'worker'}, 'dist_device_sync'),
+])
+def test_create_kvstore_single_worker_host_with_parameter_server(env, environ, kvstore_type):
+    mx = MagicMock()
+
+    with patch.dict('sys.modules', {'mxnet': mx}), patch.dict('os.environ', environ, clear=True):
+        training_utils.create_kvstore(env)
+    mx.kv.create.assert_called_once_with(kvstore_type)
+
+
+@patch.dict('sys.modules', {'mxnet': MagicMock()})
+def test_create_kvstore_under_mpi():
+    env = _job_env(['algo-1', 'algo-2'], framework_params={'sagemaker_mpi_enabled': True})
+
+    assert training_utils.create_kvstore(env) is None
+    sys.modules['mxnet'].kv.create.assert_not_called()
+
+
+@pytest.mark.parametrize('kvstore_type, compressed', [('dist_sync', True), ('local', False)])
+@patch.dict('os.environ', {}, clear=True)
+def test_create_kvstore_with_gradient_compression(kvstore_type, compressed):
+    mx = MagicMock()
+    mx.kv.create.return_value.type = kvstore_type
+    env = _job_env(['algo-1'], hyperparameters={'_gradient_compression': '2bit',
+                                                '_gradient_compression_threshold': '1'})
+
+    with patch.dict('sys.modules', {'mxnet': mx}):
+        kv = training_utils.create_kvstore(env)
+
+    if compressed:
+        kv.set_gradient_compression.assert_called_once_with({'type': '2bit', 'threshold': 1.0})
+    else:
+        kv.set_gradient_compression.assert_not_called()
+
+
+@pytest.mark.parametrize('environ, bound', [
+    ({'DMLC_NUM_SERVER': '4'}, str(training_utils.MIN_BIGARRAY_BOUND)),
+    ({'DMLC_NUM_SERVER': '2'}, '125062'),
+    ({'DMLC_NUM_SERVER': '2', 'MXNET_KVSTORE_BIGARRAY_BOUND': '7'}, '7'),
+    ({'DMLC_NUM_SERVER': '1'}, None),
+])
+def test_create_kvstore_bigarray_bound(environ, bound):
+    params = {'fc1_weight': np.zeros((1000, 1000)), 'fc1_bias': np.zeros(500)}
+    if environ['DMLC_NUM_SERVER'] == '4':
+        params = [(100, 100)]
+
+    with patch.dict('sys.modules', {'mxnet': MagicMock()}), \
+            patch.dict('os.environ', environ, clear=True):
+        training_utils.create_kvstore(_job_env(['algo-1', 'algo-2']), params)
+        assert os.environ.get('MXNET_KVSTORE_BIGARRAY_BOUND') == bound
+
+
+@patch.dict('os.environ', {'SM_HOSTS': '["algo-1", "algo-2"]', 'SM_NUM_GPUS': '0',
+                           'SM_HPS': '{"_kvstore": "dist_async"}', 'SM_FRAMEWORK_PARAMS': '{}'})
+@patch.dict('sys.modules', {'mxnet': MagicMock()})
+def test_create_kvstore_from_environment():
+    training_utils.create_kvstore()
+
+    sys.modules['mxnet'].kv.create.assert_called_once_with('dist_async')
+
+
+class _ObjectState(object):
+    """Like horovod.common.elastic.ObjectState, without the host update notifications."""
+
+    def __init__(self, bcast_object, get_rank, **kwargs):
+        self._bcast_object = bcast_object
+        self._saved_state = kwargs
+        self._set_attrs()
+
+    def commit(self):
+        self.save()
+
+    def save(self):
+        self._saved_state = {attr: getattr(self, attr) for attr in self._saved_state}
+
+    def restore(self):
+        self._set_attrs()
+
+    def sync(self):
+        self._saved_state = self._bcast_object(self._saved_state)
+        self._set_attrs()
+
+    def _set_attrs(self):
+        for attr, value in self._saved_state.items():
+            setattr(self, attr, value)
+
+
+@pytest.fixture
+def horovod():
+    hvd = MagicMock()
+    hvd.broadcast_object.side_effect = lambda obj: obj
+    horovod = MagicMock()
+    horovod.mxnet = hvd
+    horovod.common.elastic.ObjectState = _ObjectState
+    with patch.dict('sys.modules', {'horovod': horovod, 'horovod.mxnet': hvd,
+                                    'horovod.common': horovod.common,
+                                    'horovod.common.elastic': horovod.common.elastic}):
+        yield horovod
+
+
+def test_elastic_state_with_module(horovod):
+    hvd = horovod.mxnet
+    module = Mock(spec=['get_params', 'set_params'])
+    weight = Mock()
+    module.get_params.return_value = ({'fc_weight': weight}, {})
+
+    state = training_utils.elastic_state(module, batch=0)
+    assert (state.epoch, state.batch) == (0, 0)
+
+    state.epoch_end_callback(4, None, None, None)
+    state.batch = 10
+    state.restore()
+
+    assert (state.epoch, state.batch) == (5, 0)
+    module.set_params.assert_called_with({'fc_weight': weight.copy.return_value}, {})
+
+    state.sync()
+    hvd.broadcast_parameters.assert_has_calls([call({'fc_weight': weight}, root_rank=0),
+                                               call({}, root_rank=0)])
+    module.set_params.assert_called_with({'fc_weight': weight}, {})
+
+
+def test_elastic_state_with_gluon_block(horovod):
+    hvd = horovod.mxnet
+    mx = MagicMock()
+    param = Mock()
+    block = Mock()
+    block.collect_params.return_value = {'dense0_weight': param}
+
+    with patch.dict('sys.modules', {'mxnet': mx}):
+        state = training_utils.elastic_state(block)
+        state.restore()
+        state.sync()
+
+    param.data.return_value.copyto.assert_called_with(mx.cpu())
+    param.set_data.assert_called_once_with(param.data.return_value.copyto.return_value)
+    hvd.broadcast_parameters.assert_called_once_with(block.collect_params.return_value,
+                                                     root_rank=0)
+
+
+def test_elastic_run(horovod):
+    hvd = horovod.mxnet
+
+    def train(state):
+        pass
+
+    assert training_utils.elastic_run(train) == horovod.common.elastic.run_fn.return_value
+    func, reset = horovod.common.elastic.run_fn.call_args[0]
+    assert func is train
+
+    reset()
+    hvd.shutdown.assert_called_once_with()
+    hvd.init.assert_called_once_with()
+
+
+class _DataIter(object):
+    def __init__(self, batch_size=0):
+        self.batch_size = batch_size
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return self.next()
+
+
+def _mock_mxnet_io():
+    mx = sys.modules['mxnet']
+    mx.io.DataIter = _DataIter
+    mx.io.DataBatch = lambda **kwargs: kwargs
+    mx.nd.from_numpy.side_effect = lambda array, zero_copy: array
+    return mx
+
+
+def _write_npy(tmpdir, num_samples=10):
+    data = tmpdir.join('data.npy')
+    label = tmpdir.join('label.npy')
+    np.save(str(data), np.arange(num_samples * 2, dtype='float32').reshape(num_samples, 2))
+    np.save(str(label), np.arange(num_samples, dtype='int64'))
+    return str(data), str(label)
+
+
+@pytest.mark.parametrize('current_host, labels', [
+    ('host-1', [[0, 1], [0, 2]]), ('host-2', [[3, 4], [3, 5]]), ('host-3', [[6, 7], [8, 9]])])
+@patch.dict('sys.modules', {'mxnet': MagicMock()})
+def test_numpy_shard_iter(current_host, labels, tmpdir):
+    mx = _mock_mxnet_io()
+    data, label = _write_npy(tmpdir)
+
+    data_iter = training_utils.numpy_shard_iter(data, label, batch_size=2,
+                                                hosts=['host-1', 'host-2', 'host-3'],
+                                                current_host=current_host)
+    batches = list(data_iter)
+
+    assert [batch['label'][0].tolist() for batch in batches] == labels
+    assert [batch['data'][0].dtype for batch in batches] == [np.float32, np.float32]
+    assert batches[-1]['pad'] == (1 if current_host != 'host-3' else 0)
+    mx.io.DataDesc.assert_any_call('data', (2, 2), np.float32)
+
+
+@patch.dict('sys.modules', {'mxnet': MagicMock()})
+@patch('os.environ', {'SM_CURRENT_HOST': WORKER_HOST,
+                      'SM_HOSTS': json.dumps([SCHEDULER_HOST, WORKER_HOST])})
+def test_numpy_shard_iter_sequential_batches_are_views(tmpdir):
+    _mock_mxnet_io()
+    data, _ = _write_npy(tmpdir)
+
+    data_iter = training_utils.numpy_shard_iter({'x': data}, batch_size=5)
+    batch = next(data_iter)
+
+    assert isinstance(batch['data'][0].base, np.memmap)
+    assert batch['data'][0][:, 0].tolist() == [10, 12, 14, 16, 18]
+    assert batch['label'] == []
+    with pytest.raises(StopIteration):
+        next(data_iter)
+
+
+@pytest.mark.parametrize('prefetch', [0, 2])
+@patch.dict('sys.modules', {'mxnet': MagicMock()})
+def test_numpy_shard_iter_shuffle(prefetch, tmpdir):
+    _mock_mxnet_io()
+    data, label = _write_npy(tmpdir, num_samples=20)
+
+    data_iter = training_utils.numpy_shard_iter(data, label, batch_size=3, hosts=['host-1'],
+                                                current_host='host-1', shuffle=True,
+                                                last_batch_handle='discard', prefetch=prefetch)
+    epochs = []
+    for _ in range(2):
+        data_iter.reset()
+        epochs.append([batch['label'][0].tolist() for batch in data_iter])
+
+    assert [len(epoch) for epoch in epochs] == [6, 6]
+    assert epochs[0] != epochs[1]
+    for epoch in epochs:
+        samples = sum(epoch, [])
+        assert len(set(samples)) == 18
+        assert all(batch == sorted(batch) for batch in epoch)
+
+
+@patch.dict('sys.modules', {'mxnet': MagicMock()})
+def test_numpy_shard_iter_reset_during_prefetch(tmpdir):
+    _mock_mxnet_io()
+    data, label = _write_npy(tmpdir, num_samples=20)
+
+    data_iter = training_utils.numpy_shard_iter(data, label, batch_size=2, hosts=['host-1'],
+                                                current_host='host-1', prefetch=1)
+    next(data_iter)
+    data_iter.reset()
+
+    assert next(data_iter)['label'][0].tolist() == [0, 1]
+    assert len(list(data_iter)) == 9
+
+
+@pytest.mark.parametrize('kwargs', [
+    {'last_batch_handle': 'roll_over'}, {'batch_size': 6}])
+@patch.dict('sys.modules', {'mxnet': MagicMock()})
+def test_numpy_shard_iter_with_invalid_options(kwargs, tmpdir):
+    _mock_mxnet_io()
+    data, label = _write_npy(tmpdir)
+
+    with pytest.raises(ValueError):
+        training_utils.numpy_shard_iter(data, label, hosts=['host-1', 'host-2'],
+                                        current_host='host-1', **kwargs)
+
+
+@patch.dict('sys.modules', {'mxnet': MagicMock()})
+def test_numpy_shard_iter_with_mismatched_arrays(tmpdir):
+    _mock_mxnet_io()
+    data, _ = _write_npy(tmpdir)
+    _, label = _write_npy(tmpdir.mkdir('other'), num_samples=8)
+
+    with pytest.raises(ValueError):
+        training_utils.numpy_shard_iter(data, label, hosts=['host-1'], current_host='host-1')
+
+
+def _record(label, payload):
+    # the layout of mx.recordio.pack(IRHeader(0, label, 0, 0), payload) in a RecordIO file
+    record = struct.pack('<IfQQ', 0, label, 0, 0) + payload
+    parts = record.split(struct.pack('<I', training_utils.RECORDIO_MAGIC))
+    flags = [0] if len(parts) == 1 else [1] + [2] * (len(parts) - 2) + [3]
+    return b''.join(struct.pack('<II', training_utils.RECORDIO_MAGIC, flag << 29 | len(part))
+                    + part + b'\0' * (-len(part) % 4) for flag, part in zip(flags, parts))
+
+
+def _write_fifo(path, num_records):
+    os.mkfifo(path)
+    try:
+        with open(path, 'wb') as fifo:
+            for i in range(num_records):
+                fifo.write(_record(i % 2, np.full(3, i, dtype='float32').tobytes()))
+    except BrokenPipeError:
+        # the reader abandoned the epoch, SageMaker moves on to the next FIFO as well
+        pass
+
+
+@pytest.fixture
+def pipe_channel(tmpdir):
+    writers = []
+
+    def write(num_records, epochs=1):
+        def target():
+            for epoch in range(epochs):
+                _write_fifo(str(tmpdir.join('train_{}'.format(epoch))), num_records)
+        writer = threading.Thread(target=target)
+        writer.daemon = True
+        writer.start()
+        writers.append(writer)
+        return str(tmpdir)
+
+    yield write
+    for writer in writers:
+        writer.join(timeout=10)
+
+
+@patch.dict('sys.modules', {'mxnet': MagicMock()})
+def test_pipe_mode_iter(pipe_channel):
+    mx = _mock_mxnet_io()
+    input_dir = pipe_channel(num_records=7, epochs=2)
+
+    data_iter = training_utils.pipe_mode_iter('train', 3, (3,), input_dir=input_dir)
+    epochs = []
+    for _ in range(2):
+        epochs.append(list(data_iter))
+        data_iter.reset()
+
+    for batches in epochs:
+        assert [batch['data'][0][:, 0].tolist() for batch in batches] == [
+            [0, 1, 2], [3, 4, 5], [6, 6, 6]]
+        assert batches[0]['label'][0].tolist() == [0, 1, 0]
+        assert [batch['pad'] for batch in batches] == [0, 0, 2]
+    assert data_iter.epoch == 2
+    mx.io.DataDesc.assert_any_call('softmax_label', (3,), np.float32)
+
+
+@patch.dict('sys.modules', {'mxnet': MagicMock()})
+def test_pipe_mode_iter_skips_rest_of_epoch_on_reset(pipe_channel):
+    _mock_mxnet_io()
+    input_dir = pipe_channel(num_records=100, epochs=2)
+
+    data_iter = training_utils.pipe_mode_iter('train', 4, (3,), input_dir=input_dir,
+                                              last_batch_handle='discard', prefetch=1)
+    next(data_iter)
+    data_iter.reset()
+
+    assert data_iter.epoch == 1
+    assert len(list(data_iter)) == 25
+
+
+@patch.dict('sys.modules', {'mxnet': MagicMock()})
+def test_pipe_mode_iter_without_fifo(tmpdir):
+    _mock_mxnet_io()
+
+    data_iter = training_utils.pipe_mode_iter('train', 4, (3,), input_dir=str(tmpdir),
+                                              timeout=0)
+    with pytest.raises(IOError):
+        next(data_iter)
+
+
+def test_read_records_joins_split_records():
+    magic = struct.pack('<I', training_utils.RECORDIO_MAGIC)
+    payloads = [b'abc', magic + b'de' + magic, b'']
+    stream = io.BytesIO(b''.join(_record(0, payload) for payload in payloads))
+
+    records = list(training_utils._read_records(stream))
+
+    assert [training_utils._unpack_record(record, 1)[1] for record in records] == payloads
+
+
+@pytest.mark.parametrize('data', [b'\x01\x02', struct.pack('<II', 1, 0)])
+def test_read_records_with_corrupt_stream(data):
+    with pytest.raises(ValueError):
+        list(training_utils._read_records(io.BytesIO(data)))
+
+
+def test_unpack_record_with_label_array():
+    record = struct.pack('<IfQQ', 2, 0, 0, 0) + struct.pack('<ff', 1.5, 2.5) + b'data'
+
+    label, payload = training_utils._unpack_record(record, 2)
+
+    assert label.tolist() == [1.5, 2.5]
+    assert payload == b'data'
+
+
+@pytest.mark.parametrize('num_samples, shards', [
+    (10, [(0, 3), (3, 6), (6, 10)]), (2, [(0, 0), (0, 1), (1, 2)]), (9, [(0, 3), (3, 6), (6, 9)])])
+def test_host_shard(num_samples, shards):
+    hosts = ['host-1', 'host-2', 'host-3']
+
+    assert [training_utils.host_shard(num_samples, hosts, host) for host in hosts] == shards
+
+
+@patch('os.environ', {'SM_CURRENT_HOST': WORKER_HOST,
+                      'SM_HOSTS': json.dumps([SCHEDULER_HOST, WORKER_HOST])})
+def test_host_shard_from_environment():
+    assert training_utils.host_shard(11) == (5, 11)
+
+
+def test_atomic_write(tmpdir):
+    path = str(tmpdir.join('file.txt'))
+
+    training_utils.atomic_write(path, lambda tmp_path: _write_file(tmp_path, 'content'))
+
+    assert os.listdir(str(tmpdir)) == ['file.txt']
+    assert tmpdir.join('file.txt').read() == 'content'
+
+
+def test_atomic_write_failure_leaves_no_file(tmpdir):
+    def write(tmp_path):
+        _write_file(tmp_path, 'partial')
+        raise IOError('disk full')
+
+    with pytest.raises(IOError):
+        training_utils.atomic_write(str(tmpdir.join('file.txt')), write, per_process=True)
+
+    assert os.listdir(str(tmpdir)) == []
+
+
+def test_epoch_permutation_is_deterministic_per_epoch():
+    first = training_utils.epoch_permutation(100, epoch=0, seed=7)
+
+    assert sorted(first.tolist()) == list(range(100))
+    assert first.dtype == np.int32
+    assert training_utils.epoch_permutation(100, epoch=0, seed=7).tolist() == first.tolist()
+    assert training_utils.epoch_permutation(100, epoch=1, seed=7).tolist() != first.tolist()
+    assert training_utils.epoch_permutation(100, epoch=0, seed=8).tolist() != first.tolist()
+
+
+@patch('sagemaker_mxnet_container.training_utils.PERMUTATION_CHUNK_SIZE', 16)
+def test_epoch_permutation_memory_mapped(tmpdir):
+    indices = training_utils.epoch_permutation(100, epoch=3, index_dir=str(tmpdir))
+
+    assert isinstance(indices, np.memmap)
+    assert indices.tolist() == training_utils.epoch_permutation(100, epoch=3).tolist()
+    assert os.listdir(str(tmpdir)) == ['permutation-100-seed-0-epoch-3.npy']
+
+    with patch('sagemaker_mxnet_container.training_utils._write_permutation') as write:
+        training_utils.epoch_permutation(100, epoch=3, index_dir=str(tmpdir))
+    write.assert_not_called()
+
+
+def test_epoch_permutation_removes_earlier_epochs(tmpdir):
+    for name in ['permutation-100-seed-0-epoch-3.npy', 'permutation-100-seed-0-epoch-1.npy',
+                 'permutation-100-seed-1-epoch-1.npy', 'permutation-50-seed-0-epoch-1.npy']:
+        tmpdir.join(name).write('')
+
+    training_utils.epoch_permutation(100, epoch=2, index_dir=str(tmpdir))
+
+    assert sorted(os.listdir(str(tmpdir))) == [
+        'permutation-100-seed-0-epoch-2.npy', 'permutation-100-seed-0-epoch-3.npy',
+        'permutation-100-seed-1-epoch-1.npy', 'permutation-50-seed-0-epoch-1.npy']
+
+
+def test_epoch_permutation_removes_partial_file(tmpdir):
+    with patch('os.rename', side_effect=OSError):
+        with pytest.raises(OSError):
+            training_utils.epoch_permutation(100, epoch=0, index_dir=str(tmpdir))
+
+    assert os.listdir(str(tmpdir)) == []
+
+
+def test_shuffled_shard():
+    hosts = ['host-1', 'host-2', 'host-3']
+
+    for epoch in range(2):
+        shards = [training_utils.shuffled_shard(50, epoch, 0, hosts, host).tolist()
+                  for host in hosts]
+        assert [len(shard) for shard in shards] == [16, 17, 17]
+        assert sorted(sum(shards, [])) == list(range(50))
+        # not a shuffle inside fixed shards
+        assert max(shards[0]) >= 16 or min(shards[2]) < 33
+
+
+@patch.dict('sys.modules', {'mxnet': MagicMock()})
+def test_numpy_shard_iter_shuffles_globally(tmpdir):
+    _mock_mxnet_io()
+    data, label = _write_npy(tmpdir, num_samples=20)
+    hosts = ['host-1', 'host-2']
+
+    iters = [training_utils.numpy_shard_iter(data, label, batch_size=5, hosts=hosts,
+                                             current_host=host, shuffle=True) for host in hosts]
+    for epoch in range(2):
+        samples = [sum((batch['label'][0].tolist() for batch in data_iter), [])
+                   for data_iter in iters]
+        assert sorted(samples[0] + samples[1]) == list(range(20))
+        assert [sorted(host_samples) for host_samples in samples] == [
+            sorted(training_utils.shuffled_shard(20, epoch, 0, hosts, host).tolist())
+            for host in hosts]
+        for data_iter in iters:
+            data_iter.reset()
+
+
+def _write_idx(path, array, compress=True):
+    type_code = {'uint8': 0x08, 'int16': 0x0b}[str(array.dtype)]
+    content = (struct.pack('>HBB', 0, type_code, array.ndim)
+               + struct.pack('>{}I'.format(array.ndim), *array.shape)
+               + array.astype(array.dtype.newbyteorder('>')).tobytes())
+    with (gzip.open(path, 'wb') if compress else open(path, 'wb')) as f:
+        f.write(content)
+
+
+@patch('sagemaker_mxnet_container.training_utils.IDX_CHUNK_BYTES', 7)
+def test_load_idx(tmpdir):
+    images = np.arange(60, dtype='uint8').reshape(3, 4, 5)
+    _write_idx(str(tmpdir.join('images.gz')), images)
+    cache_dir = str(tmpdir.join('cache'))
+
+    loaded = training_utils.load_idx(str(tmpdir.join('images.gz')), cache_dir=cache_dir)
+
+    assert isinstance(loaded, np.memmap)
+    assert loaded.dtype == np.uint8
+    assert loaded.tolist() == images.tolist()
+
+    scaled = training_utils.load_idx(str(tmpdir.join('images.gz')), scale=0.5,
+                                     cache_dir=cache_dir)
+
+    assert scaled.dtype == np.float32
+    assert scaled.tolist() == (images * 0.5).tolist()
+    assert len(os.listdir(cache_dir)) == 2
+
+
+def test_load_idx_in_parallel(tmpdir):
+    arrays = [np.arange(10, dtype='int16') * 300, np.arange(6, dtype='uint8').reshape(2, 3)]
+    paths = [str(tmpdir.join('labels')), str(tmpdir.join('images.gz'))]
+    _write_idx(paths[0], arrays[0], compress=False)
+    _write_idx(paths[1], arrays[1])
+
+    loaded = training_utils.load_idx(paths, dtype='float32', cache_dir=str(tmpdir.join('cache')))
+
+    assert [array.tolist() for array in loaded] == [array.tolist() for array in arrays]
+    assert [array.dtype for array in loaded] == [np.float32, np.float32]
+
+
+def test_load_idx_decodes_once(tmpdir):
+    path = str(tmpdir.join('images.gz'))
+    _write_idx(path, np.zeros(4, dtype='uint8'))
+    cache_dir = str(tmpdir.join('cache'))
+    training_utils.load_idx(path, cache_dir=cache_dir)
+
+    with patch('sagemaker_mxnet_container.training_utils._decode_idx') as decode:
+        training_utils.load_idx(path, cache_dir=cache_dir)
+    decode.assert_not_called()
+
+    _write_idx(path, np.ones(4, dtype='uint8'))
+    os.utime(path, ns=(0, 0))
+
+    assert training_utils.load_idx(path, cache_dir=cache_dir).tolist() == [1, 1, 1, 1]
+
+
+@pytest.mark.parametrize('content', [b'\x00\x00\x99\x01', b'\x00\x00\x08\x01\x00\x00\x00\x05\x01'])
+def test_load_idx_with_invalid_file(content, tmpdir):
+    path = tmpdir.join('images')
+    path.write_binary(content)
+    cache_dir = tmpdir.join('cache')
+
+    with pytest.raises(ValueError):
+        training_utils.load_idx(str(path), cache_dir=str(cache_dir))
+
+    assert cache_dir.listdir() == []
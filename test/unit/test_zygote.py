@@ -0,0 +1,159 @@
+# Copyright 2018-2020 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the 'License'). You
+# may not use this file except in compliance with the License. A copy of
+# the License is located at
+#
+#     http://aws.amazon.com/apache2.0/
+#
+# or in the 'license' file accompanying this file. This file is
+# distributed on an 'AS IS' BASIS, WITHOUT WARRANTIES OR CONDITIONS OF
+# ANY KIND, either express or implied. See the License for the specific
+# language governing permissions and limitations under the License.
+from __future__ import absolute_import
+
+import json
+import os
+import signal
+import subprocess
+import threading
+
+from mock import patch
+import pytest
+
+from sagemaker_mxnet_container import zygote
+from sagemaker_mxnet_container.zygote import Zygote, ZygoteError
+
+ROLE_MODULE = '''
+import os
+import sys
+import time
+
+
+def run():
+    with open(os.environ['ROLE_OUTPUT'], 'w') as f:
+        f.write(os.environ['DMLC_ROLE'])
+    time.sleep(float(os.environ.get('ROLE_SLEEP', 0)))
+    sys.exit(int(os.environ.get('ROLE_EXIT_CODE', 0)))
+'''
+
+
+@pytest.fixture
+def started_zygote(tmpdir, monkeypatch):
+    tmpdir.join('zygote_role.py').write(ROLE_MODULE)
+    monkeypatch.setenv('PYTHONPATH', str(tmpdir))
+    monkeypatch.setenv('DMLC_ROLE', 'worker')
+
+    started = Zygote(preload=('json',), target='zygote_role:run')
+    started.start()
+    yield started
+    started.close()
+    started.process.kill()
+
+
+def _role_env(tmpdir, role, **kwargs):
+    env = dict(os.environ, DMLC_ROLE=role, ROLE_OUTPUT=str(tmpdir.join(role)))
+    env.update(kwargs)
+    return env
+
+
+def test_spawn_applies_role_env(started_zygote, tmpdir):
+    scheduler = started_zygote.spawn('scheduler', _role_env(tmpdir, 'scheduler'))
+    server = started_zygote.spawn('server', _role_env(tmpdir, 'server', ROLE_EXIT_CODE='3'))
+
+    assert scheduler.wait(timeout=10) == 0
+    assert server.wait(timeout=10) == 3
+    assert tmpdir.join('scheduler').read() == 'scheduler'
+    assert tmpdir.join('server').read() == 'server'
+
+
+def test_zygote_exits_after_close(started_zygote, tmpdir):
+    server = started_zygote.spawn('server', _role_env(tmpdir, 'server', ROLE_SLEEP='0.2'))
+    started_zygote.close()
+
+    assert started_zygote.process.wait(timeout=10) == 0
+    assert server.poll() == 0
+
+
+def test_terminate_role(started_zygote, tmpdir):
+    server = started_zygote.spawn('server', _role_env(tmpdir, 'server', ROLE_SLEEP='60'))
+    assert server.poll() is None
+    with pytest.raises(subprocess.TimeoutExpired):
+        server.wait(timeout=0.01)
+
+    server.terminate()
+    assert server.wait(timeout=10) == -signal.SIGTERM
+
+
+def test_preload_sees_zygote_env(tmpdir, monkeypatch):
+    tmpdir.join('zygote_preload.py').write(
+        "import os\n"
+        "with open(os.environ['PRELOAD_OUTPUT'], 'w') as f:\n"
+        "    f.write(os.environ.get('OMP_NUM_THREADS', ''))\n")
+    monkeypatch.setenv('PYTHONPATH', str(tmpdir))
+    monkeypatch.setenv('PRELOAD_OUTPUT', str(tmpdir.join('preload')))
+    monkeypatch.setenv('OMP_NUM_THREADS', '8')
+
+    started = Zygote(preload=('zygote_preload',), env={'OMP_NUM_THREADS': '2'})
+    started.start()
+    started.close()
+    started.process.wait(timeout=10)
+
+    assert tmpdir.join('preload').read() == '2'
+
+
+def test_start_without_preload_module():
+    with pytest.raises(ZygoteError):
+        Zygote(preload=('sagemaker_mxnet_container_missing_module',)).start()
+
+
+def test_serve_forks_roles_until_requests_close():
+    request_read, request_write = os.pipe()
+    response_read, response_write = os.pipe()
+
+    server = threading.Thread(target=zygote.main,
+                              args=([str(request_read), str(response_write), 'os:getpid', 'json'],))
+    server.start()
+    os.write(request_write, json.dumps({'id': 0, 'role': 'server', 'env': dict(os.environ),
+                                        'requested_at': 0}).encode('utf-8') + b'\n')
+    os.close(request_write)
+    server.join(timeout=10)
+    os.close(response_write)
+
+    with os.fdopen(response_read) as responses:
+        events = [json.loads(line) for line in responses]
+    os.close(request_read)
+
+    assert [event['event'] for event in events] == ['started', 'ready', 'exit']
+    assert events[1]['pid'] == events[2]['pid']
+    assert events[2]['returncode'] == 0
+
+
+@pytest.mark.parametrize('target, returncode', [
+    ('os:getpid', 0), ('sys:exit', 0), ('os:abort_missing', 1)])
+@patch('os._exit')
+@patch('os.close')
+@patch('sagemaker_mxnet_container.zygote._send')
+def test_run_role(send, close, exit, target, returncode):
+    request = {'id': 1, 'role': 'scheduler', 'env': {'DMLC_ROLE': 'scheduler'},
+               'requested_at': 0}
+
+    with patch.dict('os.environ', {'SOME_VAR': '1'}):
+        zygote._run_role(request, 3, 4, target)
+        assert os.environ == {'DMLC_ROLE': 'scheduler'}
+
+    assert send.call_args[0][1]['event'] == 'ready'
+    exit.assert_called_once_with(returncode)
+
+
+@patch('os.sched_setaffinity', create=True)
+@patch('os._exit')
+@patch('os.close')
+@patch('sagemaker_mxnet_container.zygote._send')
+def test_run_role_with_cpus(send, close, exit, sched_setaffinity):
+    request = {'id': 1, 'role': 'server', 'env': {}, 'cpus': [2, 3], 'requested_at': 0}
+
+    with patch.dict('os.environ', {}):
+        zygote._run_role(request, 3, 4, 'os:getpid')
+
+    sched_setaffinity.assert_called_once_with(0, [2, 3])